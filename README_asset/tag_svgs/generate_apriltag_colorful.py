@@ -1,108 +1,152 @@
-import svgwrite
-
-# Parameters for the AprilTag and layout
-tag_size = 120  # Size of the AprilTag in mm
-square_size = tag_size / 8  # Size of each square in mm (for an 8x8 grid)
-boundary_size = 15 # Size of the boundary in mm
-base_size = tag_size + 2 * boundary_size  # Size of the AprilTag including the boundary
-
-# Parameters for the layout grid
-rows = 1  # Number of rows of AprilTags
-cols = 1  # Number of columns of AprilTags
-spacing = 20  # Spacing between AprilTags in mm
-paper_x_offset = 30
-paper_y_offset = 30
-
-outer_color = "black"
-inner_color = "#7cbdc5"
-
-tag1_colors = [[0, 0, 0, 0, 0, 0, 0, 0],
-               [0, 1, 1, 0, 1, 1, 0, 0],
-               [0, 0, 1, 0, 1, 1, 1, 0],
-               [0, 1, 1, 1, 1, 0, 0, 0],
-               [0, 0, 1, 1, 0, 0, 0, 0],
-               [0, 1, 0, 1, 1, 0, 1, 0],
-               [0, 0, 0, 1, 0, 0, 1, 0],
-               [0, 0, 0, 0, 0, 0, 0, 0]]
-
-tag2_colors = [[0, 0, 0, 0, 0, 0, 0, 0],
-                [0, 1, 1, 0, 1, 1, 1, 0],
-                [0, 0, 1, 0, 0, 1, 0, 0],
-                [0, 1, 0, 0, 0, 0, 0, 0],
-                [0, 0, 0, 1, 0, 0, 1, 0],
-                [0, 0, 0, 0, 1, 0, 0, 0],
-                [0, 0, 0, 1, 1, 1, 0, 0],
-                [0, 0, 0, 0, 0, 0, 0, 0]]
-
-tag3_colors = [[0, 0, 0, 0, 0, 0, 0, 0],
-                [0, 1, 1, 1, 0, 0, 1, 0],
-                [0, 0, 0, 0, 1, 1, 1, 0],
-                [0, 1, 0, 0, 1, 1, 1, 0],
-                [0, 1, 0, 1, 0, 0, 1, 0],
-                [0, 1, 1, 0, 0, 1, 0, 0],
-                [0, 0, 1, 1, 0, 0, 0, 0],
-                [0, 0, 0, 0, 0, 0, 0, 0]]
-
-tag4_colors = [[0, 0, 0, 0, 0, 0, 0, 0],
-                [0, 1, 1, 1, 0, 1, 0, 0],
-                [0, 1, 1, 1, 1, 0, 0, 0],
-                [0, 1, 0, 1, 1, 1, 1, 0],
-                [0, 0, 0, 1, 0, 1, 0, 0],
-                [0, 1, 0, 0, 0, 0, 0, 0],
-                [0, 1, 0, 0, 0, 1, 0, 0],
-                [0, 0, 0, 0, 0, 0, 0, 0]]
-
-tag5_colors = [[0, 0, 0, 0, 0, 0, 0, 0],
-                [0, 1, 1, 1, 1, 0, 0, 0],
-                [0, 1, 1, 0, 0, 0, 1, 0],
-                [0, 1, 1, 0, 1, 1, 0, 0],
-                [0, 1, 0, 1, 0, 1, 1, 0],
-                [0, 0, 0, 1, 1, 1, 0, 0],
-                [0, 1, 0, 1, 1, 0, 0, 0],
-                [0, 0, 0, 0, 0, 0, 0, 0]]
-
-
-
-# Calculate the total size of the layout grid in mm
-total_width = cols * base_size + (cols - 1) * spacing + paper_x_offset
-total_height = rows * base_size + (rows - 1) * spacing + paper_y_offset
-
-# Create a new SVG drawing for the entire layout
-tag_colors = tag5_colors
-dwg = svgwrite.Drawing(f"tag5_blue.svg", profile="tiny", size=("297mm", "210mm"))  # A4 size paper    
-# dwg.add(dwg.text(f"tag36h11, ID: {1}", 
-#                 insert=(f"{paper_x_offset}mm", f"{paper_y_offset - 15}mm"),
-#                 font_size="5mm", font_family="Arial", fill="black"))
-
-# Generate multiple AprilTags and position them within the layout
-for row in range(rows):
-    for col in range(cols):
-        # Get the tag pattern
-        
-
-        # Calculate position for each AprilTag within the layout grid
-        x_offset = col * (base_size + spacing) + paper_x_offset
-        y_offset = row * (base_size + spacing) + paper_y_offset
-
-        # Add the inner boundary rectangle in inner color
-        dwg.add(dwg.rect(
-            (f"{x_offset - boundary_size}mm", f"{y_offset - boundary_size}mm"),
-            (f"{base_size}mm", f"{base_size}mm"),
-            fill=inner_color,
-            stroke='none'
-        ))
-
-        # Create the grid of rectangles (AprilTag pattern)
-        for i in range(8):
-            y = i * square_size + y_offset
-            for j in range(8):
-                x = j * square_size + x_offset
-                
-                # Set color: 0 for red, 1 for green
-                color = outer_color if tag_colors[i][j] == 0 else inner_color
-
-                dwg.add(dwg.rect((f"{x}mm", f"{y}mm"), (f"{square_size}mm", f"{square_size}mm"), fill=color, stroke='none'))
-
-
-# Save the SVG file for the entire layout
-dwg.save()
+import argparse
+import multiprocessing
+import os
+
+import svgwrite
+import yaml
+
+from tag36h11 import tag_pattern
+
+# Parameters for the AprilTag and layout
+tag_size = 120  # Size of the AprilTag in mm
+boundary_size = 15 # Size of the boundary in mm
+
+# Parameters for the layout grid
+spacing = 20  # Spacing between AprilTags in mm
+paper_x_offset = 30
+paper_y_offset = 30
+paper_size = (297, 210)  # A4 landscape in mm
+
+outer_color = "black"
+inner_color = "#7cbdc5"
+
+default_map = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "planner", "config", "map.yaml")
+
+
+def parse_ids(spec):
+    # "1-5,10" -> [1, 2, 3, 4, 5, 10]
+    ids = []
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            ids.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            ids.append(int(part))
+    return ids
+
+
+def map_ids(map_path):
+    # Tag ids placed in the map, the keys of tags in map.yaml
+    with open(map_path, "r") as file:
+        return sorted(int(tag_id) for tag_id in yaml.safe_load(file)["tags"])
+
+
+def runs(pattern, value):
+    # Rectangles (col, row, width, height) in cells covering the cells of a value: runs in each row,
+    # merged with the same run of the rows below
+    rects = []
+    open_rects = {}
+    for row, cells in enumerate(pattern):
+        row_runs = []
+        col = 0
+        while col < len(cells):
+            if cells[col] != value:
+                col += 1
+                continue
+            start = col
+            while col < len(cells) and cells[col] == value:
+                col += 1
+            row_runs.append((start, col - start))
+        next_open = {}
+        for run in row_runs:
+            rect = open_rects.pop(run, None)
+            if rect is None:
+                rect = [run[0], row, run[1], 0]
+                rects.append(rect)
+            rect[3] += 1
+            next_open[run] = rect
+        open_rects = next_open
+    return rects
+
+
+def rect_path(x, y, width, height):
+    return f"M{x:g},{y:g}h{width:g}v{height:g}h{-width:g}z"
+
+
+def layout(tag_size, boundary_size, spacing, paper_size):
+    # (cols, rows) of tags that fit on a page with the same margins on all sides
+    base_size = tag_size + 2 * boundary_size
+    cols = max(1, int((paper_size[0] - 2 * (paper_x_offset - boundary_size) + spacing) // (base_size + spacing)))
+    rows = max(1, int((paper_size[1] - 2 * (paper_y_offset - boundary_size) + spacing) // (base_size + spacing)))
+    return cols, rows
+
+
+def page_name(ids):
+    return f"tag{ids[0]}_blue.svg" if len(ids) == 1 else f"tags{ids[0]}-{ids[-1]}_blue.svg"
+
+
+def render_page(task):
+    ids, path, args = task
+    square_size = args.tag_size / 8
+    base_size = args.tag_size + 2 * args.boundary_size
+    cols, _ = layout(args.tag_size, args.boundary_size, args.spacing, paper_size)
+
+    # Coordinates in mm, one path per color for the whole page
+    dwg = svgwrite.Drawing(path, profile="tiny", size=(f"{paper_size[0]}mm", f"{paper_size[1]}mm"),
+                           viewBox=f"0 0 {paper_size[0]} {paper_size[1]}")
+    inner = []
+    outer = []
+    for index, tag_id in enumerate(ids):
+        row, col = divmod(index, cols)
+        x_offset = col * (base_size + args.spacing) + paper_x_offset
+        y_offset = row * (base_size + args.spacing) + paper_y_offset
+
+        # The boundary in inner color, the light cells are left uncovered
+        inner.append(rect_path(x_offset - args.boundary_size, y_offset - args.boundary_size, base_size, base_size))
+        for j, i, width, height in runs(tag_pattern(tag_id), 0):
+            outer.append(rect_path(x_offset + j * square_size, y_offset + i * square_size,
+                                   width * square_size, height * square_size))
+        if args.label:
+            dwg.add(dwg.text(f"tag36h11, ID: {tag_id}", insert=(x_offset - args.boundary_size, y_offset - args.boundary_size - 2),
+                             font_size=4, font_family="Arial", fill="black"))
+
+    dwg.add(dwg.path(d="".join(inner), fill=inner_color, stroke="none"))
+    dwg.add(dwg.path(d="".join(outer), fill=outer_color, stroke="none"))
+    dwg.save()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print sheets of tag36h11 AprilTags with a colored boundary.")
+    parser.add_argument("--ids", help="Tag ids, e.g. 1-5,10. Default: the tags of --map")
+    parser.add_argument("--map", default=default_map, help="map.yaml whose tags are printed")
+    parser.add_argument("--tag-size", type=float, default=tag_size, help="Size of the AprilTag in mm")
+    parser.add_argument("--boundary-size", type=float, default=boundary_size, help="Size of the boundary in mm")
+    parser.add_argument("--spacing", type=float, default=spacing, help="Spacing between AprilTags in mm")
+    parser.add_argument("--label", action="store_true", help="Print the id above each tag")
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--workers", type=int, default=1, help="Pages rendered in parallel")
+    args = parser.parse_args()
+
+    ids = parse_ids(args.ids) if args.ids else map_ids(args.map)
+    cols, rows = layout(args.tag_size, args.boundary_size, args.spacing, paper_size)
+    per_page = cols * rows
+    tasks = []
+    for start in range(0, len(ids), per_page):
+        page_ids = ids[start:start + per_page]
+        tasks.append((page_ids, os.path.join(args.out_dir, page_name(page_ids)), args))
+
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        try:
+            paths = pool.map(render_page, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        paths = [render_page(task) for task in tasks]
+    print(f"{len(ids)} tags on {len(paths)} pages, {per_page} per page")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,29 +5,81 @@
 # and the tag pose in the camera frame
 import rospy
 import numpy as np
-from dt_apriltags import Detector
 import yaml
-import cv2
 import os
-from scipy.spatial.transform import Rotation as R
+import queue
+import threading
 from sensor_msgs.msg import CompressedImage
 from geometry_msgs.msg import PoseStamped
-from apriltag_detection.msg import ApriltagMsg
-from typing import Tuple, Dict
+from apriltag_detection.msg import ApriltagMsg, ApriltagArrayMsg, ApriltagDistanceMsg
+from tag_filter import TagFilterBank, time_to_distance
+from detector_config import read_intrinsics, default_detector_config, detector_config_path, load_detector_config
+from apriltag_pipeline import AprilTagPipeline, PipelineResult, rotation_mats_to_quats, draw_overlay
+from frame_bus.frame_ring import FrameBusReader, default_ring_name
+from frame_bus.compressed_fallback import CompressedFallback, latest_frame
+from typing import Tuple, Dict, List, Optional, Set
 
-def rotation_mat_to_quat(rot_mat: np.ndarray) -> dict:
-    if rot_mat.shape != (3, 3):
-        raise ValueError("Rotation matrix must be 3x3.")
-    
-    rotation = R.from_matrix(rot_mat)
-    quat = rotation.as_quat() # scalar last
-    
-    return {
-        "x": quat[0],
-        "y": quat[1],
-        "z": quat[2],
-        "w": quat[3]
-    }
+def build_tag_msgs(posed_tags: list, stamp: rospy.Time, frame_id: str, tags: Dict[int, list], goal_tag_id: int) -> List[ApriltagMsg]:
+    if not posed_tags:
+        return []
+    positions = np.stack([tag.pose_t.reshape(3) for tag in posed_tags])
+    quats = rotation_mats_to_quats(np.stack([tag.pose_R for tag in posed_tags]))
+
+    tag_msgs = []
+    for tag, position, quat in zip(posed_tags, positions, quats):
+        tag_msg = ApriltagMsg()
+        tag_msg.tag_id = tag.tag_id
+        tag_msg.tag_pose = PoseStamped()
+        tag_msg.tag_pose.header.stamp = stamp
+        tag_msg.tag_pose.header.frame_id = frame_id
+        tag_msg.tag_pose.pose.position.x = position[0]
+        tag_msg.tag_pose.pose.position.y = position[1]
+        tag_msg.tag_pose.pose.position.z = position[2]
+        tag_msg.tag_pose.pose.orientation.x = quat[0]
+        tag_msg.tag_pose.pose.orientation.y = quat[1]
+        tag_msg.tag_pose.pose.orientation.z = quat[2]
+        tag_msg.tag_pose.pose.orientation.w = quat[3]
+
+        if tag.tag_id == goal_tag_id:
+            tag_msg.grid_coords = [-1, -1]
+        else:
+            tag_msg.grid_coords = tags[tag.tag_id]
+        tag_msgs.append(tag_msg)
+    return tag_msgs
+
+def build_distance_msg(tag_filters: TagFilterBank, stamp: rospy.Time, frame_id: str, stop_dist: float) -> ApriltagDistanceMsg:
+    # Filtered distance of the closest tracked tag, predicted to stamp
+    distance_msg = ApriltagDistanceMsg()
+    distance_msg.header.stamp = stamp
+    distance_msg.header.frame_id = frame_id
+
+    closest = tag_filters.closest(stamp.to_sec())
+    if closest is None:
+        distance_msg.tag_id = -1 # No tag tracked
+        distance_msg.time_to_stop = -1
+    else:
+        tag_id, position, velocity = closest
+        distance_msg.tag_id = tag_id
+        distance_msg.distance = position[2]
+        distance_msg.velocity = velocity[2]
+        distance_msg.time_to_stop = time_to_distance(position[2], velocity[2], stop_dist)
+    return distance_msg
+
+def no_tag_msg() -> ApriltagMsg:
+    tag_msg = ApriltagMsg()
+    tag_msg.tag_id = -1 # No tag detected
+    tag_msg.tag_pose = PoseStamped()
+    tag_msg.tag_pose.header.stamp = rospy.Time.now()
+    tag_msg.tag_pose.header.frame_id = "camera_frame"
+    tag_msg.tag_pose.pose.position.x = 0
+    tag_msg.tag_pose.pose.position.y = 0
+    tag_msg.tag_pose.pose.position.z = 0
+    tag_msg.tag_pose.pose.orientation.x = 0
+    tag_msg.tag_pose.pose.orientation.y = 0
+    tag_msg.tag_pose.pose.orientation.z = 0
+    tag_msg.tag_pose.pose.orientation.w = 1
+    tag_msg.grid_coords = [0, 0]
+    return tag_msg
 
 
 class AprilTagDetectionNode:
@@ -39,21 +91,37 @@ class AprilTagDetectionNode:
     map: np.ndarray
     tags: Dict[int, list]
     goal_tag_id: int
+    valid_ids: Set[int]
+    pose_candidates: int
     intrinsic_dict: dict
     camera_matrix: np.ndarray
     distortion_coefficients: np.ndarray
     projection_matrix: np.ndarray
 
-    detector: Detector
+    detector_config: dict
+    pipeline: AprilTagPipeline
 
     timer: rospy.Timer
     
-    image_sub: rospy.Subscriber
-    last_image: CompressedImage
+    fallback: CompressedFallback
+    frame_bus: Optional[FrameBusReader]
     
     tag_pub: rospy.Publisher
+    tag_array_pub: rospy.Publisher
     overlay_pub: rospy.Publisher
 
+    prediction_rate: float
+    stop_dist: float
+    tag_filters: TagFilterBank
+    prediction_timer: rospy.Timer
+    tag_distance_pub: rospy.Publisher
+
+    overlay_rate: float
+    overlay_jpeg_quality: int
+    last_overlay_time: float
+    overlay_queue: queue.Queue
+    overlay_thread: threading.Thread
+
     def __init__(self) -> None:
         self.node_name = rospy.get_name()
         rospy.loginfo(f"[{self.node_name}] Initializing {self.node_name} node...")
@@ -66,10 +134,21 @@ class AprilTagDetectionNode:
         # Decide if we render the overlay image, default is True
         self.render_overlay = rospy.get_param("~render_overlay", True)
         rospy.loginfo(f"[{self.node_name}] Render overlay: {self.render_overlay}")
+        # The overlay is only for visualization, it can run slower and with lower quality than detection
+        self.overlay_rate = float(rospy.get_param("~overlay_rate", 2.0)) # Hz
+        self.overlay_jpeg_quality = int(rospy.get_param("~overlay_jpeg_quality", 75))
+        if self.render_overlay:
+            rospy.loginfo(f"[{self.node_name}] Overlay rate: {self.overlay_rate} Hz, JPEG quality: {self.overlay_jpeg_quality}")
         
-        # Lower detection rate to reduce latency
-        self.detection_rate = 5 # Hz
+        # Lower detection rate to reduce latency, the tag filters predict the distance in between
+        self.detection_rate = float(rospy.get_param("~detection_rate", 5.0)) # Hz
         rospy.loginfo(f"[{self.node_name}] Detection rate: {self.detection_rate} Hz")
+        self.prediction_rate = float(rospy.get_param("~prediction_rate", 20.0)) # Hz
+        rospy.loginfo(f"[{self.node_name}] Prediction rate: {self.prediction_rate} Hz")
+        self.stop_dist = float(rospy.get_param("~stop_dist", 0.3)) # [m]
+        self.tag_filters = TagFilterBank(track_timeout=float(rospy.get_param("~track_timeout", 0.5)),
+                                         accel_noise=float(rospy.get_param("~filter_accel_noise", 0.5)),
+                                         meas_noise=float(rospy.get_param("~filter_meas_noise", 0.02)))
 
         # keep everything in meter [m]
         self.tag_size = rospy.get_param("~tag_size")
@@ -93,23 +172,40 @@ class AprilTagDetectionNode:
         self.distortion_coefficients = self.intrinsic_dict['distortion_coefficients']
         self.projection_matrix = self.intrinsic_dict['projection_matrix']
 
-        self.detector = Detector(searchpath=["apriltags"],
-                                    families="tag36h11",
-                                    nthreads=1,
-                                    quad_decimate=1.0,
-                                    quad_sigma=0.0,
-                                    refine_edges=1,
-                                    decode_sharpening=0.25,
-                                    debug=0)
-        
-        self.last_image = None
-        self.image_sub = rospy.Subscriber(f"/{self.robot_name}/camera_node/image/compressed", CompressedImage, self.__store_latest_image_cb)
+        # Only tags on the map and the goal tag are relevant, everything else is never posed
+        self.valid_ids = set(self.tags.keys()) | {self.goal_tag_id}
+        # Number of largest (= closest) valid tags per frame for which the pose is solved
+        self.pose_candidates = int(rospy.get_param("~pose_candidates", 2))
+        rospy.loginfo(f"[{self.node_name}] Pose candidates per frame: {self.pose_candidates}")
+
+        self.detector_config = self._read_detector_config()
+        self.pipeline = AprilTagPipeline(self.camera_matrix, self.distortion_coefficients, self.tag_size,
+                                         self.valid_ids, self.detector_config, self.pose_candidates)
+
+        # Decoded frames from the frame bus node if it runs, the compressed images are only decoded here without it
+        self.frame_bus = None
+        if rospy.get_param("~use_frame_bus", True):
+            self.frame_bus = FrameBusReader(rospy.get_param("~frame_bus_ring_name", default_ring_name(self.robot_name)))
+        rospy.loginfo(f"[{self.node_name}] Use frame bus: {self.frame_bus is not None}")
+
+        # Only subscribed while the frame bus is not available
+        self.fallback = CompressedFallback(f"/{self.robot_name}/camera_node/image/compressed")
         
         self.timer = rospy.Timer(rospy.Duration(1/self.detection_rate), self._process_latest_image)
         self.tag_pub = rospy.Publisher(f"/{self.robot_name}/apriltag_detection_node/tag_info", ApriltagMsg, queue_size=1)
+        # All valid tags in view, sorted by distance, the first one is the one on tag_info
+        self.tag_array_pub = rospy.Publisher(f"/{self.robot_name}/apriltag_detection_node/tag_array", ApriltagArrayMsg, queue_size=1)
+        # Filtered distance of the closest tag, published faster than detection runs
+        self.tag_distance_pub = rospy.Publisher(f"/{self.robot_name}/apriltag_detection_node/tag_distance", ApriltagDistanceMsg, queue_size=1)
+        self.prediction_timer = rospy.Timer(rospy.Duration(1/self.prediction_rate), self._publish_prediction)
         # Publish the overlay image, **don't change endfix /compressed**
         if self.render_overlay:
             self.overlay_pub = rospy.Publisher(f"/{self.robot_name}/apriltag_detection_node/overlay/compressed", CompressedImage, queue_size=1)
+            # Single slot, a pending overlay is replaced by a newer one instead of piling up
+            self.last_overlay_time = 0.0
+            self.overlay_queue = queue.Queue(maxsize=1)
+            self.overlay_thread = threading.Thread(target=self._overlay_worker, daemon=True)
+            self.overlay_thread.start()
 
     def _read_map(self) -> Tuple[np.ndarray, Dict[int, list]]:
         yaml_path = rospy.get_param("~map_yaml_path")
@@ -129,143 +225,115 @@ class AprilTagDetectionNode:
             raise ValueError(f"[{self.node_name}] ~camera_intrinsics_yaml_path is not set")
         rospy.loginfo(f"[{self.node_name}] Intrinsic YAML path: %s", yaml_path)
         
-        with open(yaml_path, "r") as file:
-            data = yaml.safe_load(file)
-
-        # [fx, 0, cx, 0, fy, cy, 0, 0, 1]
-        camera_matrix = np.array(data['camera_matrix']['data']).reshape(
-            data['camera_matrix']['rows'], data['camera_matrix']['cols']
-        )
-        # [k1, k2, p1, p2, k3]
-        distortion_coefficients = np.array(data['distortion_coefficients']['data']).reshape(
-            data['distortion_coefficients']['rows'], data['distortion_coefficients']['cols']
-        )
-        # K * [R|t]
-        projection_matrix = np.array(data['projection_matrix']['data']).reshape(
-            data['projection_matrix']['rows'], data['projection_matrix']['cols']
-        )
-        return {
-            'camera_matrix': camera_matrix,
-            'distortion_coefficients': distortion_coefficients,
-            'projection_matrix': projection_matrix
-        }
-    
-    def __store_latest_image_cb(self, image_msg: CompressedImage) -> None:
-        self.last_image = image_msg
+        return read_intrinsics(yaml_path)
+
+    def _read_detector_config(self) -> dict:
+        # Priority: explicit ROS params > autotuned per-robot file > defaults from the CPU count
+        yaml_path = rospy.get_param("~detector_config_yaml_path", None)
+        if yaml_path is None:
+            yaml_path = detector_config_path(rospy.get_param("~camera_intrinsics_yaml_path"))
+        tuned_config = load_detector_config(yaml_path)
+        if tuned_config:
+            rospy.loginfo(f"[{self.node_name}] Autotuned detector config: %s", yaml_path)
+        else:
+            rospy.loginfo(f"[{self.node_name}] No autotuned detector config at %s, using defaults", yaml_path)
+
+        config = default_detector_config()
+        config.update(tuned_config)
+        for key in config:
+            config[key] = rospy.get_param(f"~{key}", config[key])
+        rospy.loginfo(f"[{self.node_name}] Detector config: %s", config)
+        return config
+
+    def _detect_latest_image(self, max_tags: Optional[int]) -> Optional[Tuple[PipelineResult, float, str]]:
+        # (result, capture time, frame id) of the newest frame, from the frame bus if available
+        frame, image_msg = latest_frame(self.frame_bus, self.fallback)
+        if frame is not None:
+            result = self.pipeline.process_image(frame.image, max_tags)
+            if not self.frame_bus.is_valid(frame):
+                rospy.logwarn(f"[{self.node_name}] Frame {frame.seq} was overwritten during detection, skipping it")
+                return None
+            return result, frame.stamp, f"/{self.robot_name}/camera_frame"
+
+        if image_msg is None:
+            return None # No image to process yet
+        result = self.pipeline.process(image_msg.data, max_tags)
+        if result.image is None:
+            rospy.logerr(f"[{self.node_name}] Failed to decode image!")
+            return None
+        capture_time = image_msg.header.stamp.to_sec() if not image_msg.header.stamp.is_zero() else rospy.get_time()
+        return result, capture_time, image_msg.header.frame_id
 
     def _process_latest_image(self, event) -> None:
-        if self.last_image is None:
-            return # No image to process yet
-        
-        image_msg = self.last_image
         # the img was published at 30hz, but this node only processes at 5hz
-        image = cv2.imdecode(np.frombuffer(image_msg.data, np.uint8), cv2.IMREAD_COLOR)
-        # undistort the image
-        undistorted_image = cv2.undistort(image, self.camera_matrix, self.distortion_coefficients)
-        # convert to grayscale
-        gray = cv2.cvtColor(undistorted_image, cv2.COLOR_BGR2GRAY)
-        
-        fx = self.camera_matrix[0, 0]
-        fy = self.camera_matrix[1, 1]
-        cx = self.camera_matrix[0, 2]
-        cy = self.camera_matrix[1, 2]
-        
-        tags = self.detector.detect(gray, estimate_tag_pose=True, camera_params=[fx, fy, cx, cy], tag_size=self.tag_size)
-        
-        detected_ids = [tag.tag_id for tag in tags]
-        valid_ids = list(self.tags.keys()) + [self.goal_tag_id]
-        checked_ids = []
-        # rospy.loginfo(f"[{self.node_name}] Detected tags: %s", detected_ids)
-
-        # Find the closest tag to the camera
-        closest_tag = None
-        min_distance = float('inf')
-
-        for tag in tags:
-            if tag.tag_id in checked_ids or tag.tag_id not in valid_ids:
-                continue # Skip this tag if already checked or not valid on the map
-            checked_ids.append(tag.tag_id)
-            # Calculate the Euclidean distance of the tag from the camera origin
-            distance = np.linalg.norm(tag.pose_t)
-            if distance < min_distance:
-                min_distance = distance
-                closest_tag = tag
-
-        if closest_tag is not None:
-            # Publish the detected tag info
-            tag_msg = ApriltagMsg()
-            tag_msg.tag_id = closest_tag.tag_id
-            tag_msg.tag_pose = PoseStamped()
-            tag_msg.tag_pose.header.stamp = rospy.Time.now()
-            tag_msg.tag_pose.header.frame_id = f"/{self.robot_name}/camera_frame"
-            tag_msg.tag_pose.pose.position.x = closest_tag.pose_t[0]
-            tag_msg.tag_pose.pose.position.y = closest_tag.pose_t[1]
-            tag_msg.tag_pose.pose.position.z = closest_tag.pose_t[2]
-
-            quat = rotation_mat_to_quat(closest_tag.pose_R)
-            tag_msg.tag_pose.pose.orientation.x = quat['x']
-            tag_msg.tag_pose.pose.orientation.y = quat['y']
-            tag_msg.tag_pose.pose.orientation.z = quat['z']
-            tag_msg.tag_pose.pose.orientation.w = quat['w']
-
-            if closest_tag.tag_id == self.goal_tag_id:
-                tag_msg.grid_coords = [-1, -1]
-            else:
-                tag_msg.grid_coords = self.tags[closest_tag.tag_id]
-            self.tag_pub.publish(tag_msg)
+        # Pose every valid tag only if someone listens to the array, otherwise just the closest candidates
+        publish_array = self.tag_array_pub.get_num_connections() > 0
+        detection = self._detect_latest_image(len(self.valid_ids) if publish_array else None)
+        if detection is None:
+            return
+        result, capture_time, frame_id = detection
+        posed_tags = result.posed_tags
+        stamp = rospy.Time.now()
+        tag_msgs = build_tag_msgs(posed_tags, stamp, f"/{self.robot_name}/camera_frame", self.tags, self.goal_tag_id)
 
-            # Overlay the detected tag on the image
-            if not self.render_overlay:
-                return
-            overlay_image = undistorted_image.copy()
-            for tag in tags:
-                # Ensure corners are in integer coordinates and draw lines between them
-                for idx in range(len(tag.corners)):
-                    start_point = tuple(tag.corners[idx - 1, :].astype(int))
-                    end_point = tuple(tag.corners[idx, :].astype(int))
-                    cv2.line(overlay_image, start_point, end_point, (0, 255, 0), 2)
+        # Feed the filters with the capture time of the frame
+        for tag in posed_tags:
+            self.tag_filters.update(tag.tag_id, tag.pose_t.reshape(3), capture_time)
 
-                # Put the tag id on the image
-                cv2.putText(overlay_image, str(tag.tag_id), 
-                            (int(tag.corners[0, 0]), int(tag.corners[0, 1])), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+        if publish_array:
+            tag_array_msg = ApriltagArrayMsg()
+            tag_array_msg.header.stamp = stamp
+            tag_array_msg.header.frame_id = f"/{self.robot_name}/camera_frame"
+            tag_array_msg.tags = tag_msgs
+            self.tag_array_pub.publish(tag_array_msg)
 
-            _, jpeg_image = cv2.imencode('.jpeg', overlay_image)
-
-            compressed_image_msg = CompressedImage()
-            compressed_image_msg.header = image_msg.header
-            compressed_image_msg.header.stamp = rospy.Time.now()
-            compressed_image_msg.format = "jpeg"
-            compressed_image_msg.data = jpeg_image.tobytes()
-            self.overlay_pub.publish(compressed_image_msg)
+        if tag_msgs:
+            # Publish the closest tag info
+            self.tag_pub.publish(tag_msgs[0])
         else:
             # No tag detected
-            tag_msg = ApriltagMsg()
-            tag_msg.tag_id = -1 # No tag detected
-            tag_msg.tag_pose = PoseStamped()
-            tag_msg.tag_pose.header.stamp = rospy.Time.now()
-            tag_msg.tag_pose.header.frame_id = "camera_frame"
-            tag_msg.tag_pose.pose.position.x = 0
-            tag_msg.tag_pose.pose.position.y = 0
-            tag_msg.tag_pose.pose.position.z = 0
-            tag_msg.tag_pose.pose.orientation.x = 0
-            tag_msg.tag_pose.pose.orientation.y = 0
-            tag_msg.tag_pose.pose.orientation.z = 0
-            tag_msg.tag_pose.pose.orientation.w = 1
-            tag_msg.grid_coords = [0, 0]
+            tag_msg = no_tag_msg()
             self.tag_pub.publish(tag_msg)
 
-            if not self.render_overlay:
-                return
-            # Publish the undistorted image
+        # Only draw the tags if a valid one was found
+        self._queue_overlay(frame_id, result.image, result.tags if tag_msgs else [])
+
+    def _publish_prediction(self, event) -> None:
+        distance_msg = build_distance_msg(self.tag_filters, rospy.Time.now(), f"/{self.robot_name}/camera_frame", self.stop_dist)
+        self.tag_distance_pub.publish(distance_msg)
+
+    def _queue_overlay(self, frame_id: str, undistorted_image: np.ndarray, tags: list) -> None:
+        if not self.render_overlay or self.overlay_pub.get_num_connections() == 0:
+            return # Nobody is watching
+        now = rospy.get_time()
+        if now - self.last_overlay_time < 1 / self.overlay_rate:
+            return
+        self.last_overlay_time = now
+        # The image is not used by the detection thread anymore, the worker may draw on it
+        job = (frame_id, undistorted_image, [(tag.tag_id, tag.corners) for tag in tags])
+        try:
+            self.overlay_queue.put_nowait(job)
+        except queue.Full:
+            try:
+                self.overlay_queue.get_nowait() # Drop the stale overlay
+            except queue.Empty:
+                pass
+            self.overlay_queue.put_nowait(job)
+
+    def _overlay_worker(self) -> None:
+        while not rospy.is_shutdown():
+            try:
+                frame_id, overlay_image, tags = self.overlay_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            jpeg_data = draw_overlay(overlay_image, tags, self.overlay_jpeg_quality)
+
             compressed_image_msg = CompressedImage()
-            compressed_image_msg.header = image_msg.header
+            compressed_image_msg.header.frame_id = frame_id
             compressed_image_msg.header.stamp = rospy.Time.now()
             compressed_image_msg.format = "jpeg"
-            _, jpeg_image = cv2.imencode('.jpeg', undistorted_image)
-            compressed_image_msg.data = jpeg_image.tobytes()
+            compressed_image_msg.data = jpeg_data
             self.overlay_pub.publish(compressed_image_msg)
-                
 
 
 if __name__ == "__main__":
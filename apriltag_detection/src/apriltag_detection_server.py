@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+# Detection server for a fleet: one process on an edge box runs the AprilTag detection
+# for many robots. Camera frames of all robots are dispatched round robin to a pool of
+# worker processes, each with its own detector and a per-robot pipeline (intrinsics) cache.
+# The results are published on each robot's apriltag_detection_node/tag_info topic, and like the node
+# the filtered distance of the closest tag on apriltag_detection_node/tag_distance.
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
+import time
+from collections import deque
+from functools import partial
+from typing import Deque, Dict, List, Optional
+
+import numpy as np
+import rospy
+import yaml
+from sensor_msgs.msg import CompressedImage
+from std_msgs.msg import String
+from apriltag_detection.msg import ApriltagMsg, ApriltagDistanceMsg
+
+from apriltag_pipeline import AprilTagPipeline
+from apriltag_detection_node import build_tag_msgs, build_distance_msg, no_tag_msg
+from tag_filter import TagFilterBank
+from detector_config import read_intrinsics, default_detector_config
+
+# Per worker process state, set by _init_worker
+_worker_settings: dict = {}
+_worker_pipelines: Dict[str, AprilTagPipeline] = {}
+
+
+def _init_worker(settings: dict) -> None:
+    _worker_settings.update(settings)
+
+
+def _detect_in_worker(robot_name: str, data: bytes) -> Optional[list]:
+    pipeline = _worker_pipelines.get(robot_name)
+    if pipeline is None:
+        # Built once per robot and worker, the intrinsics are only read on the first frame
+        settings = _worker_settings
+        intrinsics = read_intrinsics(settings["intrinsics_pattern"].format(robot=robot_name))
+        pipeline = AprilTagPipeline(intrinsics['camera_matrix'], intrinsics['distortion_coefficients'],
+                                    settings["tag_size"], settings["valid_ids"][robot_name],
+                                    settings["detector_config"], settings["pose_candidates"])
+        _worker_pipelines[robot_name] = pipeline
+    result = pipeline.process(data)
+    if result.image is None:
+        return None
+    return result.posed_tags
+
+
+class RobotChannel:
+    # Latest frame, publishers, tag filters and latency statistics of one robot
+    robot_name: str
+    goal_tag_id: int
+    latest_image: Optional[CompressedImage]
+    latest_receive_time: float
+    last_dispatch_time: float
+    in_flight: bool
+    tag_filters: TagFilterBank
+    tag_pub: rospy.Publisher
+    tag_distance_pub: rospy.Publisher
+    image_sub: rospy.Subscriber
+    latencies: Deque[float]
+    processing_times: Deque[float]
+    processed_frames: int
+
+    def __init__(self, robot_name: str, goal_tag_id: int, window: int, tag_filters: TagFilterBank) -> None:
+        self.robot_name = robot_name
+        self.goal_tag_id = goal_tag_id
+        self.tag_filters = tag_filters
+        self.latest_image = None
+        self.latest_receive_time = 0.0
+        self.last_dispatch_time = 0.0
+        self.in_flight = False
+        self.latencies = deque(maxlen=window)
+        self.processing_times = deque(maxlen=window)
+        self.processed_frames = 0
+
+
+class AprilTagDetectionServer:
+    node_name: str
+    robots: List[str]
+    detection_rate: float
+    workers: int
+    tags: Dict[int, list]
+    channels: Dict[str, RobotChannel]
+    pool: multiprocessing.pool.Pool
+    condition: threading.Condition
+    in_flight: int
+    next_robot: int
+    dispatch_thread: threading.Thread
+    stop_dist: float
+    prediction_timer: rospy.Timer
+    metrics_pub: rospy.Publisher
+    metrics_timer: rospy.Timer
+
+    def __init__(self) -> None:
+        self.node_name = rospy.get_name()
+        rospy.loginfo(f"[{self.node_name}] Initializing {self.node_name} node...")
+
+        self.robots = rospy.get_param("~robots", None)
+        if not self.robots:
+            raise ValueError(f"[{self.node_name}] ~robots is not set")
+        if isinstance(self.robots, str):
+            self.robots = [robot.strip() for robot in self.robots.split(",") if robot.strip()]
+        rospy.loginfo(f"[{self.node_name}] Robots: {self.robots}")
+
+        # Maximum detection rate per robot, like the on-board node
+        self.detection_rate = float(rospy.get_param("~detection_rate", 5.0)) # Hz
+        self.workers = int(rospy.get_param("~workers", os.cpu_count() or 1))
+        rospy.loginfo(f"[{self.node_name}] Workers: {self.workers}, detection rate per robot: {self.detection_rate} Hz")
+
+        tag_size = rospy.get_param("~tag_size")
+        if tag_size is None:
+            raise ValueError(f"[{self.node_name}] ~tag_size is not set")
+
+        yaml_path = rospy.get_param("~map_yaml_path")
+        if yaml_path is None:
+            raise ValueError("~map_yaml_path is not set")
+        with open(yaml_path, "r") as file:
+            self.tags = yaml.safe_load(file)["tags"]
+
+        # Parallelism comes from the worker processes, one detector thread each by default
+        detector_config = default_detector_config()
+        detector_config["nthreads"] = 1
+        for key in detector_config:
+            detector_config[key] = rospy.get_param(f"~{key}", detector_config[key])
+
+        # Same tag filters as the node, the state machine waits for tag_distance
+        prediction_rate = float(rospy.get_param("~prediction_rate", 20.0)) # Hz
+        self.stop_dist = float(rospy.get_param("~stop_dist", 0.3)) # [m]
+        track_timeout = float(rospy.get_param("~track_timeout", 0.5))
+        accel_noise = float(rospy.get_param("~filter_accel_noise", 0.5))
+        meas_noise = float(rospy.get_param("~filter_meas_noise", 0.02))
+
+        metrics_window = int(rospy.get_param("~metrics_window", 100))
+        self.channels = {}
+        valid_ids = {}
+        for robot_name in self.robots:
+            goal_tag_id = int(rospy.get_param(f"/{robot_name}/goal_tag_id", -1))
+            self.channels[robot_name] = RobotChannel(robot_name, goal_tag_id, metrics_window,
+                                                     TagFilterBank(track_timeout, accel_noise, meas_noise))
+            valid_ids[robot_name] = set(self.tags.keys()) | {goal_tag_id}
+
+        settings = {
+            "intrinsics_pattern": rospy.get_param("~camera_intrinsics_yaml_pattern",
+                                                  "/data/config/calibrations/camera_intrinsic/{robot}.yaml"),
+            "tag_size": float(tag_size),
+            "valid_ids": valid_ids,
+            "detector_config": detector_config,
+            "pose_candidates": int(rospy.get_param("~pose_candidates", 2)),
+        }
+        # Spawn instead of fork, rospy already runs threads in this process
+        context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(self.workers, initializer=_init_worker, initargs=(settings,))
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.next_robot = 0
+
+        for channel in self.channels.values():
+            channel.tag_pub = rospy.Publisher(f"/{channel.robot_name}/apriltag_detection_node/tag_info", ApriltagMsg, queue_size=1)
+            channel.tag_distance_pub = rospy.Publisher(f"/{channel.robot_name}/apriltag_detection_node/tag_distance", ApriltagDistanceMsg, queue_size=1)
+            channel.image_sub = rospy.Subscriber(f"/{channel.robot_name}/camera_node/image/compressed", CompressedImage,
+                                                 self._image_cb, callback_args=channel, queue_size=1, buff_size=2**22)
+
+        self.prediction_timer = rospy.Timer(rospy.Duration(1 / prediction_rate), self._publish_predictions)
+        self.metrics_pub = rospy.Publisher(f"{self.node_name}/metrics", String, queue_size=1)
+        self.metrics_timer = rospy.Timer(rospy.Duration(float(rospy.get_param("~metrics_period", 5.0))), self._publish_metrics)
+
+        self.dispatch_thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self.dispatch_thread.start()
+        rospy.on_shutdown(self._shutdown)
+
+    def _image_cb(self, image_msg: CompressedImage, channel: RobotChannel) -> None:
+        with self.condition:
+            # Only the latest frame is kept, older ones are never dispatched
+            channel.latest_image = image_msg
+            channel.latest_receive_time = time.perf_counter()
+            self.condition.notify()
+
+    def _next_channel(self) -> Optional[RobotChannel]:
+        # Round robin over the robots, at most one frame per robot in flight keeps the results in order
+        now = time.perf_counter()
+        for offset in range(len(self.robots)):
+            channel = self.channels[self.robots[(self.next_robot + offset) % len(self.robots)]]
+            if channel.latest_image is None or channel.in_flight:
+                continue
+            if now - channel.last_dispatch_time < 1 / self.detection_rate:
+                continue
+            self.next_robot = (self.next_robot + offset + 1) % len(self.robots)
+            return channel
+        return None
+
+    def _dispatch_loop(self) -> None:
+        while not rospy.is_shutdown():
+            with self.condition:
+                channel = self._next_channel() if self.in_flight < self.workers else None
+                if channel is None:
+                    # Woken up by new frames and finished jobs, the timeout covers the rate limit
+                    self.condition.wait(timeout=0.01)
+                    continue
+                image_msg = channel.latest_image
+                receive_time = channel.latest_receive_time
+                capture_time = image_msg.header.stamp.to_sec() if not image_msg.header.stamp.is_zero() else rospy.get_time()
+                channel.latest_image = None
+                channel.in_flight = True
+                channel.last_dispatch_time = time.perf_counter()
+                self.in_flight += 1
+
+            self.pool.apply_async(_detect_in_worker, (channel.robot_name, bytes(image_msg.data)),
+                                  callback=partial(self._publish_result, channel, receive_time, channel.last_dispatch_time, capture_time),
+                                  error_callback=partial(self._handle_error, channel))
+
+    def _publish_result(self, channel: RobotChannel, receive_time: float, dispatch_time: float, capture_time: float,
+                        posed_tags: Optional[list]) -> None:
+        if posed_tags is None:
+            rospy.logerr(f"[{self.node_name}] Failed to decode image of {channel.robot_name}!")
+        else:
+            # Feed the filters with the capture time of the frame
+            for tag in posed_tags:
+                channel.tag_filters.update(tag.tag_id, tag.pose_t.reshape(3), capture_time)
+            tag_msgs = build_tag_msgs(posed_tags, rospy.Time.now(), f"/{channel.robot_name}/camera_frame",
+                                      self.tags, channel.goal_tag_id)
+            channel.tag_pub.publish(tag_msgs[0] if tag_msgs else no_tag_msg())
+
+        done_time = time.perf_counter()
+        with self.condition:
+            channel.latencies.append(done_time - receive_time)
+            channel.processing_times.append(done_time - dispatch_time)
+            channel.processed_frames += 1
+            self._finish(channel)
+
+    def _handle_error(self, channel: RobotChannel, error: BaseException) -> None:
+        rospy.logerr(f"[{self.node_name}] Detection for {channel.robot_name} failed: {error}")
+        with self.condition:
+            self._finish(channel)
+
+    def _finish(self, channel: RobotChannel) -> None:
+        # Called with the condition held
+        channel.in_flight = False
+        self.in_flight -= 1
+        self.condition.notify()
+
+    def _publish_predictions(self, event) -> None:
+        stamp = rospy.Time.now()
+        for channel in self.channels.values():
+            channel.tag_distance_pub.publish(build_distance_msg(channel.tag_filters, stamp, f"/{channel.robot_name}/camera_frame", self.stop_dist))
+
+    def _publish_metrics(self, event) -> None:
+        metrics = {}
+        with self.condition:
+            for channel in self.channels.values():
+                latencies = np.array(channel.latencies) * 1000
+                processing_times = np.array(channel.processing_times) * 1000
+                metrics[channel.robot_name] = {
+                    "processed_frames": channel.processed_frames,
+                    "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                    "latency_p90_ms": float(np.percentile(latencies, 90)) if len(latencies) else None,
+                    "processing_mean_ms": float(np.mean(processing_times)) if len(processing_times) else None,
+                }
+        self.metrics_pub.publish(String(data=json.dumps(metrics)))
+        rospy.logdebug(f"[{self.node_name}] Metrics: {metrics}")
+
+    def _shutdown(self) -> None:
+        self.pool.terminate()
+
+
+if __name__ == "__main__":
+    rospy.init_node("apriltag_detection_server")
+    server = AprilTagDetectionServer()
+    rospy.spin()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# ROS free AprilTag processing pipeline used by the detection node and the replay tool.
+# Stages: decode -> undistort -> grayscale -> detect -> select (pose of the closest valid tags) -> overlay
+import time
+import cv2
+import numpy as np
+from dt_apriltags import Detector
+from scipy.spatial.transform import Rotation as R
+from typing import Dict, List, Optional, Set
+
+from detector_config import build_detector
+
+STAGES = ["decode", "undistort", "grayscale", "detect", "select", "overlay"]
+
+
+def rotation_mats_to_quats(rot_mats: np.ndarray) -> np.ndarray:
+    # One scipy call for the whole batch, (N, 3, 3) -> (N, 4) as [x, y, z, w]
+    if rot_mats.ndim != 3 or rot_mats.shape[1:] != (3, 3):
+        raise ValueError("Rotation matrices must be of shape (N, 3, 3).")
+    if len(rot_mats) == 0:
+        return np.empty((0, 4))
+
+    return R.from_matrix(rot_mats).as_quat() # scalar last
+
+def tag_object_points(tag_size: float) -> np.ndarray:
+    # Tag corners in the tag frame, same order as the detector corners and as
+    # required by cv2.SOLVEPNP_IPPE_SQUARE
+    half = tag_size / 2
+    return np.array([[-half,  half, 0],
+                     [ half,  half, 0],
+                     [ half, -half, 0],
+                     [-half, -half, 0]], dtype=np.float64)
+
+def tag_apparent_size(corners: np.ndarray) -> float:
+    # Mean edge length in pixels, a cheap proxy for the inverse distance
+    return float(np.mean(np.linalg.norm(corners - np.roll(corners, 1, axis=0), axis=1)))
+
+
+class PipelineResult:
+    image: Optional[np.ndarray] # undistorted BGR image
+    tags: list # all decoded tags
+    posed_tags: list # valid tags with pose, closest first
+    stage_times: Dict[str, float] # seconds per stage
+
+    def __init__(self) -> None:
+        self.image = None
+        self.tags = []
+        self.posed_tags = []
+        self.stage_times = {}
+
+
+class AprilTagPipeline:
+    camera_matrix: np.ndarray
+    distortion_coefficients: np.ndarray
+    valid_ids: Set[int]
+    pose_candidates: int
+    tag_points: np.ndarray
+    detector: Detector
+
+    def __init__(self, camera_matrix: np.ndarray, distortion_coefficients: np.ndarray, tag_size: float,
+                 valid_ids: Set[int], detector_config: dict, pose_candidates: int = 2) -> None:
+        self.camera_matrix = camera_matrix
+        self.distortion_coefficients = distortion_coefficients
+        # Only tags on the map and the goal tag are relevant, everything else is never posed
+        self.valid_ids = set(valid_ids)
+        # Number of largest (= closest) valid tags per frame for which the pose is solved
+        self.pose_candidates = pose_candidates
+        self.tag_points = tag_object_points(tag_size)
+        self.detector = build_detector(detector_config)
+
+    def decode(self, data) -> Optional[np.ndarray]:
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+    def undistort(self, image: np.ndarray) -> np.ndarray:
+        return cv2.undistort(image, self.camera_matrix, self.distortion_coefficients)
+
+    def grayscale(self, image: np.ndarray) -> np.ndarray:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    def detect(self, gray: np.ndarray) -> list:
+        # Decode only, the pose is solved in select() for the relevant tags
+        return self.detector.detect(gray, estimate_tag_pose=False)
+
+    def _select_candidates(self, tags: list, max_tags: int) -> List:
+        # Keep one detection per valid id, largest first
+        candidates = {}
+        for tag in tags:
+            if tag.tag_id not in self.valid_ids:
+                continue # Not on the map
+            size = tag_apparent_size(tag.corners)
+            if tag.tag_id not in candidates or size > candidates[tag.tag_id][0]:
+                candidates[tag.tag_id] = (size, tag)
+        ranked = sorted(candidates.values(), key=lambda item: -item[0])
+        return [tag for _, tag in ranked[:max_tags]]
+
+    def _solve_pose(self, tag) -> bool:
+        # The image is already undistorted, so no distortion coefficients here
+        success, rvec, tvec = cv2.solvePnP(self.tag_points, tag.corners.astype(np.float64),
+                                           self.camera_matrix, None, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+        if not success:
+            return False
+        tag.pose_R, _ = cv2.Rodrigues(rvec)
+        tag.pose_t = tvec
+        return True
+
+    def select(self, tags: list, max_tags: Optional[int] = None) -> List:
+        # Returns the posed valid tags sorted by distance, closest first
+        if max_tags is None:
+            max_tags = self.pose_candidates
+        posed_tags = [tag for tag in self._select_candidates(tags, max_tags) if self._solve_pose(tag)]
+        # Euclidean distance of the tag from the camera origin
+        posed_tags.sort(key=lambda tag: np.linalg.norm(tag.pose_t))
+        return posed_tags
+
+    def process(self, data, max_tags: Optional[int] = None) -> PipelineResult:
+        # Runs all stages up to select on a JPEG buffer and times each of them
+        start = time.perf_counter()
+        image = self.decode(data)
+        decode_time = time.perf_counter() - start
+        if image is None:
+            result = PipelineResult()
+            result.stage_times["decode"] = decode_time
+            return result
+
+        result = self.process_image(image, max_tags)
+        result.stage_times["decode"] = decode_time
+        return result
+
+    def process_image(self, image: np.ndarray, max_tags: Optional[int] = None) -> PipelineResult:
+        # Same on an already decoded BGR image, e.g. a frame bus view, which is only read
+        result = PipelineResult()
+        start = time.perf_counter()
+        result.image = self.undistort(image)
+        undistorted = time.perf_counter()
+        gray = self.grayscale(result.image)
+        converted = time.perf_counter()
+        result.tags = self.detect(gray)
+        detected = time.perf_counter()
+        result.posed_tags = self.select(result.tags, max_tags)
+        selected = time.perf_counter()
+
+        result.stage_times["undistort"] = undistorted - start
+        result.stage_times["grayscale"] = converted - undistorted
+        result.stage_times["detect"] = detected - converted
+        result.stage_times["select"] = selected - detected
+        return result
+
+def draw_overlay(image: np.ndarray, tags: list, jpeg_quality: int) -> bytes:
+    # Draws (tag_id, corners) pairs onto the image in place and encodes it as JPEG
+    for tag_id, corners in tags:
+        # Ensure corners are in integer coordinates and draw lines between them
+        for idx in range(len(corners)):
+            start_point = tuple(corners[idx - 1, :].astype(int))
+            end_point = tuple(corners[idx, :].astype(int))
+            cv2.line(image, start_point, end_point, (0, 255, 0), 2)
+
+        # Put the tag id on the image
+        cv2.putText(image, str(tag_id),
+                    (int(corners[0, 0]), int(corners[0, 1])),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+
+    _, jpeg_image = cv2.imencode('.jpeg', image, [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality])
+    return jpeg_image.tobytes()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Offline autotuner for the dt_apriltags detector configuration.
+# Sweeps nthreads, quad_decimate and quad_sigma over a directory of recorded camera frames
+# and keeps the fastest configuration whose detection recall stays above a threshold.
+# The recall reference is the full resolution configuration (quad_decimate=1.0, quad_sigma=0.0).
+# Run it on the robot itself, the timings are only meaningful on the target CPU:
+# python3 autotune_detector.py --frames /data/logs/frames --intrinsics /data/config/calibrations/camera_intrinsic/$VEHICLE_NAME.yaml
+import argparse
+import glob
+import itertools
+import os
+import time
+from datetime import datetime
+from typing import List, Set, Tuple
+
+import cv2
+import numpy as np
+import yaml
+
+from detector_config import read_intrinsics, default_detector_config, detector_config_path, save_detector_config, build_detector
+
+
+def load_frames(frames_dir: str, intrinsics: dict, max_frames: int) -> List[np.ndarray]:
+    paths = sorted(glob.glob(os.path.join(frames_dir, "*.jpg")) + glob.glob(os.path.join(frames_dir, "*.jpeg")))
+    if max_frames > 0:
+        paths = paths[:max_frames]
+    if not paths:
+        raise ValueError(f"No JPEG frames found in {frames_dir}")
+
+    frames = []
+    for path in paths:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is None:
+            print(f"Skipping unreadable frame {path}")
+            continue
+        # Same preprocessing as the detection node
+        undistorted_image = cv2.undistort(image, intrinsics['camera_matrix'], intrinsics['distortion_coefficients'])
+        frames.append(cv2.cvtColor(undistorted_image, cv2.COLOR_BGR2GRAY))
+    return frames
+
+
+def run_config(config: dict, frames: List[np.ndarray], valid_ids: Set[int], repeat: int) -> Tuple[float, List[Set[int]]]:
+    detector = build_detector(config)
+    best_time = float('inf')
+    detections = []
+    for _ in range(repeat):
+        detections = []
+        start = time.perf_counter()
+        for gray in frames:
+            tags = detector.detect(gray, estimate_tag_pose=False)
+            detections.append({tag.tag_id for tag in tags if not valid_ids or tag.tag_id in valid_ids})
+        best_time = min(best_time, time.perf_counter() - start)
+    return best_time / len(frames), detections
+
+
+def recall(reference: List[Set[int]], detections: List[Set[int]]) -> float:
+    total = sum(len(ids) for ids in reference)
+    if total == 0:
+        return 1.0
+    return sum(len(ref & det) for ref, det in zip(reference, detections)) / total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Autotune the dt_apriltags detector on recorded frames.")
+    parser.add_argument("--frames", required=True, help="Directory with recorded JPEG camera frames")
+    parser.add_argument("--intrinsics", required=True, help="Camera intrinsics yaml of the robot")
+    parser.add_argument("--map", default=None, help="Map yaml, only its tags count for the recall if given")
+    parser.add_argument("--goal-tag-id", type=int, default=None, help="Goal tag id, counted as valid together with --map")
+    parser.add_argument("--output", default=None, help="Output yaml, defaults to calibrations/apriltag_detector/<robot>.yaml")
+    parser.add_argument("--min-recall", type=float, default=0.98, help="Minimum detection recall w.r.t. the reference")
+    parser.add_argument("--nthreads", type=int, nargs="+", default=None, help="Thread counts to sweep, default 1..cpu_count")
+    parser.add_argument("--quad-decimate", type=float, nargs="+", default=[1.0, 1.5, 2.0, 3.0])
+    parser.add_argument("--quad-sigma", type=float, nargs="+", default=[0.0, 0.4, 0.8])
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions per configuration, the best one counts")
+    parser.add_argument("--max-frames", type=int, default=0, help="Limit the number of frames, 0 uses all")
+    args = parser.parse_args()
+
+    intrinsics = read_intrinsics(args.intrinsics)
+    frames = load_frames(args.frames, intrinsics, args.max_frames)
+    print(f"Loaded {len(frames)} frames")
+
+    valid_ids = set()
+    if args.map is not None:
+        with open(args.map, "r") as file:
+            valid_ids = set(yaml.safe_load(file)["tags"].keys())
+        if args.goal_tag_id is not None:
+            valid_ids.add(args.goal_tag_id)
+
+    base_config = default_detector_config()
+    nthreads_list = args.nthreads or list(range(1, base_config["nthreads"] + 1))
+
+    _, reference = run_config(base_config, frames, valid_ids, 1)
+    print(f"Reference detections: {sum(len(ids) for ids in reference)}")
+
+    results = []
+    for nthreads, quad_decimate, quad_sigma in itertools.product(nthreads_list, args.quad_decimate, args.quad_sigma):
+        config = dict(base_config, nthreads=nthreads, quad_decimate=quad_decimate, quad_sigma=quad_sigma)
+        frame_time, detections = run_config(config, frames, valid_ids, args.repeat)
+        config_recall = recall(reference, detections)
+        results.append((frame_time, config_recall, config))
+        print(f"nthreads={nthreads} quad_decimate={quad_decimate} quad_sigma={quad_sigma}: "
+              f"{frame_time * 1000:.1f} ms/frame, recall {config_recall:.3f}")
+
+    accepted = [result for result in results if result[1] >= args.min_recall]
+    if not accepted:
+        raise RuntimeError(f"No configuration reaches a recall of {args.min_recall}")
+    frame_time, config_recall, config = min(accepted, key=lambda result: result[0])
+
+    output = args.output or detector_config_path(args.intrinsics)
+    info = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "frames": len(frames),
+        "ms_per_frame": round(frame_time * 1000, 2),
+        "recall": round(config_recall, 4),
+        "min_recall": args.min_recall,
+    }
+    save_detector_config(output, config, info)
+    print(f"Best: {config} ({frame_time * 1000:.1f} ms/frame, recall {config_recall:.3f})")
+    print(f"Saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
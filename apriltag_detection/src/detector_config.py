@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Helpers shared by the detection node and the autotuner:
+# camera intrinsics, dt_apriltags detector configuration and its per-robot persistence.
+import os
+import yaml
+import numpy as np
+from dt_apriltags import Detector
+
+# Parameters tuned per robot, everything else stays fixed
+TUNED_PARAMS = ["nthreads", "quad_decimate", "quad_sigma", "refine_edges", "decode_sharpening"]
+
+
+def read_intrinsics(yaml_path: str) -> dict:
+    with open(yaml_path, "r") as file:
+        data = yaml.safe_load(file)
+
+    # [fx, 0, cx, 0, fy, cy, 0, 0, 1]
+    camera_matrix = np.array(data['camera_matrix']['data']).reshape(
+        data['camera_matrix']['rows'], data['camera_matrix']['cols']
+    )
+    # [k1, k2, p1, p2, k3]
+    distortion_coefficients = np.array(data['distortion_coefficients']['data']).reshape(
+        data['distortion_coefficients']['rows'], data['distortion_coefficients']['cols']
+    )
+    # K * [R|t]
+    projection_matrix = np.array(data['projection_matrix']['data']).reshape(
+        data['projection_matrix']['rows'], data['projection_matrix']['cols']
+    )
+    return {
+        'camera_matrix': camera_matrix,
+        'distortion_coefficients': distortion_coefficients,
+        'projection_matrix': projection_matrix
+    }
+
+
+def default_detector_config() -> dict:
+    # Full resolution detection on every available core
+    return {
+        "nthreads": os.cpu_count() or 1,
+        "quad_decimate": 1.0,
+        "quad_sigma": 0.0,
+        "refine_edges": 1,
+        "decode_sharpening": 0.25,
+    }
+
+
+def detector_config_path(intrinsics_yaml_path: str) -> str:
+    # .../calibrations/camera_intrinsic/<robot>.yaml -> .../calibrations/apriltag_detector/<robot>.yaml
+    calib_dir, file_name = os.path.split(os.path.abspath(intrinsics_yaml_path))
+    return os.path.join(os.path.dirname(calib_dir), "apriltag_detector", file_name)
+
+
+def load_detector_config(yaml_path: str) -> dict:
+    # Returns only the tuned parameters, an empty dict if the robot was never tuned
+    if not yaml_path or not os.path.isfile(yaml_path):
+        return {}
+    with open(yaml_path, "r") as file:
+        data = yaml.safe_load(file) or {}
+    return {key: data[key] for key in TUNED_PARAMS if key in data}
+
+
+def save_detector_config(yaml_path: str, config: dict, info: dict = None) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(yaml_path)), exist_ok=True)
+    data = {key: config[key] for key in TUNED_PARAMS}
+    if info:
+        data["autotune"] = info
+    with open(yaml_path, "w") as file:
+        yaml.safe_dump(data, file, sort_keys=False)
+
+
+def build_detector(config: dict) -> Detector:
+    return Detector(searchpath=["apriltags"],
+                    families="tag36h11",
+                    nthreads=int(config["nthreads"]),
+                    quad_decimate=float(config["quad_decimate"]),
+                    quad_sigma=float(config["quad_sigma"]),
+                    refine_edges=int(config["refine_edges"]),
+                    decode_sharpening=float(config["decode_sharpening"]),
+                    debug=0)
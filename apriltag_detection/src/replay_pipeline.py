@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Headless replay of recorded camera frames through the AprilTag pipeline, no ROS needed.
+# Frames come from a directory of JPEGs or from an uncompressed tar archive of JPEGs,
+# which is memory-mapped so no frame is copied before decoding (tar cf frames.tar *.jpg).
+# Prints per-stage latency histograms, throughput and the detections as JSON:
+# python3 replay_pipeline.py --frames frames.tar --intrinsics [ROBOT_NAME].yaml --map ../../planner/config/map.yaml
+import argparse
+import glob
+import json
+import mmap
+import os
+import sys
+import tarfile
+import time
+from typing import Iterator, Tuple
+
+import numpy as np
+import yaml
+
+from apriltag_pipeline import AprilTagPipeline, STAGES, draw_overlay
+from detector_config import read_intrinsics, default_detector_config, load_detector_config
+
+# Histogram bin edges in milliseconds
+HISTOGRAM_EDGES_MS = [0, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')]
+
+
+def iter_frames(path: str) -> Iterator[Tuple[str, memoryview]]:
+    if os.path.isdir(path):
+        for frame_path in sorted(glob.glob(os.path.join(path, "*.jpg")) + glob.glob(os.path.join(path, "*.jpeg"))):
+            with open(frame_path, "rb") as file:
+                yield os.path.basename(frame_path), memoryview(file.read())
+        return
+
+    with open(path, "rb") as file, tarfile.open(fileobj=file, mode="r:") as archive:
+        members = sorted((member for member in archive.getmembers() if member.isfile()), key=lambda member: member.name)
+        # Not closed explicitly, the map is released once the last frame view is gone
+        view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        for member in members:
+            yield member.name, view[member.offset_data:member.offset_data + member.size]
+
+
+def stage_stats(times: list) -> dict:
+    times_ms = np.array(times) * 1000
+    counts, _ = np.histogram(times_ms, bins=HISTOGRAM_EDGES_MS)
+    return {
+        "count": len(times_ms),
+        "mean_ms": float(np.mean(times_ms)),
+        "p50_ms": float(np.percentile(times_ms, 50)),
+        "p90_ms": float(np.percentile(times_ms, 90)),
+        "p99_ms": float(np.percentile(times_ms, 99)),
+        "max_ms": float(np.max(times_ms)),
+        "histogram": {
+            "edges_ms": [edge if np.isfinite(edge) else None for edge in HISTOGRAM_EDGES_MS],
+            "counts": counts.tolist(),
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded frames through the AprilTag pipeline.")
+    parser.add_argument("--frames", required=True, help="Directory of JPEG frames or uncompressed tar archive of them")
+    parser.add_argument("--intrinsics", required=True, help="Camera intrinsics yaml")
+    parser.add_argument("--map", default=None, help="Map yaml with the valid tags, all tags are valid if omitted")
+    parser.add_argument("--goal-tag-id", type=int, default=-1)
+    parser.add_argument("--tag-size", type=float, default=0.12)
+    parser.add_argument("--detector-config", default=None, help="Autotuned detector yaml, defaults otherwise")
+    parser.add_argument("--pose-candidates", type=int, default=2)
+    parser.add_argument("--pose-all", action="store_true", help="Pose every valid tag, like with a tag_array subscriber")
+    parser.add_argument("--overlay", action="store_true", help="Also time the overlay rendering and encoding")
+    parser.add_argument("--overlay-jpeg-quality", type=int, default=75)
+    parser.add_argument("--output", default=None, help="JSON output file, stdout if omitted")
+    args = parser.parse_args()
+
+    intrinsics = read_intrinsics(args.intrinsics)
+    if args.map is not None:
+        with open(args.map, "r") as file:
+            valid_ids = set(yaml.safe_load(file)["tags"].keys()) | {args.goal_tag_id}
+    else:
+        valid_ids = set(range(587)) # every tag36h11 id
+    detector_config = default_detector_config()
+    detector_config.update(load_detector_config(args.detector_config))
+
+    pipeline = AprilTagPipeline(intrinsics['camera_matrix'], intrinsics['distortion_coefficients'], args.tag_size,
+                                valid_ids, detector_config, args.pose_candidates)
+    max_tags = len(valid_ids) if args.pose_all else None
+
+    stage_times = {stage: [] for stage in STAGES}
+    total_times = []
+    detections = []
+    start = time.perf_counter()
+    for name, data in iter_frames(args.frames):
+        result = pipeline.process(data, max_tags)
+        if result.image is None:
+            print(f"Skipping undecodable frame {name}", file=sys.stderr)
+            continue
+        if args.overlay:
+            overlay_start = time.perf_counter()
+            draw_overlay(result.image, [(tag.tag_id, tag.corners) for tag in result.tags], args.overlay_jpeg_quality)
+            result.stage_times["overlay"] = time.perf_counter() - overlay_start
+
+        for stage, stage_time in result.stage_times.items():
+            stage_times[stage].append(stage_time)
+        total_times.append(sum(result.stage_times.values()))
+        detections.append({
+            "frame": name,
+            "detected_ids": [int(tag.tag_id) for tag in result.tags],
+            "tags": [{"tag_id": int(tag.tag_id), "position": tag.pose_t.reshape(3).tolist()} for tag in result.posed_tags],
+        })
+    wall_time = time.perf_counter() - start
+
+    if not total_times:
+        raise ValueError(f"No frames found in {args.frames}")
+
+    report = {
+        "frames": len(total_times),
+        "wall_time_s": wall_time,
+        "throughput_fps": len(total_times) / wall_time,
+        "detector_config": detector_config,
+        "stages": {stage: stage_stats(times) for stage, times in stage_times.items() if times},
+        "total": stage_stats(total_times),
+        "detections": detections,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Constant velocity Kalman filters over the tag position in the camera frame.
+# Detection runs at a low rate, the filters predict the tag position in between.
+import threading
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+
+class TagPoseFilter:
+    # State [x, y, z, vx, vy, vz], measurement [x, y, z]
+    state: np.ndarray
+    covariance: np.ndarray
+    accel_noise: float
+    meas_noise: float
+    last_update_time: float
+    state_time: float
+
+    def __init__(self, position: np.ndarray, stamp: float, accel_noise: float, meas_noise: float) -> None:
+        self.accel_noise = accel_noise
+        self.meas_noise = meas_noise
+        self.state = np.zeros(6)
+        self.state[:3] = position
+        # Unknown velocity at the first detection
+        self.covariance = np.diag([meas_noise**2] * 3 + [1.0] * 3)
+        self.last_update_time = stamp
+        self.state_time = stamp
+
+    @staticmethod
+    def _transition(dt: float) -> np.ndarray:
+        transition = np.eye(6)
+        transition[:3, 3:] = dt * np.eye(3)
+        return transition
+
+    def _process_noise(self, dt: float) -> np.ndarray:
+        # White acceleration noise model
+        q = self.accel_noise**2
+        noise = np.zeros((6, 6))
+        noise[:3, :3] = q * dt**4 / 4 * np.eye(3)
+        noise[:3, 3:] = noise[3:, :3] = q * dt**3 / 2 * np.eye(3)
+        noise[3:, 3:] = q * dt**2 * np.eye(3)
+        return noise
+
+    def update(self, position: np.ndarray, stamp: float) -> None:
+        dt = max(stamp - self.state_time, 0.0)
+        transition = self._transition(dt)
+        state = transition @ self.state
+        covariance = transition @ self.covariance @ transition.T + self._process_noise(dt)
+
+        innovation = position - state[:3]
+        innovation_cov = covariance[:3, :3] + self.meas_noise**2 * np.eye(3)
+        gain = covariance[:, :3] @ np.linalg.inv(innovation_cov)
+        self.state = state + gain @ innovation
+        self.covariance = covariance - gain @ covariance[:3, :]
+        self.state_time = stamp
+        self.last_update_time = stamp
+
+    def predict(self, stamp: float) -> Tuple[np.ndarray, np.ndarray]:
+        # Position and velocity at the given time, the filter state is not changed
+        dt = max(stamp - self.state_time, 0.0)
+        return self.state[:3] + dt * self.state[3:], self.state[3:].copy()
+
+
+class TagFilterBank:
+    # One filter per tag id, tracks without detections for track_timeout seconds are dropped
+    filters: Dict[int, TagPoseFilter]
+    track_timeout: float
+    accel_noise: float
+    meas_noise: float
+    lock: threading.Lock
+
+    def __init__(self, track_timeout: float, accel_noise: float, meas_noise: float) -> None:
+        self.filters = {}
+        self.track_timeout = track_timeout
+        self.accel_noise = accel_noise
+        self.meas_noise = meas_noise
+        self.lock = threading.Lock()
+
+    def update(self, tag_id: int, position: np.ndarray, stamp: float) -> None:
+        with self.lock:
+            tag_filter = self.filters.get(tag_id)
+            if tag_filter is None or stamp - tag_filter.last_update_time > self.track_timeout:
+                self.filters[tag_id] = TagPoseFilter(position, stamp, self.accel_noise, self.meas_noise)
+            else:
+                tag_filter.update(position, stamp)
+
+    def closest(self, stamp: float) -> Optional[Tuple[int, np.ndarray, np.ndarray]]:
+        # (tag_id, position, velocity) of the tag with the smallest predicted Euclidean distance,
+        # the same choice as the closest tag on tag_info
+        with self.lock:
+            for tag_id in [tag_id for tag_id, tag_filter in self.filters.items()
+                           if stamp - tag_filter.last_update_time > self.track_timeout]:
+                del self.filters[tag_id]
+            predictions = [(tag_id,) + tag_filter.predict(stamp) for tag_id, tag_filter in self.filters.items()]
+        if not predictions:
+            return None
+        return min(predictions, key=lambda prediction: np.linalg.norm(prediction[1]))
+
+
+def time_to_distance(distance: float, velocity: float, target_distance: float) -> float:
+    # Time until target_distance is reached at the current velocity, -1 if not approaching
+    if distance <= target_distance:
+        return 0.0
+    if velocity >= 0:
+        return -1.0
+    return (distance - target_distance) / -velocity
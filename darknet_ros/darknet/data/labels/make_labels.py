@@ -1,23 +1,45 @@
+import argparse
+import multiprocessing
 import os
 import string
-import pipes
 
+from PIL import Image, ImageDraw, ImageFont
+
+# A font file, or a name Pillow finds in the system font directories (futura-normal.ttf)
 font = 'futura-normal'
+sizes = [12,24,36,48,60,72,84,96]
+
+def make_labels(task):
+    # One <ord>_<size index>.png per printable character, black on white like ImageMagick's label:
+    font_path, s, out = task
+    f = ImageFont.truetype(font_path, s)
+    ascent, descent = f.getmetrics()
+    height = ascent + descent
+    for word in string.printable:
+        if ord(word) in [9,10,11,12,13,14]:
+            continue
+        width = max(int(round(f.getlength(word))), 1)
+        im = Image.new('L', (width, height), 255)
+        ImageDraw.Draw(im).text((0, 0), word, fill=0, font=f)
+        im.save(os.path.join(out, '%d_%d.png'%(ord(word), s//12-1)))
+    return s
 
-def make_labels(s):
-    l = string.printable
-    for word in l:
-        if word == ' ':
-            os.system('convert -fill black -background white -bordercolor white -font %s -pointsize %d label:"\ " 32_%d.png'%(font,s,s/12-1))
-        if word == '@':
-            os.system('convert -fill black -background white -bordercolor white -font %s -pointsize %d label:"\@" 64_%d.png'%(font,s,s/12-1))
-        elif word == '\\':
-            os.system('convert -fill black -background white -bordercolor white -font %s -pointsize %d label:"\\\\\\\\" 92_%d.png'%(font,s,s/12-1))
-        elif ord(word) in [9,10,11,12,13,14]:
-            pass
-        else:
-            os.system("convert -fill black -background white -bordercolor white -font %s -pointsize %d label:%s \"%d_%d.png\""%(font,s,pipes.quote(word), ord(word),s/12-1))
+def main():
+    parser = argparse.ArgumentParser(description='Render the label glyphs darknet draws on the detections.')
+    parser.add_argument('--font', default=font)
+    parser.add_argument('--out', default='.')
+    parser.add_argument('--workers', type=int, default=min(len(sizes), multiprocessing.cpu_count()))
+    args = parser.parse_args()
 
-for i in [12,24,36,48,60,72,84,96]:
-    make_labels(i)
+    # Fails here instead of in every worker if the font is missing
+    ImageFont.truetype(args.font, sizes[0])
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for s in pool.imap_unordered(make_labels, [(args.font, s, args.out) for s in sizes]):
+            print('%d pt done' % s)
+    finally:
+        pool.close()
+        pool.join()
 
+if __name__ == '__main__':
+    main()
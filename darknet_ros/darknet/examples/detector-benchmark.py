@@ -0,0 +1,79 @@
+# Images per second of the darknet python API on a directory or list of images:
+# python3 examples/detector-benchmark.py cfg/yolov3-tiny.cfg yolov3-tiny.weights cfg/coco.data /data/duckietown/frames --workers 1 2 4 8
+# Classification networks also get the batch sizes, capped at the batch= of the cfg:
+# python3 examples/detector-benchmark.py cfg/tiny.cfg tiny.weights cfg/imagenet1k.data images.txt --classify --batch 1 4 16
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.getcwd(),'python/'))
+
+import darknet as dn
+
+def list_images(source):
+    if os.path.isdir(source):
+        return sorted(p for p in glob.glob(os.path.join(source, '*')) if p.lower().endswith(('.jpg', '.jpeg', '.png')))
+    with open(source) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def classify_path(net, meta, path):
+    im = dn.load_image(path)
+    res = dn.classify(net, meta, im)
+    dn.free_image(im)
+    return res
+
+def run(name, n, results):
+    start = time.time()
+    count = sum(1 for _ in results)
+    elapsed = time.time() - start
+    print('%-28s %6d images %8.2f s %8.1f images/s' % (name, count, elapsed, n / elapsed))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the darknet python API.')
+    parser.add_argument('cfg')
+    parser.add_argument('weights')
+    parser.add_argument('data')
+    parser.add_argument('images', help='Directory of images or a list file like train.txt')
+    parser.add_argument('--classify', action='store_true', help='Classification network, also benchmarks the batch sizes')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--chunk', type=int, default=4, help='Images per task of the process pool')
+    parser.add_argument('--thresh', type=float, default=.5)
+    parser.add_argument('--limit', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = list_images(args.images)
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        raise ValueError('No images in %s' % args.images)
+    n = len(paths)
+    print('%d images, %d cores' % (n, os.cpu_count()))
+
+    kwargs = {} if args.classify else {'thresh': args.thresh}
+    with dn.Network(args.cfg, args.weights, args.data) as net:
+        # Warm up
+        net.classify(paths[0]) if args.classify else net.detect(paths[0], **kwargs)
+        if args.classify:
+            run('classify', n, (classify_path(net.net, net.meta, p) for p in paths))
+            for batch in args.batch:
+                if batch > net.max_batch:
+                    print('Network batch %d skipped, the cfg has batch=%d' % (batch, net.max_batch))
+                    continue
+                run('Network batch %d' % batch, n, net.classify_many(paths, batch=batch))
+        else:
+            run('detect', n, (dn.detect(net.net, net.meta, p, **kwargs) for p in paths))
+            run('Network.detect_many', n, net.detect_many(paths, **kwargs))
+
+    for workers in args.workers:
+        with dn.NetworkPool(args.cfg, args.weights, args.data, workers=workers, chunk=args.chunk) as pool:
+            # Loading the networks is not timed
+            list(pool.classify_many(paths[:workers]) if args.classify else pool.detect_many(paths[:workers], **kwargs))
+            results = pool.classify_many(paths) if args.classify else pool.detect_many(paths, **kwargs)
+            run('NetworkPool %d workers' % workers, n, results)
+
+if __name__ == '__main__':
+    main()
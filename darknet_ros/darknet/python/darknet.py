@@ -1,7 +1,11 @@
 from ctypes import *
 import math
+import multiprocessing
+import os
 import random
 
+import numpy as np
+
 def sample(probs):
     s = sum(probs)
     probs = [a/s for a in probs]
@@ -45,7 +49,8 @@ class METADATA(Structure):
     
 
 #lib = CDLL("/home/pjreddie/documents/darknet/libdarknet.so", RTLD_GLOBAL)
-lib = CDLL("libdarknet.so", RTLD_GLOBAL)
+# DARKNET_LIB=/path/to/libdarknet.so if the library is not on the loader path
+lib = CDLL(os.environ.get("DARKNET_LIB", "libdarknet.so"), RTLD_GLOBAL)
 lib.network_width.argtypes = [c_void_p]
 lib.network_width.restype = c_int
 lib.network_height.argtypes = [c_void_p]
@@ -82,9 +87,12 @@ network_predict.argtypes = [c_void_p, POINTER(c_float)]
 reset_rnn = lib.reset_rnn
 reset_rnn.argtypes = [c_void_p]
 
-load_net = lib.load_network
-load_net.argtypes = [c_char_p, c_char_p, c_int]
-load_net.restype = c_void_p
+reset_network_state = lib.reset_network_state
+reset_network_state.argtypes = [c_void_p, c_int]
+
+load_network = lib.load_network
+load_network.argtypes = [c_char_p, c_char_p, c_int]
+load_network.restype = c_void_p
 
 do_nms_obj = lib.do_nms_obj
 do_nms_obj.argtypes = [POINTER(DETECTION), c_int, c_int, c_float]
@@ -99,13 +107,16 @@ letterbox_image = lib.letterbox_image
 letterbox_image.argtypes = [IMAGE, c_int, c_int]
 letterbox_image.restype = IMAGE
 
-load_meta = lib.get_metadata
+letterbox_image_into = lib.letterbox_image_into
+letterbox_image_into.argtypes = [IMAGE, c_int, c_int, IMAGE]
+
+get_metadata = lib.get_metadata
 lib.get_metadata.argtypes = [c_char_p]
 lib.get_metadata.restype = METADATA
 
-load_image = lib.load_image_color
-load_image.argtypes = [c_char_p, c_int, c_int]
-load_image.restype = IMAGE
+load_image_color = lib.load_image_color
+load_image_color.argtypes = [c_char_p, c_int, c_int]
+load_image_color.restype = IMAGE
 
 rgbgr_image = lib.rgbgr_image
 rgbgr_image.argtypes = [IMAGE]
@@ -114,43 +125,434 @@ predict_image = lib.network_predict_image
 predict_image.argtypes = [c_void_p, IMAGE]
 predict_image.restype = POINTER(c_float)
 
-def classify(net, meta, im):
-    out = predict_image(net, im)
-    res = []
-    for i in range(meta.classes):
-        res.append((meta.names[i], out[i]))
-    res = sorted(res, key=lambda x: -x[1])
-    return res
+set_batch_network = lib.set_batch_network
+set_batch_network.argtypes = [c_void_p, c_int]
 
-def detect(net, meta, image, thresh=.5, hier_thresh=.5, nms=.45):
-    im = load_image(image, 0, 0)
+num_detections = lib.num_detections
+num_detections.argtypes = [c_void_p, c_float]
+num_detections.restype = c_int
+
+fill_network_boxes = lib.fill_network_boxes
+fill_network_boxes.argtypes = [c_void_p, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, POINTER(DETECTION)]
+
+make_network_boxes_n = lib.make_network_boxes
+make_network_boxes_n.argtypes = [c_void_p, c_float, POINTER(c_int)]
+make_network_boxes_n.restype = POINTER(DETECTION)
+
+free_network = lib.free_network
+free_network.argtypes = [c_void_p]
+
+def _c_str(s):
+    # ctypes wants bytes for char *, paths may be given as str
+    return s.encode() if isinstance(s, str) else s
+
+def load_net(cfg, weights, clear=0):
+    return load_network(_c_str(cfg), _c_str(weights), clear)
+
+def load_meta(data):
+    return get_metadata(_c_str(data))
+
+def load_image(path, w=0, h=0):
+    return load_image_color(_c_str(path), w, h)
+
+class ImageBuffer(object):
+    # Reusable float32 CHW buffer wrapped as an IMAGE. fill() writes a HWC uint8 frame into it with
+    # vectorized operations, darknet reads the NumPy memory directly, so the IMAGE must not be freed.
+    def __init__(self):
+        self.array = None
+        self.image = None
+
+    def fill(self, arr, bgr=False):
+        if arr.ndim == 2:
+            arr = arr[:, :, None]
+        h, w, c = arr.shape
+        if self.array is None or self.array.shape != (c, h, w):
+            self.array = np.empty((c, h, w), np.float32)
+            self.image = IMAGE(w, h, c, self.array.ctypes.data_as(POINTER(c_float)))
+        if bgr:
+            arr = arr[:, :, ::-1]
+        # Normalization and HWC -> CHW in one pass
+        np.multiply(arr.transpose(2, 0, 1), np.float32(1 / 255.), out=self.array)
+        return self.image
+
+_image_buffer = ImageBuffer()
+
+def array_to_image(arr, bgr=False, buf=None):
+    # HWC uint8 RGB (or BGR with bgr=True) frame -> IMAGE backed by a reused buffer, valid until the next call
+    return (buf or _image_buffer).fill(arr, bgr)
+
+# NumPy view of a detection array, the pointers as integers. The layout mirrors DETECTION.
+_DETECTION_VIEW = np.dtype({
+    "names": ["bbox", "prob", "objectness"],
+    "formats": [(np.float32, 4), np.uintp, np.float32],
+    "offsets": [DETECTION.bbox.offset, DETECTION.prob.offset, DETECTION.objectness.offset],
+    "itemsize": sizeof(DETECTION)})
+
+# One row per detection and class, boxes (x, y, w, h) in pixels of the image
+DETECTION_DTYPE = np.dtype([("class_id", np.int32), ("prob", np.float32),
+                            ("x", np.float32), ("y", np.float32), ("w", np.float32), ("h", np.float32)])
+CLASSIFICATION_DTYPE = np.dtype([("class_id", np.int32), ("prob", np.float32)])
+
+_class_names = {}
+
+def class_names(meta):
+    # Decoded class names of the metadata, read once
+    key = cast(meta.names, c_void_p).value
+    if key not in _class_names:
+        _class_names[key] = [meta.names[i].decode() for i in range(meta.classes)]
+    return _class_names[key]
+
+def _top_k(prob, top_k):
+    # Indices of the top_k largest probabilities, highest first
+    if top_k is not None and top_k < len(prob):
+        order = np.argpartition(-prob, top_k)[:top_k]
+        return order[np.argsort(-prob[order], kind="stable")]
+    return np.argsort(-prob, kind="stable")
+
+def _detection_view(dets, num):
+    # Writable NumPy view of the first num detections of a detection array
+    return np.ctypeslib.as_array(cast(dets, POINTER(c_uint8)), shape=(num * sizeof(DETECTION),)).view(_DETECTION_VIEW)
+
+def _bind_probs(dets, num, classes):
+    # Points the probability array of every detection into one (num, classes) block, so darknet writes all
+    # probabilities into a single NumPy array. Returns the block and darknet's own arrays, which have to be
+    # put back with _unbind_probs before free_detections.
+    view = _detection_view(dets, num)
+    probs = np.zeros((num, classes), np.float32)
+    own = view["prob"].copy()
+    view["prob"] = probs.ctypes.data + np.arange(num, dtype=np.uintp) * np.uintp(probs.strides[0])
+    return probs, own
+
+def _unbind_probs(dets, own):
+    _detection_view(dets, len(own))["prob"] = own
+
+def _detections_to_array(dets, num, probs, top_k=None):
+    # probs is the block bound by _bind_probs. NMS sorts the detections, so the block row of every detection
+    # is recovered from its pointer, no Python work but per kept box.
+    if num == 0:
+        return np.empty(0, DETECTION_DTYPE)
+    view = _detection_view(dets, num)
+    order = (view["prob"] - np.uintp(probs.ctypes.data)) // np.uintp(probs.strides[0])
+    probs = probs[order.astype(np.intp)]
+
+    rows, class_ids = np.nonzero(probs > 0)
+    res = np.empty(len(rows), DETECTION_DTYPE)
+    res["class_id"] = class_ids
+    res["prob"] = probs[rows, class_ids]
+    boxes = view["bbox"][rows]
+    res["x"], res["y"], res["w"], res["h"] = boxes.T
+    return res[_top_k(res["prob"], top_k)]
+
+def _to_tuples(meta, res):
+    # Structured detections or classifications -> the list of tuples of the original API
+    names = class_names(meta)
+    if res.dtype == CLASSIFICATION_DTYPE:
+        return [(names[i], p) for i, p in zip(res["class_id"].tolist(), res["prob"].tolist())]
+    return [(names[i], p, (x, y, w, h)) for i, p, x, y, w, h in
+            zip(*(res[field].tolist() for field in DETECTION_DTYPE.names))]
+
+def _get_detections(net, meta, im, thresh, hier_thresh, nms, top_k=None):
     num = c_int(0)
     pnum = pointer(num)
     predict_image(net, im)
-    dets = get_network_boxes(net, im.w, im.h, thresh, hier_thresh, None, 0, pnum)
+    # get_network_boxes split up, so the probabilities are written into one NumPy block
+    dets = make_network_boxes_n(net, thresh, pnum)
     num = pnum[0]
+    probs, own = _bind_probs(dets, num, meta.classes)
+    fill_network_boxes(net, im.w, im.h, thresh, hier_thresh, None, 0, dets)
     if (nms): do_nms_obj(dets, num, meta.classes, nms);
 
-    res = []
-    for j in range(num):
-        for i in range(meta.classes):
-            if dets[j].prob[i] > 0:
-                b = dets[j].bbox
-                res.append((meta.names[i], dets[j].prob[i], (b.x, b.y, b.w, b.h)))
-    res = sorted(res, key=lambda x: -x[1])
-    free_image(im)
+    res = _detections_to_array(dets, num, probs, top_k)
+    _unbind_probs(dets, own)
     free_detections(dets, num)
     return res
-    
+
+def classify(net, meta, im, top_k=None, structured=False):
+    out = predict_image(net, im)
+    prob = np.ctypeslib.as_array(out, shape=(meta.classes,))
+    order = _top_k(prob, top_k)
+    res = np.empty(len(order), CLASSIFICATION_DTYPE)
+    res["class_id"] = order
+    res["prob"] = prob[order]
+    return res if structured else _to_tuples(meta, res)
+
+def detect(net, meta, image, thresh=.5, hier_thresh=.5, nms=.45, top_k=None, structured=False):
+    # structured=True returns a DETECTION_DTYPE array instead of (name, prob, (x, y, w, h)) tuples
+    im = load_image(image, 0, 0)
+    res = _get_detections(net, meta, im, thresh, hier_thresh, nms, top_k)
+    free_image(im)
+    return res if structured else _to_tuples(meta, res)
+
+def detect_array(net, meta, arr, thresh=.5, hier_thresh=.5, nms=.45, bgr=False, buf=None, top_k=None, structured=False):
+    # Same as detect for an in-memory HWC uint8 frame, e.g. from cv2.imread with bgr=True.
+    # Boxes are (x, y, w, h) in pixels of the frame.
+    im = array_to_image(arr, bgr, buf)
+    res = _get_detections(net, meta, im, thresh, hier_thresh, nms, top_k)
+    return res if structured else _to_tuples(meta, res)
+
+class Network(object):
+    # A network with its metadata and all per frame buffers, allocated once:
+    # the letterboxed input images, the resize buffers per frame size and the detection array.
+    # Frames are HWC uint8 arrays or image paths, which darknet loads itself.
+    #
+    #     with Network("cfg/yolov3-tiny.cfg", "yolov3-tiny.weights", "cfg/coco.data") as net:
+    #         for dets in net.detect_many(frames, bgr=True):
+    #             ...
+    def __init__(self, cfg, weights, data, clear=0):
+        self.net = load_net(cfg, weights, clear)
+        self.meta = load_meta(data)
+        self.names = class_names(self.meta)
+        self.width = lib.network_width(self.net)
+        self.height = lib.network_height(self.net)
+        # Batch of the cfg, the layer outputs and workspaces are allocated for it when parsing, and
+        # set_batch_network does not reallocate them, so larger batches would overflow them
+        self.max_batch = cast(self.net, POINTER(c_int))[1]
+        self.batch = 0
+        self._frame_shape = None
+        self._set_batch(1)
+        self._dets = None
+        self._capacity = 0
+        self._probs = None
+        self._own_probs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._dets is not None:
+            _unbind_probs(self._dets, self._own_probs)
+            free_detections(self._dets, self._capacity)
+            self._dets = None
+        if self.net is not None:
+            free_network(self.net)
+            self.net = None
+
+    def _set_batch(self, n):
+        # One letterboxed input per batch item, contiguous as the network expects them
+        if n == self.batch:
+            return
+        if n > self.max_batch:
+            raise ValueError("batch %d needs a cfg with batch >= %d, it has batch=%d" % (n, n, self.max_batch))
+        set_batch_network(self.net, n)
+        self.inputs = np.full((n, 3, self.height, self.width), .5, np.float32)
+        self.input = self.inputs[0]
+        self._input_ptr = self.inputs.ctypes.data_as(POINTER(c_float))
+        # Frame size each batch item was padded for
+        self._padded = [None] * n
+        self.batch = n
+
+    def _prepare(self, h, w):
+        # Index and weight arrays of darknet's letterbox_image (bilinear resize_image, 0.5 padding) for a frame size
+        if np.float32(self.width) / np.float32(w) < np.float32(self.height) / np.float32(h):
+            new_w, new_h = self.width, (h * self.width) // w
+        else:
+            new_w, new_h = (w * self.height) // h, self.height
+        self._x0, self._y0 = (self.width - new_w) // 2, (self.height - new_h) // 2
+        self._new_w, self._new_h = new_w, new_h
+
+        def taps(n_in, n_out):
+            scale = np.float32(n_in - 1) / np.float32(n_out - 1) if n_out > 1 else np.float32(0)
+            s = np.arange(n_out, dtype=np.float32) * scale
+            i0 = s.astype(np.intp)
+            d = s - i0.astype(np.float32)
+            i1 = np.minimum(i0 + 1, n_in - 1)
+            return i0, i1, d
+
+        # Columns: the last one is the last source pixel
+        self._ix0, self._ix1, dx = taps(w, new_w)
+        self._ix0[-1] = self._ix1[-1] = w - 1
+        dx[-1] = 0
+        self._wx0, self._wx1 = (1 - dx)[None, :, None], dx[None, :, None]
+        # Rows: the last one only gets the (1 - dy) term
+        self._iy0, self._iy1, dy = taps(h, new_h)
+        self._wy0, self._wy1 = (1 - dy)[:, None, None], dy[:, None, None]
+        self._wy1[-1] = 0
+        if h == 1:
+            self._wy1[:] = 0
+
+        self._src = np.empty((h, w, 3), np.float32)
+        self._part0 = np.empty((h, new_w, 3), np.float32)
+        self._part1 = np.empty((h, new_w, 3), np.float32)
+        self._rows0 = np.empty((new_h, new_w, 3), np.float32)
+        self._rows1 = np.empty((new_h, new_w, 3), np.float32)
+        self._frame_shape = (h, w)
+
+    def letterbox(self, arr, bgr=False, slot=0):
+        # HWC uint8 frame -> the network input of a batch item, resized like darknet does it
+        h, w = arr.shape[:2]
+        if (h, w) != self._frame_shape:
+            self._prepare(h, w)
+        if (h, w) != self._padded[slot]:
+            self.inputs[slot] = .5
+            self._padded[slot] = (h, w)
+        if arr.ndim == 2:
+            arr = arr[:, :, None]
+        elif bgr:
+            arr = arr[:, :, ::-1]
+        np.divide(arr, np.float32(255), out=self._src)
+        np.take(self._src, self._ix0, axis=1, out=self._part0)
+        np.take(self._src, self._ix1, axis=1, out=self._part1)
+        self._part0 *= self._wx0
+        self._part1 *= self._wx1
+        self._part0 += self._part1
+        np.take(self._part0, self._iy0, axis=0, out=self._rows0)
+        np.take(self._part0, self._iy1, axis=0, out=self._rows1)
+        self._rows0 *= self._wy0
+        self._rows1 *= self._wy1
+        self._rows0 += self._rows1
+        self.inputs[slot, :, self._y0:self._y0 + self._new_h, self._x0:self._x0 + self._new_w] = self._rows0.transpose(2, 0, 1)
+        return self.inputs[slot]
+
+    def _load(self, frame, bgr, slot):
+        # Letterboxes an array or an image file into a batch item, returns the frame size (w, h)
+        if not isinstance(frame, (str, bytes)):
+            self.letterbox(frame, bgr, slot)
+            return frame.shape[1], frame.shape[0]
+        im = load_image(frame, 0, 0)
+        self.inputs[slot] = .5
+        boxed = IMAGE(self.width, self.height, 3, self.inputs[slot].ctypes.data_as(POINTER(c_float)))
+        letterbox_image_into(im, self.width, self.height, boxed)
+        free_image(im)
+        self._padded[slot] = None
+        return im.w, im.h
+
+    def predict(self, frame, bgr=False):
+        # Raw network output, a pointer into the network valid until the next call
+        self._set_batch(1)
+        self._load(frame, bgr, 0)
+        return network_predict(self.net, self._input_ptr)
+
+    def _detections(self):
+        # The detection array holds every box of the network, so it never has to grow
+        if self._dets is None:
+            capacity = c_int(0)
+            self._dets = make_network_boxes_n(self.net, -1, pointer(capacity))
+            self._capacity = capacity.value
+            self._probs, self._own_probs = _bind_probs(self._dets, self._capacity, self.meta.classes)
+        return self._dets
+
+    def detect(self, frame, thresh=.5, hier_thresh=.5, nms=.45, bgr=False, top_k=None):
+        # Frame -> DETECTION_DTYPE array, boxes (x, y, w, h) in pixels of the frame.
+        # darknet only decodes the boxes of the first batch item, so detection always runs with batch 1.
+        self._set_batch(1)
+        w, h = self._load(frame, bgr, 0)
+        network_predict(self.net, self._input_ptr)
+        dets = self._detections()
+        num = min(num_detections(self.net, thresh), self._capacity)
+        fill_network_boxes(self.net, w, h, thresh, hier_thresh, None, 0, dets)
+        if (nms): do_nms_obj(dets, num, self.meta.classes, nms);
+        return _detections_to_array(dets, num, self._probs, top_k)
+
+    def detect_many(self, frames, **kwargs):
+        # Detections of every frame of an iterable, all buffers are shared between the frames
+        for arr in frames:
+            yield self.detect(arr, **kwargs)
+
+    def _classifications(self, prob, top_k):
+        order = _top_k(prob, top_k)
+        res = np.empty(len(order), CLASSIFICATION_DTYPE)
+        res["class_id"] = order
+        res["prob"] = prob[order]
+        return res
+
+    def classify(self, frame, bgr=False, top_k=None):
+        prob = np.ctypeslib.as_array(self.predict(frame, bgr), shape=(self.meta.classes,))
+        return self._classifications(prob, top_k)
+
+    def classify_batch(self, frames, bgr=False, top_k=None):
+        # One forward pass for all frames, a list of CLASSIFICATION_DTYPE arrays in the same order
+        frames = list(frames)
+        self._set_batch(len(frames))
+        for slot, frame in enumerate(frames):
+            self._load(frame, bgr, slot)
+        out = network_predict(self.net, self._input_ptr)
+        probs = np.ctypeslib.as_array(out, shape=(len(frames), self.meta.classes))
+        return [self._classifications(prob, top_k) for prob in probs]
+
+    def classify_many(self, frames, batch=8, **kwargs):
+        # Classifications of every frame of an iterable, batch frames per forward pass (at most the cfg batch)
+        batch = min(batch, self.max_batch)
+        chunk = []
+        for frame in frames:
+            chunk.append(frame)
+            if len(chunk) == batch:
+                for res in self.classify_batch(chunk, **kwargs):
+                    yield res
+                chunk = []
+        if chunk:
+            for res in self.classify_batch(chunk, **kwargs):
+                yield res
+
+    def to_tuples(self, res):
+        return _to_tuples(self.meta, res)
+
+_worker_network = None
+
+def _init_worker(cfg, weights, data):
+    global _worker_network
+    _worker_network = Network(cfg, weights, data)
+
+def _run_in_worker(task):
+    method, frames, kwargs = task
+    return [getattr(_worker_network, method)(frame, **kwargs) for frame in frames]
+
+class NetworkPool(object):
+    # One Network per worker process, frames are spread over the workers in chunks and the
+    # results come back in input order. Frames are best given as image paths, arrays are pickled.
+    #
+    #     with NetworkPool("cfg/yolov3-tiny.cfg", "yolov3-tiny.weights", "cfg/coco.data", workers=8) as pool:
+    #         for path, dets in zip(paths, pool.detect_many(paths, thresh=.25)):
+    #             ...
+    def __init__(self, cfg, weights, data, workers=None, chunk=4):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk = chunk
+        self.pool = multiprocessing.Pool(self.workers, _init_worker, (cfg, weights, data))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _imap(self, method, frames, kwargs):
+        def tasks():
+            chunk = []
+            for frame in frames:
+                chunk.append(frame)
+                if len(chunk) == self.chunk:
+                    yield method, chunk, kwargs
+                    chunk = []
+            if chunk:
+                yield method, chunk, kwargs
+        for results in self.pool.imap(_run_in_worker, tasks()):
+            for res in results:
+                yield res
+
+    def detect_many(self, frames, **kwargs):
+        # Same as Network.detect for every frame, in order
+        return self._imap("detect", frames, kwargs)
+
+    def classify_many(self, frames, **kwargs):
+        return self._imap("classify", frames, kwargs)
+
 if __name__ == "__main__":
     #net = load_net("cfg/densenet201.cfg", "/home/pjreddie/trained/densenet201.weights", 0)
     #im = load_image("data/wolf.jpg", 0, 0)
     #meta = load_meta("cfg/imagenet1k.data")
     #r = classify(net, meta, im)
-    #print r[:10]
+    #print(r[:10])
     net = load_net("cfg/tiny-yolo.cfg", "tiny-yolo.weights", 0)
     meta = load_meta("cfg/coco.data")
     r = detect(net, meta, "data/dog.jpg")
-    print r
+    print(r)
     
 
@@ -1,37 +1,95 @@
 from darknet import *
 
-def predict_tactic(net, s):
-    prob = 0
-    d = c_array(c_float, [0.0]*256)
+import math
+
+import numpy as np
+
+# Batch size each net was loaded with. The rnn layers and their inner connected layers are allocated for it
+# and always run the full batch (set_batch_network does not reach the inner layers), so the input has that many rows.
+_batch_capacity = {}
+
+def _network_batch(net):
+    # network starts with int n, int batch
+    return _batch_capacity.setdefault(net, cast(net, POINTER(c_int))[1])
+
+def sample_index(p, temperature=1., top_k=None, rng=np.random):
+    # Index drawn from the distribution p (not necessarily normalized) by cumulative sum search
+    if top_k is not None and top_k < len(p):
+        candidates = np.argpartition(-p, top_k)[:top_k]
+        p = p[candidates]
+    else:
+        candidates = None
+    if temperature != 1.:
+        p = np.power(p, 1. / temperature)
+    cum = np.cumsum(p, dtype=np.float64)
+    i = min(int(np.searchsorted(cum, rng.uniform(0, cum[-1]), side='right')), len(cum) - 1)
+    return int(candidates[i]) if candidates is not None else i
+
+def generate(net, seeds, temperature=1., top_k=None, stop='.', max_len=1000, rng=np.random):
+    # Streams the characters the rnn predicts after each seed, all seeds as one batch.
+    # Yields (seed index, char, log prob of the char) as they are sampled, a sequence ends with stop.
+    # The cfg batch bounds the number of seeds, unused rows get a zero input and their output is ignored.
+    seeds = [s if len(s) else '\n' for s in seeds]
+    n = len(seeds)
+    rows = _network_batch(net)
+    if n > rows:
+        raise ValueError("%d seeds need a cfg with batch >= %d, the net was loaded with batch=%d" % (n, n, rows))
+    # Clears the hidden state of every row, darknet only does this on GPU builds,
+    # on CPU the state carries over from the previous call as it always did with reset_rnn
+    for b in range(rows):
+        reset_network_state(net, b)
+    d = np.zeros((rows, 256), np.float32)
+    d_ptr = d.ctypes.data_as(POINTER(c_float))
+    last = [None] * n
+    length = [0] * n
+    done = [False] * n
+    step = 0
+    while not all(done):
+        # Seed characters first, then what was sampled in the step before
+        for b in range(n):
+            c = seeds[b][step] if step < len(seeds[b]) else last[b]
+            if c is not None:
+                d[b, ord(c)] = 1
+        pred = np.ctypeslib.as_array(predict(net, d_ptr), shape=(rows, 256))[:n]
+        d[:] = 0
+        for b in range(n):
+            if done[b] or step < len(seeds[b]) - 1:
+                continue
+            ind = sample_index(pred[b], temperature, top_k, rng)
+            c = chr(ind)
+            last[b] = c
+            length[b] += 1
+            done[b] = c == stop or length[b] >= max_len
+            yield b, c, math.log(max(pred[b, ind], 1e-45))
+        step += 1
+
+def stream_tactic(net, s, **kwargs):
+    # Characters of one tactic as they are produced
+    for _, c, _ in generate(net, [s], **kwargs):
+        yield c
+
+def predict_tactic(net, s, **kwargs):
     tac = ''
-    if not len(s):
-        s = '\n'
-    for c in s[:-1]:
-        d[ord(c)] = 1
-        pred = predict(net, d)
-        d[ord(c)] = 0
-    c = s[-1]
-    while 1:
-        d[ord(c)] = 1
-        pred = predict(net, d)
-        d[ord(c)] = 0
-        pred = [pred[i] for i in range(256)]
-        ind = sample(pred)
-        c = chr(ind)
-        prob += math.log(pred[ind])
-        if len(tac) and tac[-1] == '.':
-            break
-        tac = tac + c
+    prob = 0
+    for _, c, logp in generate(net, [s], **kwargs):
+        tac += c
+        prob += logp
     return (tac, prob)
 
-def predict_tactics(net, s, n):
-    tacs = []
-    for i in range(n):
-        reset_rnn(net)
-        tacs.append(predict_tactic(net, s))
+def predict_tactics(net, s, n, batch=False, **kwargs):
+    # n samples for the seed, with batch=True in one batch (the cfg needs batch >= n)
+    if batch:
+        tacs = [['', 0] for _ in range(n)]
+        for b, c, logp in generate(net, [s] * n, **kwargs):
+            tacs[b][0] += c
+            tacs[b][1] += logp
+        tacs = [tuple(t) for t in tacs]
+    else:
+        tacs = [predict_tactic(net, s, **kwargs) for _ in range(n)]
     tacs = sorted(tacs, key=lambda x: -x[1])
     return tacs
 
-net = load_net("cfg/coq.test.cfg", "/home/pjreddie/backup/coq.backup", 0)
-t = predict_tactics(net, "+++++\n", 10)
-print t
+if __name__ == "__main__":
+    net = load_net("cfg/coq.test.cfg", "/home/pjreddie/backup/coq.backup", 0)
+    t = predict_tactics(net, "+++++\n", 10)
+    print(t)
@@ -0,0 +1,179 @@
+# Packed training shards: images and YOLO labels in a few large files instead of thousands of small ones.
+#
+# <prefix>.json          version, sample count, shard files, size of the pre-resized copies
+# <prefix>.index.npy     one INDEX_DTYPE row per sample
+# <prefix>-00000.shard   the records, each part aligned to ALIGN bytes:
+#                        encoded image file | labels, float32 (n, 5) class x y w h | resized RGB uint8 (h, w, 3)
+#
+# Samples are served from mmaps without copies, e.g. for augmentation or evaluation scripts:
+#
+#     with ShardDataset("/data/duckietown/train") as dataset:
+#         for i in range(len(dataset)):
+#             image, labels = dataset.resized(i), dataset.labels(i)
+#
+# scripts/pack_shards.py writes them from a darknet image list like train.txt.
+
+import io
+import json
+import mmap
+import os
+
+import numpy as np
+
+VERSION = 1
+ALIGN = 64
+
+INDEX_DTYPE = np.dtype([("shard", np.uint32), ("image_offset", np.uint64), ("image_size", np.uint64),
+                        ("label_offset", np.uint64), ("label_count", np.uint32),
+                        ("resized_offset", np.uint64), ("width", np.uint32), ("height", np.uint32)])
+
+def label_path(image_path):
+    # Label file of an image, the same replacements darknet does in fill_truth_detection
+    path = image_path
+    for old, new in (("images", "labels"), ("JPEGImages", "labels"), ("raw", "labels"),
+                     (".jpg", ".txt"), (".png", ".txt"), (".JPG", ".txt"), (".JPEG", ".txt")):
+        path = path.replace(old, new, 1)
+    return path
+
+def read_labels(path):
+    # YOLO label file -> float32 (n, 5), no file is no boxes like in darknet
+    if not os.path.exists(path):
+        return np.zeros((0, 5), np.float32)
+    with open(path) as f:
+        return np.array(f.read().split(), np.float32).reshape(-1, 5)
+
+def _padding(offset):
+    return -offset % ALIGN
+
+class ShardWriter(object):
+    # Appends samples to shards of about shard_size bytes, close() writes the index
+    def __init__(self, prefix, shard_size=1 << 30, resized=None):
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.resized = tuple(resized) if resized else None
+        self.index = []
+        self.paths = []
+        self.shards = []
+        self._file = None
+        self._offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, data):
+        offset = self._offset
+        self._file.write(data)
+        padding = _padding(len(data))
+        if padding:
+            self._file.write(b"\0" * padding)
+        self._offset += len(data) + padding
+        return offset
+
+    def add(self, path, encoded, labels, size, resized=None):
+        # encoded: the image file bytes, labels: (n, 5), size: (w, h) of the image, resized: (h, w, 3) uint8 RGB
+        if self._file is None or self._offset >= self.shard_size:
+            self._next_shard()
+        labels = np.ascontiguousarray(labels, np.float32).reshape(-1, 5)
+        image_offset = self._write(encoded)
+        label_offset = self._write(labels.tobytes())
+        resized_offset = 0
+        if self.resized is not None:
+            if resized is None or resized.shape != (self.resized[1], self.resized[0], 3):
+                raise ValueError("%s: expected a resized copy of %dx%d" % (path, self.resized[0], self.resized[1]))
+            resized_offset = self._write(np.ascontiguousarray(resized, np.uint8).tobytes())
+        self.index.append((len(self.shards) - 1, image_offset, len(encoded), label_offset, len(labels),
+                           resized_offset, size[0], size[1]))
+        self.paths.append(path)
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = "%s-%05d.shard" % (os.path.basename(self.prefix), len(self.shards))
+        self.shards.append(name)
+        self._file = open(os.path.join(os.path.dirname(os.path.abspath(self.prefix)), name), "wb")
+        self._offset = 0
+
+    def close(self):
+        if self._file is None and not self.shards:
+            return
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        np.save(self.prefix + ".index.npy", np.array(self.index, INDEX_DTYPE))
+        with open(self.prefix + ".json", "w") as f:
+            json.dump({"version": VERSION, "count": len(self.index), "shards": self.shards,
+                       "resized": self.resized, "paths": self.paths}, f)
+        self.shards = []
+
+class ShardDataset(object):
+    # Random access to packed samples, every accessor returns a read-only view into the mmapped shard
+    def __init__(self, prefix):
+        with open(prefix + ".json") as f:
+            meta = json.load(f)
+        if meta["version"] != VERSION:
+            raise ValueError("%s: shard version %s, expected %d" % (prefix, meta["version"], VERSION))
+        self.paths = meta["paths"]
+        self.resized_size = tuple(meta["resized"]) if meta["resized"] else None
+        self.index = np.load(prefix + ".index.npy", mmap_mode="r")
+        directory = os.path.dirname(os.path.abspath(prefix))
+        self._shard_paths = [os.path.join(directory, name) for name in meta["shards"]]
+        self._maps = [None] * len(self._shard_paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        for i, m in enumerate(self._maps):
+            if m is not None:
+                try:
+                    m.close()
+                except BufferError:
+                    pass # Views are still in use, the map is released with the last one
+                self._maps[i] = None
+
+    def _map(self, shard):
+        # Opened on first use, so forked workers only map the shards they read
+        m = self._maps[shard]
+        if m is None:
+            with open(self._shard_paths[shard], "rb") as f:
+                m = self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m
+
+    def encoded(self, i):
+        # The image file bytes
+        row = self.index[i]
+        offset = int(row["image_offset"])
+        return memoryview(self._map(int(row["shard"])))[offset:offset + int(row["image_size"])]
+
+    def labels(self, i):
+        # float32 (n, 5): class x y w h, relative to the image size
+        row = self.index[i]
+        return np.frombuffer(self._map(int(row["shard"])), np.float32, int(row["label_count"]) * 5,
+                             int(row["label_offset"])).reshape(-1, 5)
+
+    def resized(self, i):
+        # uint8 RGB (h, w, 3) at the size given when packing, the labels stay valid
+        if self.resized_size is None:
+            raise ValueError("The shards were packed without resized copies")
+        row = self.index[i]
+        w, h = self.resized_size
+        return np.frombuffer(self._map(int(row["shard"])), np.uint8, w * h * 3,
+                             int(row["resized_offset"])).reshape(h, w, 3)
+
+    def image(self, i):
+        # Decoded uint8 RGB (h, w, 3) of the original image
+        from PIL import Image
+        return np.asarray(Image.open(io.BytesIO(self.encoded(i))).convert("RGB"))
+
+    def size(self, i):
+        row = self.index[i]
+        return int(row["width"]), int(row["height"])
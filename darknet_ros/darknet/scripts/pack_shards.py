@@ -0,0 +1,61 @@
+# Packs the images and YOLO labels of a darknet image list into shards, see python/shards.py:
+# python3 scripts/pack_shards.py train.txt /data/duckietown/shards/train --resize 416 416
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from shards import ShardWriter, label_path, read_labels
+
+resize_to = None
+
+def init_worker(resize):
+    global resize_to
+    resize_to = resize
+
+def load_sample(path):
+    with open(path, 'rb') as f:
+        encoded = f.read()
+    image = Image.open(io.BytesIO(encoded))
+    resized = None
+    if resize_to is not None:
+        resized = np.asarray(image.convert('RGB').resize(tuple(resize_to), Image.BILINEAR))
+    return path, encoded, read_labels(label_path(path)), image.size, resized
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack a darknet image list and its labels into mmap shards.')
+    parser.add_argument('list', help='Image list, one path per line, e.g. train.txt')
+    parser.add_argument('prefix', help='Output prefix, writes <prefix>.json, <prefix>.index.npy and <prefix>-NNNNN.shard')
+    parser.add_argument('--shard-size', type=int, default=1024, help='MB per shard')
+    parser.add_argument('--resize', type=int, nargs=2, metavar=('W', 'H'), help='Also store RGB copies at the network input size')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    with open(args.list) as f:
+        paths = [line.strip() for line in f if line.strip()]
+    directory = os.path.dirname(os.path.abspath(args.prefix))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    pool = multiprocessing.Pool(args.workers, init_worker, (args.resize,))
+    try:
+        with ShardWriter(args.prefix, args.shard_size << 20, args.resize) as writer:
+            # Ordered, the samples are packed in list order
+            for n, (path, encoded, labels, size, resized) in enumerate(pool.imap(load_sample, paths, chunksize=16), 1):
+                writer.add(path, encoded, labels, size, resized)
+                if n % 1000 == 0:
+                    print('%d/%d' % (n, len(paths)))
+            shards = len(writer.shards)
+    finally:
+        pool.close()
+        pool.join()
+    print('%d images in %d shards' % (len(paths), shards))
+
+if __name__ == '__main__':
+    main()
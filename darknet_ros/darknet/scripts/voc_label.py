@@ -1,7 +1,8 @@
 import xml.etree.ElementTree as ET
-import pickle
+import argparse
+import multiprocessing
 import os
-from os import listdir, getcwd
+from os import getcwd
 from os.path import join
 
 sets=[('2012', 'train'), ('2012', 'val'), ('2007', 'train'), ('2007', 'val'), ('2007', 'test')]
@@ -22,38 +23,143 @@ def convert(size, box):
     h = h*dh
     return (x,y,w,h)
 
-def convert_annotation(year, image_id):
-    in_file = open('VOCdevkit/VOC%s/Annotations/%s.xml'%(year, image_id))
-    out_file = open('VOCdevkit/VOC%s/labels/%s.txt'%(year, image_id), 'w')
-    tree=ET.parse(in_file)
-    root = tree.getroot()
-    size = root.find('size')
-    w = int(size.find('width').text)
-    h = int(size.find('height').text)
-
-    for obj in root.iter('object'):
-        difficult = obj.find('difficult').text
-        cls = obj.find('name').text
-        if cls not in classes or int(difficult)==1:
-            continue
-        cls_id = classes.index(cls)
-        xmlbox = obj.find('bndbox')
-        b = (float(xmlbox.find('xmin').text), float(xmlbox.find('xmax').text), float(xmlbox.find('ymin').text), float(xmlbox.find('ymax').text))
-        bb = convert((w,h), b)
-        out_file.write(str(cls_id) + " " + " ".join([str(a) for a in bb]) + '\n')
-
-wd = getcwd()
-
-for year, image_set in sets:
-    if not os.path.exists('VOCdevkit/VOC%s/labels/'%(year)):
-        os.makedirs('VOCdevkit/VOC%s/labels/'%(year))
-    image_ids = open('VOCdevkit/VOC%s/ImageSets/Main/%s.txt'%(year, image_set)).read().strip().split()
-    list_file = open('%s_%s.txt'%(year, image_set), 'w')
-    for image_id in image_ids:
-        list_file.write('%s/VOCdevkit/VOC%s/JPEGImages/%s.jpg\n'%(wd, year, image_id))
-        convert_annotation(year, image_id)
-    list_file.close()
-
-os.system("cat 2007_train.txt 2007_val.txt 2012_train.txt 2012_val.txt > train.txt")
-os.system("cat 2007_train.txt 2007_val.txt 2007_test.txt 2012_train.txt 2012_val.txt > train.all.txt")
+def read_annotation(in_path, class_ids):
+    # Streams the xml, every element is dropped once it is handled, returns ((w, h), [(cls_id, box)])
+    size = None
+    objects = []
+    for _, elem in ET.iterparse(in_path, events=('end',)):
+        if elem.tag == 'size':
+            size = (int(elem.find('width').text), int(elem.find('height').text))
+            elem.clear()
+        elif elem.tag == 'object':
+            difficult = elem.find('difficult')
+            cls = elem.find('name').text
+            if cls in class_ids and (difficult is None or int(difficult.text) != 1):
+                xmlbox = elem.find('bndbox')
+                b = (float(xmlbox.find('xmin').text), float(xmlbox.find('xmax').text), float(xmlbox.find('ymin').text), float(xmlbox.find('ymax').text))
+                objects.append((class_ids[cls], b))
+            elem.clear()
+    return size, objects
 
+def convert_annotation(in_path, out_path, class_ids, force=False):
+    # Returns the number of written boxes, None if the label file is newer than the annotation
+    if not force and os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(in_path):
+        return None
+    size, objects = read_annotation(in_path, class_ids)
+    lines = [str(cls_id) + " " + " ".join([str(a) for a in convert(size, b)]) + '\n' for cls_id, b in objects]
+    # Written next to the final file and renamed, an interrupted run leaves no half written labels
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'w') as out_file:
+        out_file.writelines(lines)
+    os.replace(tmp_path, out_path)
+    return len(lines)
+
+def convert_chunk(task):
+    pairs, class_ids, force = task
+    converted = skipped = boxes = 0
+    for in_path, out_path in pairs:
+        n = convert_annotation(in_path, out_path, class_ids, force)
+        if n is None:
+            skipped += 1
+        else:
+            converted += 1
+            boxes += n
+    return converted, skipped, boxes
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def concat_lists(out_path, in_paths):
+    with open(out_path, 'w') as out_file:
+        for in_path in in_paths:
+            with open(in_path) as in_file:
+                out_file.writelines(in_file)
+
+def load_classes(spec):
+    # Comma separated names or a file with one name per line, e.g. data/voc.names
+    if os.path.isfile(spec):
+        with open(spec) as f:
+            return [line.strip() for line in f if line.strip()]
+    return [name.strip() for name in spec.split(',') if name.strip()]
+
+def labels_classes_path(labels_dir):
+    # The class list the labels of a directory were converted with, their class ids index it
+    return join(labels_dir, 'classes.names')
+
+def labels_match(labels_dir, class_names):
+    # False if the labels were converted with other classes, or by a run that did not record them
+    try:
+        with open(labels_classes_path(labels_dir)) as f:
+            return [line.strip() for line in f if line.strip()] == class_names
+    except IOError:
+        return False
+
+def write_labels_classes(labels_dir, class_names):
+    with open(labels_classes_path(labels_dir), 'w') as f:
+        f.writelines(name + '\n' for name in class_names)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert VOC annotations to darknet labels and image lists.')
+    parser.add_argument('--devkit', default='VOCdevkit', help='Directory with VOC<year>/{Annotations,ImageSets,JPEGImages}')
+    parser.add_argument('--sets', nargs='+', default=['%s_%s' % s for s in sets], help='<year>_<image set>, e.g. 2012_train')
+    parser.add_argument('--classes', default=','.join(classes), help='Comma separated names or a names file, e.g. duckie,duckiebot')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk', type=int, default=256, help='Annotations per task')
+    parser.add_argument('--force', action='store_true', help='Also convert annotations whose labels are up to date')
+    args = parser.parse_args()
+
+    class_names = load_classes(args.classes)
+    class_ids = dict((name, i) for i, name in enumerate(class_names))
+    wd = getcwd()
+    devkit = join(wd, args.devkit)
+
+    list_files = []
+    tasks = []
+    # Labels directories converted with other classes are converted again, decided before any label is written
+    forced = {}
+    for year_set in args.sets:
+        year, image_set = year_set.split('_', 1)
+        voc = join(devkit, 'VOC%s' % year)
+        labels_dir = join(voc, 'labels')
+        if not os.path.exists(labels_dir):
+            os.makedirs(labels_dir)
+        if labels_dir not in forced:
+            forced[labels_dir] = args.force or not labels_match(labels_dir, class_names)
+            if forced[labels_dir]:
+                if not args.force:
+                    print('%s: classes changed or not recorded, converting all annotations' % labels_dir)
+                # Until the run is complete the labels are a mix of both class lists
+                if os.path.exists(labels_classes_path(labels_dir)):
+                    os.remove(labels_classes_path(labels_dir))
+        with open(join(voc, 'ImageSets', 'Main', '%s.txt' % image_set)) as f:
+            image_ids = f.read().strip().split()
+        list_file = '%s_%s.txt' % (year, image_set)
+        with open(list_file, 'w') as f:
+            f.writelines('%s/JPEGImages/%s.jpg\n' % (voc, image_id) for image_id in image_ids)
+        list_files.append((year, image_set, list_file))
+        pairs = [(join(voc, 'Annotations', '%s.xml' % image_id), join(voc, 'labels', '%s.txt' % image_id)) for image_id in image_ids]
+        tasks.extend((chunk, class_ids, forced[labels_dir]) for chunk in chunks(pairs, args.chunk))
+
+    converted = skipped = boxes = 0
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for c, s, b in pool.imap_unordered(convert_chunk, tasks):
+            converted += c
+            skipped += s
+            boxes += b
+    finally:
+        pool.close()
+        pool.join()
+    # Only recorded once every label is converted, after an interrupted run everything is converted again
+    for labels_dir in forced:
+        write_labels_classes(labels_dir, class_names)
+    print('%d annotations converted (%d boxes of %d classes), %d up to date' % (converted, boxes, len(class_names), skipped))
+
+    # Lists of the same year stay together, older years first
+    list_files.sort(key=lambda l: l[0])
+    concat_lists('train.txt', [f for _, image_set, f in list_files if image_set != 'test'])
+    concat_lists('train.all.txt', [f for _, _, f in list_files])
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,10 @@
 #include <thread>
 #include <vector>
 
+// boost
+#include <boost/thread/condition_variable.hpp>
+#include <boost/thread/mutex.hpp>
+
 // ROS
 #include <actionlib/server/simple_action_server.h>
 #include <geometry_msgs/Point.h>
@@ -209,6 +213,12 @@ class YoloObjectDetector {
   bool isNodeRunning_ = true;
   boost::shared_mutex mutexNodeStatus_;
 
+  //! Only detect frames that were not detected yet, instead of looping over the last frame.
+  bool waitForNewImage_ = false;
+  bool newImage_ = false;
+  boost::mutex mutexNewImage_;
+  boost::condition_variable newImageCondition_;
+
   int actionId_;
   boost::shared_mutex mutexActionStatus_;
 
@@ -242,6 +252,12 @@ class YoloObjectDetector {
   bool isNodeRunning(void);
 
   void* publishInThread();
+
+  void notifyNewImage(void);
+
+  bool waitForNewImage(void);
+
+  void detectNewImage(void);
 };
 
 } /* namespace darknet_ros*/
@@ -50,6 +50,7 @@ bool YoloObjectDetector::readParameters() {
   nodeHandle_.param("image_view/enable_opencv", viewImage_, true);
   nodeHandle_.param("image_view/wait_key_delay", waitKeyDelay_, 3);
   nodeHandle_.param("image_view/enable_console_output", enableConsoleOutput_, false);
+  nodeHandle_.param("subscribers/camera_reading/wait_for_new_image", waitForNewImage_, false);
 
   // Check if Xserver is running on Linux.
   if (XOpenDisplay(NULL)) {
@@ -189,6 +190,7 @@ void YoloObjectDetector::cameraCallback(const sensor_msgs::ImageConstPtr& msg) {
       boost::unique_lock<boost::shared_mutex> lockImageStatus(mutexImageStatus_);
       imageStatus_ = true;
     }
+    notifyNewImage();
     frameWidth_ = cam_image->image.size().width;
     frameHeight_ = cam_image->image.size().height;
   }
@@ -223,6 +225,7 @@ void YoloObjectDetector::checkForObjectsActionGoalCB() {
       boost::unique_lock<boost::shared_mutex> lockImageStatus(mutexImageStatus_);
       imageStatus_ = true;
     }
+    notifyNewImage();
     frameWidth_ = cam_image->image.size().width;
     frameHeight_ = cam_image->image.size().height;
   }
@@ -494,6 +497,17 @@ void YoloObjectDetector::yolo() {
   demoTime_ = what_time_is_it_now();
 
   while (!demoDone_) {
+    if (waitForNewImage_) {
+      if (waitForNewImage()) {
+        detectNewImage();
+        ++count;
+      }
+      if (!isNodeRunning()) {
+        demoDone_ = true;
+      }
+      continue;
+    }
+
     buffIndex_ = (buffIndex_ + 1) % 3;
     fetch_thread = std::thread(&YoloObjectDetector::fetchInThread, this);
     detect_thread = std::thread(&YoloObjectDetector::detectInThread, this);
@@ -520,6 +534,44 @@ void YoloObjectDetector::yolo() {
   }
 }
 
+void YoloObjectDetector::notifyNewImage() {
+  {
+    boost::unique_lock<boost::mutex> lockNewImage(mutexNewImage_);
+    newImage_ = true;
+  }
+  newImageCondition_.notify_one();
+}
+
+bool YoloObjectDetector::waitForNewImage() {
+  // Times out to check regularly whether the node is still running.
+  boost::unique_lock<boost::mutex> lockNewImage(mutexNewImage_);
+  if (!newImage_) {
+    newImageCondition_.wait_for(lockNewImage, boost::chrono::milliseconds(100));
+  }
+  bool newImage = newImage_;
+  newImage_ = false;
+  return newImage;
+}
+
+void YoloObjectDetector::detectNewImage() {
+  // Fetch, detect and publish the same frame in sequence, so its result is not held back
+  // in the three stage pipeline until two more frames arrive.
+  const int fetchIndex = (buffIndex_ + 1) % 3;
+  buffIndex_ = fetchIndex;
+  fetchInThread();
+  buffIndex_ = (fetchIndex + 1) % 3;  // detectInThread() reads buffer (buffIndex_ + 2) % 3
+  detectInThread();
+  buffIndex_ = (fetchIndex + 2) % 3;  // display and publish read buffer (buffIndex_ + 1) % 3
+  fps_ = 1. / (what_time_is_it_now() - demoTime_);
+  demoTime_ = what_time_is_it_now();
+  if (viewImage_) {
+    displayInThread(0);
+  } else {
+    generate_image(buff_[fetchIndex], disp_);
+  }
+  publishInThread();
+}
+
 CvMatWithHeader_ YoloObjectDetector::getCvMatWithHeader() {
   CvMatWithHeader_ header = {.image = camImageCopy_, .header = imageHeader_};
   return header;
@@ -0,0 +1,9 @@
+from distutils.core import setup
+from catkin_pkg.python_setup import generate_distutils_setup
+ 
+d = generate_distutils_setup(
+    packages=['frame_bus'],
+    package_dir={'': 'src'}
+)
+ 
+setup(**d)
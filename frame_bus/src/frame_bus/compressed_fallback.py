@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# The compressed camera topic for consumers of the frame bus, subscribed only while they fall back to it.
+# With the frame bus running nothing but the frame bus node receives the JPEGs.
+import rospy
+from sensor_msgs.msg import CompressedImage
+from typing import Optional, Tuple
+
+from frame_bus.frame_ring import Frame, FrameBusReader
+
+
+class CompressedFallback:
+    topic: str
+    image_sub: Optional[rospy.Subscriber]
+    last_image: Optional[CompressedImage]
+
+    def __init__(self, topic: str) -> None:
+        self.topic = topic
+        self.image_sub = None
+        self.last_image = None
+
+    def _image_callback(self, image_msg: CompressedImage) -> None:
+        self.last_image = image_msg
+
+    def latest(self) -> Optional[CompressedImage]:
+        # The newest compressed frame, subscribes on the first call, so the first frame comes with a later call
+        if self.image_sub is None:
+            rospy.loginfo(f"Falling back to {self.topic}")
+            self.image_sub = rospy.Subscriber(self.topic, CompressedImage, self._image_callback, queue_size=1, buff_size=2**22)
+        return self.last_image
+
+    def stop(self) -> None:
+        # The frame bus delivers again
+        if self.image_sub is not None:
+            rospy.loginfo(f"Frame bus is back, unsubscribing from {self.topic}")
+            self.image_sub.unregister()
+            self.image_sub = None
+            self.last_image = None
+
+
+def latest_frame(frame_bus: Optional[FrameBusReader], fallback: CompressedFallback) -> Tuple[Optional[Frame], Optional[CompressedImage]]:
+    # (frame, None) from the frame bus, (None, image_msg) from the camera topic while the bus is not available,
+    # (None, None) if there is nothing new to process yet
+    frame = frame_bus.latest() if frame_bus is not None else None
+    if frame is not None:
+        fallback.stop()
+        return frame, None
+    if frame_bus is not None and frame_bus.attached:
+        return None, None # The frame bus decodes a frame for the next call
+    return None, fallback.latest()
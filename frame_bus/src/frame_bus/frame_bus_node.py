@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# This node decodes the camera frames once and writes them into a shared memory ring,
+# so the perception nodes on the robot map the decoded frames instead of decoding the JPEG each.
+# Every camera frame is decoded while readers are present, nothing is decoded while nobody reads.
+import os
+import threading
+import rospy
+import numpy as np
+import cv2
+from sensor_msgs.msg import CompressedImage
+from typing import Optional
+
+from frame_ring import FrameRing, default_ring_name
+
+class FrameBusNode:
+    node_name: str
+    robot_name: str
+    ring_name: str
+    slots: int
+    reader_timeout: float
+
+    ring: Optional[FrameRing]
+    ring_lock: threading.Lock
+    image_sub: rospy.Subscriber
+
+    def __init__(self) -> None:
+        self.node_name = rospy.get_name()
+        rospy.loginfo(f"[{self.node_name}] Initializing {self.node_name} node...")
+
+        self.robot_name = os.getenv('VEHICLE_NAME', None)
+        if self.robot_name is None:
+            raise ValueError("$VEHICLE_NAME is not set, export it first.")
+        rospy.loginfo(f"[{self.node_name}] Robot name: {self.robot_name}")
+
+        self.ring_name = rospy.get_param("~ring_name", default_ring_name(self.robot_name))
+        # A frame is overwritten after slots - 1 newer frames, i.e. after as many reads by the fastest reader
+        self.slots = int(rospy.get_param("~slots", 4))
+        # Decoding stops this long after the last read, longer than the period of the slowest reader
+        self.reader_timeout = float(rospy.get_param("~reader_timeout", 2.0))
+        rospy.loginfo(f"[{self.node_name}] Ring: {self.ring_name}, {self.slots} slots")
+
+        # Created on the first frame, the image size is not known before
+        self.ring = None
+        # The ring must not be closed on shutdown while the callback writes into it
+        self.ring_lock = threading.Lock()
+        self.image_sub = rospy.Subscriber(f"/{self.robot_name}/camera_node/image/compressed", CompressedImage,
+                                          self._image_callback, queue_size=1, buff_size=2**22)
+        rospy.on_shutdown(self._shutdown)
+
+    def _image_callback(self, image_msg: CompressedImage) -> None:
+        with self.ring_lock:
+            if self.ring is not None and not rospy.is_shutdown():
+                self.ring.touch()
+                if not self.ring.readers_active(self.reader_timeout):
+                    return # Nobody reads
+
+        image = cv2.imdecode(np.frombuffer(image_msg.data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            rospy.logerr(f"[{self.node_name}] Failed to decode image!")
+            return
+
+        with self.ring_lock:
+            if rospy.is_shutdown():
+                return
+            if self.ring is not None and self.ring.shape != image.shape:
+                rospy.logwarn(f"[{self.node_name}] Image size changed to {image.shape}, recreating the ring")
+                self.ring.close()
+                self.ring = None
+            if self.ring is None:
+                height, width, channels = image.shape
+                self.ring = FrameRing.create(self.ring_name, height, width, channels, self.slots)
+                rospy.loginfo(f"[{self.node_name}] Created ring {self.ring_name} for {width}x{height} frames")
+
+            stamp = image_msg.header.stamp.to_sec() if not image_msg.header.stamp.is_zero() else rospy.get_time()
+            self.ring.write(image, stamp)
+
+    def _shutdown(self) -> None:
+        self.image_sub.unregister()
+        with self.ring_lock:
+            if self.ring is not None:
+                self.ring.close()
+                self.ring = None
+
+
+if __name__ == "__main__":
+    rospy.init_node("frame_bus_node")
+    frame_bus_node = FrameBusNode()
+    rospy.spin()
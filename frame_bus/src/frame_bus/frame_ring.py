@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Shared memory ring buffer of decoded camera frames, no ROS needed.
+# A single writer (the frame bus node) decodes each camera frame once and copies it into the next slot,
+# readers in other processes map the same POSIX shared memory and get zero-copy NumPy views of the slots.
+# Layout: header | slot table (sequence number, capture stamp, write time per slot) | frame slots
+# The sequence number of a slot is 0 while it is written. A reader checks it again after using a view,
+# if it changed the writer has lapped the reader and the view content is torn.
+# Frames are only decoded while somebody reads: every read stores its time in the header, and the writer decodes
+# each camera frame as long as a read was recent, so the newest frame is never older than one camera period.
+# The heartbeat tells the readers the writer still receives camera frames while it does not decode.
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional
+
+import numpy as np
+
+MAGIC = 0x46425553 # "FBUS", cleared by the writer on close
+VERSION = 3
+HEADER_DTYPE = np.dtype([("magic", "<u4"), ("version", "<u4"), ("slots", "<u4"), ("height", "<u4"),
+                         ("width", "<u4"), ("channels", "<u4"), ("latest", "<u8"), ("read_time", "<f8"),
+                         ("heartbeat", "<f8")])
+SLOT_DTYPE = np.dtype([("seq", "<u8"), ("stamp", "<f8"), ("write_time", "<f8")])
+ALIGNMENT = 64 # cache line, the frames start aligned
+
+
+def default_ring_name(robot_name: str) -> str:
+    return f"frame_bus_{robot_name}"
+
+def _aligned(size: int) -> int:
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _layout(slots: int, height: int, width: int, channels: int):
+    table_offset = _aligned(HEADER_DTYPE.itemsize)
+    frames_offset = _aligned(table_offset + slots * SLOT_DTYPE.itemsize)
+    frame_size = _aligned(height * width * channels)
+    return table_offset, frames_offset, frame_size, frames_offset + slots * frame_size
+
+
+class Frame:
+    seq: int # increasing from 1, 0 is never a valid frame
+    stamp: float # capture time of the camera frame [s]
+    write_time: float # wall time the frame was written to the ring [s]
+    image: np.ndarray # read-only view into the ring, BGR
+
+    def __init__(self, seq: int, stamp: float, write_time: float, image: np.ndarray) -> None:
+        self.seq = seq
+        self.stamp = stamp
+        self.write_time = write_time
+        self.image = image
+
+
+class FrameRing:
+    name: Optional[str] # None for the in-process stand-in
+    owner: bool
+    shm: Optional[shared_memory.SharedMemory]
+    header: np.ndarray
+    table: np.ndarray
+    frames: np.ndarray
+
+    def __init__(self, name: Optional[str], buffer, owner: bool, shm: Optional[shared_memory.SharedMemory] = None) -> None:
+        self.name = name
+        self.owner = owner
+        self.shm = shm
+        self.header = np.ndarray((), HEADER_DTYPE, buffer=buffer)
+        if self.header["magic"] != MAGIC or self.header["version"] != VERSION:
+            raise ValueError(f"{name} is not an open frame ring")
+        slots, height, width, channels = (int(self.header[key]) for key in ("slots", "height", "width", "channels"))
+        table_offset, frames_offset, frame_size, _ = _layout(slots, height, width, channels)
+        self.table = np.ndarray((slots,), SLOT_DTYPE, buffer=buffer, offset=table_offset)
+        self.frames = np.ndarray((slots, height, width, channels), np.uint8, buffer=buffer, offset=frames_offset,
+                                 strides=(frame_size, width * channels, channels, 1))
+
+    @classmethod
+    def create(cls, name: Optional[str], height: int, width: int, channels: int = 3, slots: int = 4) -> "FrameRing":
+        # name=None keeps the ring in this process, a stand-in for tests without a second process
+        size = _layout(slots, height, width, channels)[3]
+        shm = None
+        if name is None:
+            buffer = bytearray(size)
+        else:
+            try:
+                shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # Left over by a writer that crashed, its readers detach once the frames get old
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            buffer = shm.buf
+        header = np.ndarray((), HEADER_DTYPE, buffer=buffer)
+        header["version"] = VERSION
+        header["slots"] = slots
+        header["height"] = height
+        header["width"] = width
+        header["channels"] = channels
+        header["latest"] = 0
+        header["read_time"] = 0.0
+        header["heartbeat"] = time.time()
+        header["magic"] = MAGIC
+        return cls(name, buffer, True, shm)
+
+    @classmethod
+    def attach(cls, name: str) -> "FrameRing":
+        # Raises FileNotFoundError if the writer has not created the ring yet
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 the resource tracker would unlink the writer's segment when a reader exits
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        try:
+            return cls(name, shm.buf, False, shm)
+        except ValueError:
+            shm.close()
+            raise
+
+    @property
+    def shape(self) -> tuple:
+        return self.frames.shape[1:]
+
+    @property
+    def closed(self) -> bool:
+        return self.header["magic"] != MAGIC
+
+    def write(self, image: np.ndarray, stamp: float) -> int:
+        if image.shape != self.shape:
+            raise ValueError(f"Frame of shape {image.shape} does not fit the ring of shape {self.shape}")
+        seq = int(self.header["latest"]) + 1
+        index = seq % len(self.table)
+        self.table["seq"][index] = 0 # being written
+        np.copyto(self.frames[index], image)
+        self.table["stamp"][index] = stamp
+        self.table["write_time"][index] = time.time()
+        self.table["seq"][index] = seq
+        self.header["latest"] = seq
+        self.header["heartbeat"] = self.table["write_time"][index]
+        return seq
+
+    def touch(self) -> None:
+        # Writer: a camera frame arrived, also when it is not decoded
+        self.header["heartbeat"] = time.time()
+
+    @property
+    def heartbeat(self) -> float:
+        return float(self.header["heartbeat"])
+
+    def readers_active(self, timeout: float) -> bool:
+        # Writer: a reader read within the last timeout seconds, camera frames should be decoded
+        return time.time() - float(self.header["read_time"]) <= timeout
+
+    def take(self) -> None:
+        # Reader: marks the readers as present. Readers race here, the time never goes back so a slow
+        # reader can not hide a read of another one.
+        now = time.time()
+        if now > self.header["read_time"]:
+            self.header["read_time"] = now
+
+    def get(self, seq: int) -> Optional[Frame]:
+        # The frame with the given sequence number, None if it was not written yet or is overwritten
+        index = seq % len(self.table)
+        if seq <= 0 or int(self.table["seq"][index]) != seq:
+            return None
+        image = self.frames[index]
+        image.flags.writeable = False
+        return Frame(seq, float(self.table["stamp"][index]), float(self.table["write_time"][index]), image)
+
+    def latest(self) -> Optional[Frame]:
+        return self.get(int(self.header["latest"]))
+
+    def is_valid(self, frame: Frame) -> bool:
+        # False if the slot was rewritten while the frame view was in use
+        return int(self.table["seq"][frame.seq % len(self.table)]) == frame.seq
+
+    def close(self) -> None:
+        # Frame views handed out must be dropped before, they keep the mapping alive
+        if self.owner:
+            self.header["magic"] = 0 # tells the readers to detach
+        del self.header, self.table, self.frames
+        if self.shm is not None:
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+
+
+class FrameBusReader:
+    # Attaches lazily to the ring of a frame bus and detaches again if the writer is gone,
+    # so consumers can fall back to decoding the camera topic themselves
+    name: str
+    max_age: float
+    retry_period: float
+    ring: Optional[FrameRing]
+    last_attempt: float
+
+    def __init__(self, name: str, max_age: float = 1.0, retry_period: float = 2.0) -> None:
+        self.name = name
+        self.max_age = max_age
+        self.retry_period = retry_period
+        self.ring = None
+        self.last_attempt = -float('inf')
+
+    @property
+    def attached(self) -> bool:
+        return self.ring is not None
+
+    def _attach(self) -> bool:
+        now = time.monotonic()
+        if now - self.last_attempt < self.retry_period:
+            return False
+        self.last_attempt = now
+        try:
+            self.ring = FrameRing.attach(self.name)
+        except (FileNotFoundError, ValueError):
+            return False
+        return True
+
+    def detach(self) -> None:
+        if self.ring is not None:
+            ring, self.ring = self.ring, None
+            try:
+                ring.close()
+            except BufferError:
+                pass # A frame view is still in use, the mapping goes away with it
+
+    def latest(self) -> Optional[Frame]:
+        # The newest frame, None if there is no ring or no frame newer than max_age.
+        # While attached is still True afterwards the writer is alive and decodes a frame for the next call.
+        if self.ring is None and not self._attach():
+            return None
+        if self.ring.closed or time.time() - self.ring.heartbeat > self.max_age:
+            # The writer stopped or was replaced by a new ring under the same name
+            self.detach()
+            return None
+        # Keeps the writer decoding while this reader reads
+        self.ring.take()
+        frame = self.ring.latest()
+        if frame is None or time.time() - frame.write_time > self.max_age:
+            return None # Decoded before anybody read, the writer decodes again from the next camera frame
+        return frame
+
+    def is_valid(self, frame: Frame) -> bool:
+        return self.ring is not None and self.ring.is_valid(frame)
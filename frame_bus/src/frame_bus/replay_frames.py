@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Plain Python stand-in for the frame bus node, no ROS needed.
+# Decodes a directory of recorded JPEG frames into the shared memory ring at the camera rate,
+# so the frame bus consumers can be run and profiled against recorded data:
+# python3 replay_frames.py --frames /data/logs/frames --ring frame_bus_$VEHICLE_NAME --rate 10 --loop
+import argparse
+import glob
+import os
+import time
+
+import cv2
+
+from frame_ring import FrameRing
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded JPEG frames into a frame bus ring.")
+    parser.add_argument("--frames", required=True, help="Directory of JPEG frames")
+    parser.add_argument("--ring", required=True, help="Shared memory name of the ring, frame_bus_<robot> for the nodes")
+    parser.add_argument("--rate", type=float, default=10.0, help="Frames per second")
+    parser.add_argument("--slots", type=int, default=4)
+    parser.add_argument("--loop", action="store_true", help="Start over after the last frame")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.frames, "*.jpg")) + glob.glob(os.path.join(args.frames, "*.jpeg")))
+    if not paths:
+        raise ValueError(f"No JPEG frames found in {args.frames}")
+
+    ring = None
+    period = 1 / args.rate
+    next_time = time.monotonic()
+    try:
+        while True:
+            for path in paths:
+                image = cv2.imread(path, cv2.IMREAD_COLOR)
+                if image is None:
+                    print(f"Skipping unreadable frame {path}")
+                    continue
+                if ring is None:
+                    height, width, channels = image.shape
+                    ring = FrameRing.create(args.ring, height, width, channels, args.slots)
+                    print(f"Created ring {args.ring} for {width}x{height} frames")
+                seq = ring.write(image, time.time())
+                print(f"\r{seq} frames written", end="", flush=True)
+
+                next_time += period
+                time.sleep(max(next_time - time.monotonic(), 0.0))
+            if not args.loop:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print()
+        if ring is not None:
+            ring.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Compares the CPU backend of obstacle_detection_node with darknet on recorded frames, no ROS needed.
+# The OpenCV DNN path is timed like the node runs it: decode, crop to the obstacle region and detect.
+# With --darknet-lib the same crops go through libdarknet.so with the darknet python wrapper:
+# python3 benchmark_detector.py --frames /data/logs/frames --darknet-lib ../../darknet_ros/darknet/libdarknet.so
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import yaml
+
+from roi import ObstacleRoi
+from yolo_detector import YoloDetector, load_network_params
+
+DARKNET_ROS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "darknet_ros")
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> float:
+    # a, b: [xmin, ymin, xmax, ymax]
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    return intersection / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection)
+
+
+def load_darknet(lib_path: str, cfg_path: str, weights_path: str, data_path: str):
+    # The wrapper loads the library on import
+    sys.path.insert(0, os.path.join(DARKNET_ROS, "darknet", "python"))
+    os.environ["DARKNET_LIB"] = os.path.abspath(lib_path)
+    import darknet
+    return darknet, darknet.load_net(cfg_path, weights_path, 0), darknet.load_meta(data_path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the OpenCV DNN obstacle detector against darknet.")
+    parser.add_argument("--frames", required=True, help="Directory of JPEG frames")
+    parser.add_argument("--roi", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config", "obstacle_roi.yaml"))
+    parser.add_argument("--cfg", default=os.path.join(DARKNET_ROS, "darknet_ros", "yolo_network_config", "cfg", "yolov3-tiny-roi.cfg"))
+    parser.add_argument("--full-frame-cfg", default=os.path.join(DARKNET_ROS, "darknet_ros", "yolo_network_config", "cfg", "yolov3-tiny.cfg"))
+    parser.add_argument("--weights", default=os.path.join(DARKNET_ROS, "darknet_ros", "yolo_network_config", "weights", "yolov3-tiny.weights"))
+    parser.add_argument("--network-param-file", default=os.path.join(DARKNET_ROS, "darknet_ros", "config", "yolov3-tiny-roi.yaml"))
+    parser.add_argument("--threads", type=int, default=0, help="OpenCV threads, 0 keeps the default")
+    parser.add_argument("--darknet-lib", help="Path to libdarknet.so, also runs darknet on the crops")
+    parser.add_argument("--darknet-data", default=os.path.join(DARKNET_ROS, "darknet", "cfg", "coco.data"))
+    parser.add_argument("--limit", type=int, default=0, help="Use only the first N frames")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.frames, "*.jpg")) + glob.glob(os.path.join(args.frames, "*.jpeg")))
+    if args.limit > 0:
+        paths = paths[:args.limit]
+    if not paths:
+        raise ValueError(f"No JPEG frames found in {args.frames}")
+
+    with open(args.roi, "r") as file:
+        roi = ObstacleRoi.from_param(yaml.safe_load(file))
+    names, threshold = load_network_params(args.network_param_file)
+    print(f"{len(paths)} frames, crop {roi.crop}, input size {roi.input_size}, threshold {threshold}")
+
+    crop_detector = YoloDetector(args.cfg, args.weights, roi.input_size, threshold=threshold, threads=args.threads)
+    frame_width, frame_height = roi.frame_size
+    full_detector = YoloDetector(args.full_frame_cfg, args.weights, (416, 416), threshold=threshold, threads=args.threads)
+    darknet = None
+    if args.darknet_lib:
+        darknet, net, meta = load_darknet(args.darknet_lib, args.cfg, args.weights, args.darknet_data)
+
+    timings = {"opencv roi": [], "opencv full frame": [], "darknet roi": []}
+    obstacles = {key: 0 for key in timings}
+    matched = 0
+    total = 0
+    x_offset, y_offset, x_max, y_max = roi.crop
+    for index, path in enumerate(paths):
+        # The first frame warms up the networks and is not timed
+        start = time.perf_counter()
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if (image.shape[1], image.shape[0]) != (frame_width, frame_height):
+            raise ValueError(f"{path} is {image.shape[1]}x{image.shape[0]}, the roi expects {frame_width}x{frame_height}")
+        crop_detections = crop_detector.detect(image[y_offset:y_max, x_offset:x_max])
+        crop_time = time.perf_counter() - start
+        crop_boxes = [(d["class_id"], np.array([d["xmin"] + x_offset, d["ymin"] + y_offset, d["xmax"] + x_offset, d["ymax"] + y_offset]))
+                      for d in crop_detections]
+
+        start = time.perf_counter()
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        full_detections = full_detector.detect(image)
+        full_time = time.perf_counter() - start
+        full_boxes = [(d["class_id"], np.array([d["xmin"], d["ymin"], d["xmax"], d["ymax"]])) for d in full_detections]
+
+        darknet_boxes = []
+        if darknet is not None:
+            start = time.perf_counter()
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            result = darknet.detect_array(net, meta, image[y_offset:y_max, x_offset:x_max], thresh=threshold, bgr=True)
+            darknet_time = time.perf_counter() - start
+            for name, _, (x, y, w, h) in result:
+                if name in names:
+                    x, y = x + x_offset, y + y_offset
+                    darknet_boxes.append((names.index(name), np.array([x - w / 2, y - h / 2, x + w / 2, y + h / 2])))
+
+        if index == 0:
+            continue
+        timings["opencv roi"].append(crop_time)
+        timings["opencv full frame"].append(full_time)
+        if darknet is not None:
+            timings["darknet roi"].append(darknet_time)
+        for key, boxes in (("opencv roi", crop_boxes), ("opencv full frame", full_boxes), ("darknet roi", darknet_boxes)):
+            obstacles[key] += any(roi.is_obstacle(*box) for _, box in boxes)
+
+        # Boxes that matter for the verdict: the darknet boxes, or the full frame boxes without darknet,
+        # inside the obstacle region should be found by the OpenCV backend on the crop too
+        reference = darknet_boxes if darknet is not None else full_boxes
+        for class_id, box in reference:
+            if not roi.is_obstacle(*box):
+                continue
+            total += 1
+            matched += any(class_id == other_id and box_iou(box, other) >= 0.5 for other_id, other in crop_boxes)
+
+    frames = len(paths) - 1
+    for key, values in timings.items():
+        if not values:
+            continue
+        values = np.array(values) * 1000
+        print(f"{key:20s} mean {values.mean():6.1f} ms, p95 {np.percentile(values, 95):6.1f} ms, "
+              f"{1000 / values.mean():5.1f} fps, obstacle in {obstacles[key]}/{frames} frames")
+    reference_name = "darknet roi" if darknet is not None else "opencv full frame"
+    if total:
+        print(f"{matched}/{total} obstacle boxes of {reference_name} found by opencv roi (IoU >= 0.5)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,43 @@
 #!/usr/bin/env python3
 
 # This node converts BGR images to RGB images to feed YOLO-ROS.
+# By default it publishes an uncompressed sensor_msgs/Image with encoding rgb8, so YOLO-ROS
+# gets the pixels without a second JPEG round trip. Optionally the frame is cropped and
+# downscaled to the network input size before publishing.
+# A motion gate skips frames in which neither the robot moved nor the obstacle region changed,
+# every forwarded frame is announced on bgr2rgb_node/forwarded.
 import rospy
 import numpy as np
 import cv2
-from sensor_msgs.msg import CompressedImage
+from sensor_msgs.msg import CompressedImage, Image
+from std_msgs.msg import Header
+from duckietown_msgs.msg import WheelEncoderStamped
+from frame_bus.frame_ring import FrameBusReader, default_ring_name
+from frame_bus.compressed_fallback import CompressedFallback, latest_frame
+from roi import ObstacleRoi
+from motion_gate import MotionGate
+from typing import List, Optional, Tuple
 import os
 
 class BGR2RGBNode:
     conversion_rate: int
+    output_format: str # "raw" or "compressed"
+    crop: Optional[List[int]] # [x_min, y_min, x_max, y_max] in full frame pixels
+    output_size: Optional[Tuple[int, int]] # (width, height)
+    roi: Optional[ObstacleRoi]
+    resized_buffer: Optional[np.ndarray]
+    rgb_buffer: Optional[np.ndarray]
 
-    image_sub: rospy.Subscriber
-    last_image: CompressedImage
+    fallback: CompressedFallback
+    frame_bus: Optional[FrameBusReader]
+
+    motion_gate: Optional[MotionGate]
+    gate_region: Optional[List[int]] # [x_min, y_min, x_max, y_max] in full frame pixels
+    left_ticks: Optional[int]
+    right_ticks: Optional[int]
+    processed_frames: int
+    forwarded_frames: int
+    forwarded_pub: rospy.Publisher
 
     def __init__(self):
         self.node_name = rospy.get_name()
@@ -24,49 +50,167 @@ class BGR2RGBNode:
 
         self.conversion_rate = 5 # Hz
 
-        self.last_image = None
-        self.image_sub = rospy.Subscriber(
-            f"/{self.robot_name}/camera_node/image/compressed",
-            CompressedImage,
-            self._image_callback
-        )
-        self.image_pub = rospy.Publisher(
-            f"/{self.robot_name}/bgr2rgb_node/image/compressed",
-            CompressedImage,
-            queue_size=1
-        )
+        self.output_format = rospy.get_param("~output_format", "raw")
+        if self.output_format not in ("raw", "compressed"):
+            raise ValueError(f"[{self.node_name}] ~output_format must be raw or compressed, got {self.output_format}")
+        # Empty crop and output size 0 keep the full frame
+        self.crop = list(rospy.get_param("~crop", [])) or None
+        if self.crop is not None and len(self.crop) != 4:
+            raise ValueError(f"[{self.node_name}] ~crop must be [x_min, y_min, x_max, y_max], got {self.crop}")
+        output_width = int(rospy.get_param("~output_width", 0))
+        output_height = int(rospy.get_param("~output_height", 0))
+        self.output_size = (output_width, output_height) if output_width > 0 and output_height > 0 else None
+        # The obstacle region overrides both, obstacle_detection_node maps the boxes back with its crop and size.
+        # YOLO only sees the region the obstacle check looks at, or the full frame with crop_input false.
+        self.roi = None
+        roi_param = rospy.get_param(f"/{self.robot_name}/obstacle_roi", None)
+        if roi_param is not None:
+            self.roi = ObstacleRoi.from_param(roi_param)
+            if self.crop is not None or self.output_size is not None:
+                rospy.logwarn(f"[{self.node_name}] /{self.robot_name}/obstacle_roi is set, ignoring ~crop and the output size")
+            self.crop = self.roi.crop if self.roi.crop_input else None
+            self.output_size = self.roi.output_size if self.roi.crop_input else None
+        rospy.loginfo(f"[{self.node_name}] Output format: {self.output_format}, crop: {self.crop}, output size: {self.output_size}")
+        # Allocated on the first frame and reused, the frame size is not known before
+        self.resized_buffer = None
+        self.rgb_buffer = None
+
+        # Decoded frames from the frame bus node if it runs, the compressed images are only decoded here without it
+        self.frame_bus = None
+        if rospy.get_param("~use_frame_bus", True):
+            self.frame_bus = FrameBusReader(rospy.get_param("~frame_bus_ring_name", default_ring_name(self.robot_name)))
+        rospy.loginfo(f"[{self.node_name}] Use frame bus: {self.frame_bus is not None}")
+
+        # Skip frames without motion or scene change, a frame is forwarded at least every max_skip_interval
+        self.motion_gate = None
+        self.gate_region = self.roi.roi if self.roi is not None else self.crop
+        self.left_ticks = None
+        self.right_ticks = None
+        if rospy.get_param("~motion_gate", True):
+            self.motion_gate = MotionGate(diff_threshold=float(rospy.get_param("~gate_diff_threshold", 4.0)),
+                                          tick_threshold=int(rospy.get_param("~gate_tick_threshold", 10)),
+                                          max_skip_interval=float(rospy.get_param("~max_skip_interval", 1.0)),
+                                          downsample=int(rospy.get_param("~gate_downsample", 8)))
+            self.left_wheel_encoder_sub = rospy.Subscriber(f"/{self.robot_name}/left_wheel_encoder_node/tick", WheelEncoderStamped, self._left_wheel_encoder_callback)
+            self.right_wheel_encoder_sub = rospy.Subscriber(f"/{self.robot_name}/right_wheel_encoder_node/tick", WheelEncoderStamped, self._right_wheel_encoder_callback)
+            rospy.loginfo(f"[{self.node_name}] Motion gate on region {self.gate_region}, max skip interval: {self.motion_gate.max_skip_interval} s")
+        self.processed_frames = 0
+        self.forwarded_frames = 0
+        # Capture stamp of every forwarded frame, obstacle_detection_node waits for YOLO's answer to it
+        self.forwarded_pub = rospy.Publisher(f"/{self.robot_name}/bgr2rgb_node/forwarded", Header, queue_size=1)
+
+        # Only subscribed while the frame bus is not available
+        self.fallback = CompressedFallback(f"/{self.robot_name}/camera_node/image/compressed")
+        # Same base topic for both formats, image_transport in YOLO-ROS picks raw or compressed
+        if self.output_format == "raw":
+            self.image_pub = rospy.Publisher(
+                f"/{self.robot_name}/bgr2rgb_node/image",
+                Image,
+                queue_size=1
+            )
+        else:
+            self.image_pub = rospy.Publisher(
+                f"/{self.robot_name}/bgr2rgb_node/image/compressed",
+                CompressedImage,
+                queue_size=1
+            )
 
         self.timer = rospy.Timer(rospy.Duration(1/self.conversion_rate), self._process_latest_image)
 
-    def _image_callback(self, image_msg: CompressedImage):
-        self.last_image = image_msg
+    def _left_wheel_encoder_callback(self, msg: WheelEncoderStamped) -> None:
+        self.left_ticks = msg.data
+
+    def _right_wheel_encoder_callback(self, msg: WheelEncoderStamped) -> None:
+        self.right_ticks = msg.data
+
+    def _gate(self, bgr_image: np.ndarray) -> bool:
+        # True if the frame should go to YOLO
+        self.processed_frames += 1
+        if self.motion_gate is None:
+            return True
+        region = bgr_image
+        if self.gate_region is not None:
+            x_min, y_min, x_max, y_max = self.gate_region
+            region = bgr_image[y_min:y_max, x_min:x_max]
+        ticks = (self.left_ticks, self.right_ticks) if self.left_ticks is not None and self.right_ticks is not None else None
+        reason = self.motion_gate.check(region, ticks, rospy.get_time())
+        if reason is None:
+            return False
+        rospy.logdebug(f"[{self.node_name}] Forwarding frame: {reason}")
+        rospy.loginfo_throttle(30, f"[{self.node_name}] Forwarded {self.forwarded_frames + 1} of {self.processed_frames} frames")
+        return True
+
+    def _convert(self, bgr_image: np.ndarray) -> np.ndarray:
+        # Crop (a view), downscale and swap the channels into the preallocated buffers
+        if self.roi is not None and (bgr_image.shape[1], bgr_image.shape[0]) != self.roi.frame_size:
+            rospy.logwarn_once(f"[{self.node_name}] Frame size {bgr_image.shape[1]}x{bgr_image.shape[0]} differs from "
+                               f"frame_size {self.roi.frame_size} of the obstacle roi, the boxes will be off")
+        if self.crop is not None:
+            x_min, y_min, x_max, y_max = self.crop
+            bgr_image = bgr_image[y_min:y_max, x_min:x_max]
+        if self.output_size is not None:
+            if self.resized_buffer is None:
+                self.resized_buffer = np.empty((self.output_size[1], self.output_size[0], 3), np.uint8)
+            cv2.resize(bgr_image, self.output_size, dst=self.resized_buffer, interpolation=cv2.INTER_AREA)
+            bgr_image = self.resized_buffer
+        if self.rgb_buffer is None or self.rgb_buffer.shape != bgr_image.shape:
+            self.rgb_buffer = np.empty(bgr_image.shape, np.uint8)
+        cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB, dst=self.rgb_buffer)
+        return self.rgb_buffer
 
     def _process_latest_image(self, event):
-        if self.last_image is None:
+        frame, image_msg = latest_frame(self.frame_bus, self.fallback)
+        if frame is None and image_msg is None:
             return # No image to process yet
-        image_msg = self.last_image
         try:
-            # Decode the compressed image
-            np_arr = np.frombuffer(image_msg.data, np.uint8)
-            bgr_image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+            if frame is not None:
+                if not self._gate(frame.image):
+                    return
+                # The conversion copies the frame out of the ring
+                rgb_image = self._convert(frame.image)
+                if not self.frame_bus.is_valid(frame):
+                    rospy.logwarn(f"[{self.node_name}] Frame {frame.seq} was overwritten during conversion, skipping it")
+                    return
+                stamp = rospy.Time.from_sec(frame.stamp)
+                frame_id = f"/{self.robot_name}/camera_frame"
+            else:
+                # Decode the compressed image
+                np_arr = np.frombuffer(image_msg.data, np.uint8)
+                bgr_image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
 
-            if bgr_image is None:
-                rospy.logerr(f"[{self.node_name}] Failed to decode image!")
-                return
+                if bgr_image is None:
+                    rospy.logerr(f"[{self.node_name}] Failed to decode image!")
+                    return
 
-            # Convert BGR to RGB
-            rgb_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
+                if not self._gate(bgr_image):
+                    return
+                rgb_image = self._convert(bgr_image)
+                stamp = image_msg.header.stamp
+                frame_id = image_msg.header.frame_id
 
-            # Re-encode the image
-            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
-            _, encoded_image = cv2.imencode('.jpeg', rgb_image, encode_param)
-            rgb_image_msg = CompressedImage()
-            rgb_image_msg.header = image_msg.header
-            rgb_image_msg.format = "jpeg"
-            rgb_image_msg.data = encoded_image.tobytes()
+            if self.output_format == "raw":
+                rgb_image_msg = Image()
+                rgb_image_msg.header.stamp = stamp
+                rgb_image_msg.header.frame_id = frame_id
+                rgb_image_msg.height, rgb_image_msg.width = rgb_image.shape[:2]
+                rgb_image_msg.encoding = "rgb8"
+                rgb_image_msg.is_bigendian = 0
+                rgb_image_msg.step = rgb_image.shape[1] * 3
+                rgb_image_msg.data = rgb_image.tobytes()
+            else:
+                # Re-encode the image
+                encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
+                _, encoded_image = cv2.imencode('.jpeg', rgb_image, encode_param)
+                rgb_image_msg = CompressedImage()
+                rgb_image_msg.header.stamp = stamp
+                rgb_image_msg.header.frame_id = frame_id
+                rgb_image_msg.format = "jpeg"
+                rgb_image_msg.data = encoded_image.tobytes()
 
             # Publish the RGB image
             self.image_pub.publish(rgb_image_msg)
+            self.forwarded_frames += 1
+            self.forwarded_pub.publish(rgb_image_msg.header)
         except Exception as e:
             rospy.logerr(f"[{self.node_name}] Error processing image: {e}")
 
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Decides which frames are worth running YOLO on, no ROS needed.
+# A frame is forwarded if the wheels moved, if the scene in the obstacle region changed
+# compared to the last forwarded frame, or if the last forwarded frame is too old.
+import cv2
+import numpy as np
+from typing import Optional, Tuple
+
+
+class MotionGate:
+    diff_threshold: float # mean absolute gray value difference, 0..255
+    tick_threshold: int # sum of both wheels' encoder ticks
+    max_skip_interval: float # [s]
+    downsample: int
+    reference: Optional[np.ndarray] # thumbnail of the last forwarded frame
+    reference_ticks: Optional[Tuple[int, int]]
+    last_forward_time: float
+
+    def __init__(self, diff_threshold: float, tick_threshold: int, max_skip_interval: float, downsample: int = 8) -> None:
+        self.diff_threshold = diff_threshold
+        self.tick_threshold = tick_threshold
+        self.max_skip_interval = max_skip_interval
+        self.downsample = downsample
+        self.reference = None
+        self.reference_ticks = None
+        self.last_forward_time = -float('inf')
+
+    def _thumbnail(self, image: np.ndarray) -> np.ndarray:
+        size = (max(image.shape[1] // self.downsample, 1), max(image.shape[0] // self.downsample, 1))
+        return cv2.cvtColor(cv2.resize(image, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+    def check(self, image: np.ndarray, ticks: Optional[Tuple[int, int]], now: float) -> Optional[str]:
+        # Reason to forward the BGR image ("first", "timeout", "motion", "scene"), None to skip it.
+        # A forwarded image becomes the new reference.
+        reason = None
+        if self.reference is None:
+            reason = "first"
+        elif now - self.last_forward_time >= self.max_skip_interval:
+            reason = "timeout"
+        elif ticks is not None and self.reference_ticks is not None and \
+                abs(ticks[0] - self.reference_ticks[0]) + abs(ticks[1] - self.reference_ticks[1]) >= self.tick_threshold:
+            reason = "motion"
+
+        thumbnail = self._thumbnail(image)
+        if reason is None:
+            if thumbnail.shape != self.reference.shape or \
+                    cv2.mean(cv2.absdiff(thumbnail, self.reference))[0] >= self.diff_threshold:
+                reason = "scene"
+            else:
+                return None
+
+        self.reference = thumbnail
+        self.reference_ticks = ticks
+        self.last_forward_time = now
+        return reason
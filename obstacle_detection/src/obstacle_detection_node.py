@@ -2,24 +2,56 @@
 
 # This nodes subscribes to the darknet_ros/bounding_boxes topic 
 # and publishes if there is an obstacle in front of the Duckiebot.
+# The stamp of the published message is the capture time of the frame the verdict is based on.
+# With backend opencv, YOLO runs in this node on the CPU instead of in darknet_ros.
 import rospy
 import os
-from darknet_ros_msgs.msg import BoundingBoxes
-from duckietown_msgs.msg import BoolStamped
+import cv2
+import numpy as np
+from darknet_ros_msgs.msg import BoundingBox, BoundingBoxes
+from duckietown_msgs.msg import BoolStamped, WheelEncoderStamped
+from std_msgs.msg import Header
+from frame_bus.frame_ring import FrameBusReader, default_ring_name
+from frame_bus.compressed_fallback import CompressedFallback, latest_frame
+from roi import ObstacleRoi
+from motion_gate import MotionGate
+from yolo_detector import YoloDetector, load_network_params
+from typing import List, Optional
 
 
 class ObstacleDetectionNode:
     node_name: str
     robot_name: str
 
+    roi: ObstacleRoi
     obstacle_detected: bool
+    verdict_stamp: rospy.Time # capture time of the frame behind obstacle_detected
     conversion_rate: int
     noMessageTime: float
+    box_timeout: float
+    max_verdict_age: float
+    last_forwarded_stamp: rospy.Time
+    last_forwarded_time: float
+
+    backend: str # "darknet_ros" or "opencv"
 
     boundingbox_sub: rospy.Subscriber
+    forwarded_sub: rospy.Subscriber
     obstacle_detected_pub: rospy.Publisher
     timer: rospy.Timer
 
+    # opencv backend
+    detector: YoloDetector
+    class_names: List[str]
+    detection_rate: float
+    frame_bus: Optional[FrameBusReader]
+    fallback: CompressedFallback
+    motion_gate: Optional[MotionGate]
+    left_ticks: Optional[int]
+    right_ticks: Optional[int]
+    boundingbox_pub: rospy.Publisher
+    detection_timer: rospy.Timer
+
     def __init__(self) -> None:
         self.node_name = rospy.get_name()
         rospy.loginfo(f"[{self.node_name}] Initializing {self.node_name} node...")
@@ -29,11 +61,34 @@ class ObstacleDetectionNode:
             raise ValueError("$VEHICLE_NAME is not set, export it first.")
         rospy.loginfo(f"[{self.node_name}] Robot name: {self.robot_name}")
 
+        # Same region as bgr2rgb_node, the boxes are in pixels of its (cropped) image
+        roi_param = rospy.get_param(f"/{self.robot_name}/obstacle_roi", None)
+        if roi_param is None:
+            raise ValueError(f"[{self.node_name}] /{self.robot_name}/obstacle_roi is not set")
+        self.roi = ObstacleRoi.from_param(roi_param)
+        rospy.loginfo(f"[{self.node_name}] Obstacle roi: {self.roi.roi}, YOLO input crop: {self.roi.crop} -> {self.roi.output_size}")
+
         self.obstacle_detected = False
+        self.verdict_stamp = rospy.Time()
         self.conversion_rate = 10 # Hz
         self.noMessageTime = rospy.get_time()
-
-        self.boundingbox_sub = rospy.Subscriber(f"/darknet_ros/bounding_boxes", BoundingBoxes, self._obstacle_detection_callback)
+        # YOLO only publishes boxes if it found something, no boxes within box_timeout after a frame means no obstacle
+        self.box_timeout = float(rospy.get_param("~box_timeout", 0.5)) # [s]
+        # bgr2rgb_node forwards a frame at least every max_skip_interval, older verdicts are reported
+        self.max_verdict_age = float(rospy.get_param("~max_verdict_age", 2.0)) # [s]
+        self.last_forwarded_stamp = None
+        self.last_forwarded_time = None
+
+        self.backend = rospy.get_param("~backend", "darknet_ros")
+        rospy.loginfo(f"[{self.node_name}] Backend: {self.backend}")
+        if self.backend == "darknet_ros":
+            self.boundingbox_sub = rospy.Subscriber(f"/darknet_ros/bounding_boxes", BoundingBoxes, self._obstacle_detection_callback)
+            # Frames sent to YOLO, the motion gate in bgr2rgb_node skips unchanged ones
+            self.forwarded_sub = rospy.Subscriber(f"/{self.robot_name}/bgr2rgb_node/forwarded", Header, self._forwarded_callback, queue_size=1)
+        elif self.backend == "opencv":
+            self._init_opencv_backend()
+        else:
+            raise ValueError(f"[{self.node_name}] ~backend must be darknet_ros or opencv, got {self.backend}")
 
         self.obstacle_detected_pub = rospy.Publisher(f"/{self.robot_name}/obstacle_detection_node/obstacle_detected", BoolStamped, queue_size=1)
         
@@ -41,6 +96,93 @@ class ObstacleDetectionNode:
         self.timer = rospy.Timer(rospy.Duration(1/self.conversion_rate), self._obstacle_detection_publish)
 
 
+    def _init_opencv_backend(self) -> None:
+        cfg_path = rospy.get_param("~yolo_cfg_path")
+        weights_path = rospy.get_param("~yolo_weights_path")
+        self.class_names, threshold = load_network_params(rospy.get_param("~network_param_file"))
+        threads = int(rospy.get_param("~threads", 0)) # 0 keeps the OpenCV default
+        self.detector = YoloDetector(cfg_path, weights_path, self.roi.input_size, threshold=threshold,
+                                     nms_threshold=float(rospy.get_param("~nms_threshold", 0.4)), threads=threads)
+        rospy.loginfo(f"[{self.node_name}] OpenCV DNN: {cfg_path}, input size: {self.roi.input_size}, threshold: {threshold}, threads: {cv2.getNumThreads()}")
+
+        # Decoded frames from the frame bus node if it runs, the compressed images are only decoded here without it
+        self.frame_bus = None
+        if rospy.get_param("~use_frame_bus", True):
+            self.frame_bus = FrameBusReader(rospy.get_param("~frame_bus_ring_name", default_ring_name(self.robot_name)))
+        self.fallback = CompressedFallback(f"/{self.robot_name}/camera_node/image/compressed")
+
+        # Same gate as bgr2rgb_node in front of darknet_ros
+        self.motion_gate = None
+        self.left_ticks = None
+        self.right_ticks = None
+        if rospy.get_param("~motion_gate", True):
+            self.motion_gate = MotionGate(diff_threshold=float(rospy.get_param("~gate_diff_threshold", 4.0)),
+                                          tick_threshold=int(rospy.get_param("~gate_tick_threshold", 10)),
+                                          max_skip_interval=float(rospy.get_param("~max_skip_interval", 1.0)),
+                                          downsample=int(rospy.get_param("~gate_downsample", 8)))
+            self.left_wheel_encoder_sub = rospy.Subscriber(f"/{self.robot_name}/left_wheel_encoder_node/tick", WheelEncoderStamped, self._left_wheel_encoder_callback)
+            self.right_wheel_encoder_sub = rospy.Subscriber(f"/{self.robot_name}/right_wheel_encoder_node/tick", WheelEncoderStamped, self._right_wheel_encoder_callback)
+
+        # Same content as /darknet_ros/bounding_boxes, in full frame pixels
+        self.boundingbox_pub = rospy.Publisher(f"/{self.robot_name}/obstacle_detection_node/bounding_boxes", BoundingBoxes, queue_size=1)
+        self.detection_rate = float(rospy.get_param("~detection_rate", 5.0)) # Hz
+        self.detection_timer = rospy.Timer(rospy.Duration(1/self.detection_rate), self._detect_latest_image)
+
+    def _left_wheel_encoder_callback(self, msg: WheelEncoderStamped) -> None:
+        self.left_ticks = msg.data
+
+    def _right_wheel_encoder_callback(self, msg: WheelEncoderStamped) -> None:
+        self.right_ticks = msg.data
+
+    def _detect_latest_image(self, event) -> None:
+        frame, image_msg = latest_frame(self.frame_bus, self.fallback)
+        if frame is not None:
+            image = frame.image
+            stamp = rospy.Time.from_sec(frame.stamp)
+        elif image_msg is not None:
+            image = cv2.imdecode(np.frombuffer(image_msg.data, np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                rospy.logerr(f"[{self.node_name}] Failed to decode image!")
+                return
+            stamp = image_msg.header.stamp
+        else:
+            return # No image to process yet
+
+        if self.motion_gate is not None:
+            x_min, y_min, x_max, y_max = self.roi.roi
+            ticks = (self.left_ticks, self.right_ticks) if self.left_ticks is not None and self.right_ticks is not None else None
+            if self.motion_gate.check(image[y_min:y_max, x_min:x_max], ticks, rospy.get_time()) is None:
+                return # Nothing changed, the last verdict stays
+
+        x_offset, y_offset, x_max, y_max = self.roi.crop
+        detections = self.detector.detect(image[y_offset:y_max, x_offset:x_max])
+        if frame is not None and not self.frame_bus.is_valid(frame):
+            rospy.logwarn(f"[{self.node_name}] Frame {frame.seq} was overwritten during detection, skipping it")
+            return
+
+        boxes_msg = BoundingBoxes()
+        boxes_msg.header.stamp = rospy.Time.now()
+        boxes_msg.header.frame_id = "detection"
+        boxes_msg.image_header.stamp = stamp
+        temp_obstacle_detected = False
+        for detection in detections:
+            box = BoundingBox()
+            box.Class = self.class_names[detection["class_id"]]
+            box.id = int(detection["class_id"])
+            box.probability = float(detection["probability"])
+            box.xmin = int(detection["xmin"] + x_offset)
+            box.ymin = int(detection["ymin"] + y_offset)
+            box.xmax = int(detection["xmax"] + x_offset)
+            box.ymax = int(detection["ymax"] + y_offset)
+            boxes_msg.bounding_boxes.append(box)
+            if self.roi.is_obstacle(box.xmin, box.ymin, box.xmax, box.ymax):
+                temp_obstacle_detected = True
+        self.boundingbox_pub.publish(boxes_msg)
+
+        self.obstacle_detected = temp_obstacle_detected
+        self.verdict_stamp = stamp
+        self._publish_verdict()
+
     # if obstacle detected publish 
     def _obstacle_detection_callback(self, msg: BoundingBoxes) -> None:
         
@@ -49,8 +191,8 @@ class ObstacleDetectionNode:
         temp_obstacle_detected = False
 
         for i in range(len(msg.bounding_boxes)):
-            # Y-axis points downwards in image plane -> ymax is closest point of bbox to duckie
-            if msg.bounding_boxes[i].ymax >= 200 and msg.bounding_boxes[i].xmax <= 520 and msg.bounding_boxes[i].xmin >= 120: 
+            box = msg.bounding_boxes[i]
+            if self.roi.is_obstacle(*self.roi.to_full_frame(box.xmin, box.ymin, box.xmax, box.ymax)):
                 #print("Obstacle detected! Stopping the Duckie.")
                 temp_obstacle_detected = True
                 break
@@ -58,18 +200,40 @@ class ObstacleDetectionNode:
                 pass
 
         self.obstacle_detected = temp_obstacle_detected
+        self.verdict_stamp = msg.image_header.stamp
         
         # publish every time callback is called
-        self.obstacle_detected_pub.publish(BoolStamped(header=rospy.Header(), data = self.obstacle_detected))
+        self._publish_verdict()
+
+    def _forwarded_callback(self, msg: Header) -> None:
+        self.last_forwarded_stamp = msg.stamp
+        self.last_forwarded_time = rospy.get_time()
+
+    def _publish_verdict(self) -> None:
+        self.obstacle_detected_pub.publish(BoolStamped(header=rospy.Header(stamp=self.verdict_stamp), data = self.obstacle_detected))
 
     # Necessary because _obstacle_detection_callback is only called when yolo detects obstacle 
     # -> we need to know when there is no obstacle
     def _obstacle_detection_publish(self, event) -> None:
-        # When there is 0.5 seconds no publish from yolo
-        if rospy.get_time() - self.noMessageTime > 0.5:
+        now = rospy.get_time()
+        if self.backend != "darknet_ros":
+            pass # Every detected frame sets the verdict
+        elif self.last_forwarded_stamp is None:
+            # No motion gate info, when there is 0.5 seconds no publish from yolo
+            if now - self.noMessageTime > self.box_timeout:
+                self.obstacle_detected = False
+                self.verdict_stamp = rospy.Time.now()
+        elif self.last_forwarded_stamp > self.verdict_stamp and now - self.last_forwarded_time > self.box_timeout:
+            # YOLO has seen the last forwarded frame and found nothing in it,
+            # skipped frames keep the verdict of the last forwarded one
             self.obstacle_detected = False
+            self.verdict_stamp = self.last_forwarded_stamp
+
+        verdict_age = now - self.verdict_stamp.to_sec()
+        if self.verdict_stamp.to_sec() > 0 and verdict_age > self.max_verdict_age:
+            rospy.logwarn_throttle(5, f"[{self.node_name}] Obstacle verdict is {verdict_age:.1f} s old, is YOLO running?")
 
-        self.obstacle_detected_pub.publish(BoolStamped(header=rospy.Header(), data = self.obstacle_detected))
+        self._publish_verdict()
         
 
 if __name__ == "__main__":
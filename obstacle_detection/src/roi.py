@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Obstacle region of interest, defined once in config/obstacle_roi.yaml.
+# bgr2rgb_node crops and downscales the frame to it before YOLO,
+# obstacle_detection_node maps the boxes back to the full frame and checks them against it.
+from typing import List, Tuple
+
+
+class ObstacleRoi:
+    frame_size: Tuple[int, int] # (width, height)
+    roi: List[int] # [x_min, y_min, x_max, y_max] in full frame pixels
+    crop_input: bool
+    input_size: Tuple[int, int] # (width, height) of the network input
+    crop: List[int] # region sent to YOLO in full frame pixels, the roi plus margin
+    output_size: Tuple[int, int] # (width, height) of the image sent to YOLO
+
+    def __init__(self, frame_size: List[int], roi: List[int], margin: int, input_size: List[int], crop_input: bool = True) -> None:
+        self.frame_size = (int(frame_size[0]), int(frame_size[1]))
+        self.roi = [int(value) for value in roi]
+        self.crop_input = crop_input
+        self.input_size = (int(input_size[0]), int(input_size[1]))
+        width, height = self.frame_size
+        if not crop_input:
+            self.crop = [0, 0, width, height]
+            self.output_size = self.frame_size
+            return
+
+        x_min, y_min, x_max, y_max = self.roi
+        self.crop = [max(x_min - margin, 0), max(y_min - margin, 0), min(x_max + margin, width), min(y_max + margin, height)]
+        crop_width = self.crop[2] - self.crop[0]
+        crop_height = self.crop[3] - self.crop[1]
+        # Keep the aspect ratio, darknet letterboxes the rest of the network input
+        scale = min(input_size[0] / crop_width, input_size[1] / crop_height, 1.0)
+        self.output_size = (round(crop_width * scale), round(crop_height * scale))
+
+    @classmethod
+    def from_param(cls, param: dict) -> "ObstacleRoi":
+        return cls(param["frame_size"], param["roi"], int(param.get("margin", 0)), param["input_size"],
+                   bool(param.get("crop_input", True)))
+
+    def to_full_frame(self, x_min: float, y_min: float, x_max: float, y_max: float) -> Tuple[float, float, float, float]:
+        # Box in pixels of the image sent to YOLO -> full frame pixels
+        scale_x = (self.crop[2] - self.crop[0]) / self.output_size[0]
+        scale_y = (self.crop[3] - self.crop[1]) / self.output_size[1]
+        return (x_min * scale_x + self.crop[0], y_min * scale_y + self.crop[1],
+                x_max * scale_x + self.crop[0], y_max * scale_y + self.crop[1])
+
+    def is_obstacle(self, x_min: float, y_min: float, x_max: float, y_max: float) -> bool:
+        # Full frame box. Y-axis points downwards in image plane -> ymax is closest point of bbox to duckie
+        return y_max >= self.roi[1] and x_min >= self.roi[0] and x_max <= self.roi[2]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# In-process YOLO on the CPU with OpenCV DNN, no ROS needed.
+# Loads the darknet cfg/weights of darknet_ros, letterboxes each frame into a preallocated
+# input blob like darknet does and returns the boxes in pixels of the given image.
+import cv2
+import numpy as np
+import yaml
+from typing import List, Tuple
+
+# One row per detection, same content as darknet_ros_msgs/BoundingBox
+DETECTION_DTYPE = np.dtype([("class_id", np.int16), ("probability", np.float32),
+                            ("xmin", np.float32), ("ymin", np.float32), ("xmax", np.float32), ("ymax", np.float32)])
+
+
+def load_network_params(network_param_file: str) -> Tuple[List[str], float]:
+    # Class names and threshold from a darknet_ros network yaml, e.g. config/yolov3-tiny.yaml
+    with open(network_param_file, "r") as file:
+        model = yaml.safe_load(file)["yolo_model"]
+    return model["detection_classes"]["names"], float(model["threshold"]["value"])
+
+
+class YoloDetector:
+    input_size: Tuple[int, int] # (width, height) of the network input
+    threshold: float
+    nms_threshold: float
+    net: cv2.dnn.Net
+    output_names: List[str]
+    canvas: np.ndarray # letterboxed BGR image, reused
+    blob: np.ndarray # network input, NCHW float32 RGB, reused
+    letterbox_geometry: Tuple[int, int, int, int] # (x, y, width, height) of the image on the canvas
+
+    def __init__(self, cfg_path: str, weights_path: str, input_size: Tuple[int, int], threshold: float = 0.3,
+                 nms_threshold: float = 0.4, threads: int = 0) -> None:
+        self.input_size = (int(input_size[0]), int(input_size[1]))
+        self.threshold = threshold
+        self.nms_threshold = nms_threshold
+        if threads > 0:
+            cv2.setNumThreads(threads)
+
+        self.net = cv2.dnn.readNetFromDarknet(cfg_path, weights_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.output_names = list(self.net.getUnconnectedOutLayersNames())
+
+        width, height = self.input_size
+        self.canvas = np.empty((height, width, 3), np.uint8)
+        self.blob = np.empty((1, 3, height, width), np.float32)
+        self.letterbox_geometry = (-1, -1, -1, -1)
+
+    def _letterbox(self, image: np.ndarray) -> Tuple[float, int, int]:
+        # Resizes the BGR image into the canvas keeping the aspect ratio, returns (scale, x offset, y offset)
+        width, height = self.input_size
+        scale = min(width / image.shape[1], height / image.shape[0])
+        new_width, new_height = round(image.shape[1] * scale), round(image.shape[0] * scale)
+        x, y = (width - new_width) // 2, (height - new_height) // 2
+        if (x, y, new_width, new_height) != self.letterbox_geometry:
+            self.canvas[:] = 127 # darknet pads with 0.5
+            self.letterbox_geometry = (x, y, new_width, new_height)
+        cv2.resize(image, (new_width, new_height), dst=self.canvas[y:y + new_height, x:x + new_width],
+                   interpolation=cv2.INTER_LINEAR)
+        return scale, x, y
+
+    def detect(self, image: np.ndarray) -> np.ndarray:
+        # BGR image -> DETECTION_DTYPE array in image pixels, one row per box and class above the threshold
+        scale, x_offset, y_offset = self._letterbox(image)
+        # BGR -> RGB, HWC -> CHW and 0..255 -> 0..1 in one pass into the reused blob
+        np.multiply(self.canvas[:, :, ::-1].transpose(2, 0, 1), np.float32(1 / 255), out=self.blob[0])
+        self.net.setInput(self.blob)
+        outputs = np.concatenate(self.net.forward(self.output_names))
+
+        # Rows [cx, cy, w, h, objectness, class scores...], the class scores already include the objectness
+        rows, class_ids = np.nonzero(outputs[:, 5:] > self.threshold)
+        if len(rows) == 0:
+            return np.empty(0, DETECTION_DTYPE)
+        probabilities = outputs[rows, 5 + class_ids]
+        width, height = self.input_size
+        centers = outputs[rows, :2] * (width, height)
+        sizes = outputs[rows, 2:4] * (width, height)
+        top_left = (centers - sizes / 2 - (x_offset, y_offset)) / scale
+        bottom_right = (centers + sizes / 2 - (x_offset, y_offset)) / scale
+
+        # Per class NMS in one call, boxes of different classes are shifted apart so they never overlap
+        shift = (class_ids * (max(image.shape[:2]) + 1))[:, None]
+        nms_boxes = np.hstack([top_left + shift, bottom_right - top_left])
+        keep = np.array(cv2.dnn.NMSBoxes(nms_boxes.tolist(), probabilities.tolist(), self.threshold, self.nms_threshold),
+                        dtype=np.int64).reshape(-1)
+
+        detections = np.empty(len(keep), DETECTION_DTYPE)
+        detections["class_id"] = class_ids[keep]
+        detections["probability"] = probabilities[keep]
+        detections["xmin"] = np.clip(top_left[keep, 0], 0, image.shape[1])
+        detections["ymin"] = np.clip(top_left[keep, 1], 0, image.shape[0])
+        detections["xmax"] = np.clip(bottom_right[keep, 0], 0, image.shape[1])
+        detections["ymax"] = np.clip(bottom_right[keep, 1], 0, image.shape[0])
+        return detections[np.argsort(-detections["probability"])]
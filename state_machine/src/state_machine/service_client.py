@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Persistent service client: one TCP connection reused for every call instead of one per call.
+import rospy
+import threading
+from typing import Any, Optional
+
+# rospy reports a lost or refused connection with these, errors raised by the handler look different
+TRANSPORT_ERRORS = ("unable to connect", "transport error")
+
+
+class PersistentServiceClient:
+    name: str
+    service_class: Any
+    reconnect_timeout: Optional[float]
+    proxy: rospy.ServiceProxy
+    lock: threading.Lock
+
+    def __init__(self, name: str, service_class: Any, reconnect_timeout: Optional[float] = None) -> None:
+        self.name = name
+        self.service_class = service_class
+        self.reconnect_timeout = reconnect_timeout
+        self.proxy = rospy.ServiceProxy(name, service_class, persistent=True)
+        self.lock = threading.Lock()
+
+    def __call__(self, request: Any) -> Any:
+        with self.lock:
+            try:
+                return self.proxy(request)
+            except rospy.ServiceException as e:
+                if not str(e).startswith(TRANSPORT_ERRORS):
+                    raise
+                # The server went away, e.g. restarted, the old connection is dead for good
+                rospy.logwarn(f"Lost connection to {self.name} ({e}), reconnecting...")
+                self._reconnect()
+                return self.proxy(request)
+
+    def _reconnect(self) -> None:
+        self.proxy.close()
+        rospy.wait_for_service(self.name, timeout=self.reconnect_timeout)
+        self.proxy = rospy.ServiceProxy(self.name, self.service_class, persistent=True)
+
+    def close(self) -> None:
+        with self.lock:
+            self.proxy.close()
@@ -4,15 +4,19 @@
 import rospy
 import numpy as np
 import ast
-from typing import Tuple, Dict, List
+import json
+from typing import Any, Callable, Tuple, Dict, List, Optional
 import os
+import threading
 from planner.map_utils import Command, StreetDirection
 from enum import Enum
-from std_msgs.msg import Int32
+from std_msgs.msg import Int32, String
 from planner.srv import PlannerService, PlannerServiceRequest
-from apriltag_detection.msg import ApriltagMsg
+from apriltag_detection.msg import ApriltagDistanceMsg
 from turning.srv import TurnService, TurnServiceRequest
 from turning.turn_service import TurnDirection
+from state_machine.service_client import PersistentServiceClient
+from state_machine.transition_trace import TransitionRecord, TransitionTrace, Trigger
 from duckietown_msgs.msg import BoolStamped
 
 class State(Enum):
@@ -24,8 +28,58 @@ class State(Enum):
     STOP = 6
     OBSTACLE_AVOIDANCE = 7
 
+class Event(Enum):
+    PLAN_READY = 1 # plan received, not in front of a crossing
+    GOAL_TAG = 2 # goal tag closer than TAG_STOP_DIST
+    OBSTACLE = 3
+    OBSTACLE_CLEARED = 4
+    TURN_DONE = 5
+    CROSSING_FORWARD = 6 # crossing tag closer than TAG_STOP_DIST, named after the planned command
+    CROSSING_LEFT = 7
+    CROSSING_RIGHT = 8
+    CROSSING_UTURN = 9
+
 TAG_STOP_DIST = 0.3
 
+CROSSING_EVENTS = {
+    Command.FORWARD: Event.CROSSING_FORWARD,
+    Command.LEFT: Event.CROSSING_LEFT,
+    Command.RIGHT: Event.CROSSING_RIGHT,
+    Command.UTURN: Event.CROSSING_UTURN,
+}
+
+CROSSING_STATES = {
+    Event.CROSSING_FORWARD: State.LANE_FOLLOW,
+    Event.CROSSING_LEFT: State.TURN_LEFT,
+    Event.CROSSING_RIGHT: State.TURN_RIGHT,
+    Event.CROSSING_UTURN: State.TURN_U,
+}
+
+# (state, event) -> next state, pairs that are not listed are invalid
+TRANSITIONS = {
+    (State.WAIT_FOR_PLAN, Event.PLAN_READY): State.LANE_FOLLOW,
+    (State.WAIT_FOR_PLAN, Event.GOAL_TAG): State.STOP,
+    (State.LANE_FOLLOW, Event.GOAL_TAG): State.STOP,
+    (State.LANE_FOLLOW, Event.OBSTACLE): State.OBSTACLE_AVOIDANCE,
+    (State.TURN_LEFT, Event.TURN_DONE): State.LANE_FOLLOW,
+    (State.TURN_RIGHT, Event.TURN_DONE): State.LANE_FOLLOW,
+    (State.TURN_U, Event.TURN_DONE): State.LANE_FOLLOW,
+    (State.OBSTACLE_AVOIDANCE, Event.OBSTACLE_CLEARED): State.LANE_FOLLOW,
+}
+TRANSITIONS.update({(state, event): next_state for state in (State.WAIT_FOR_PLAN, State.LANE_FOLLOW)
+                    for event, next_state in CROSSING_STATES.items()})
+
+# Turn service request made in each state
+TURN_DIRECTIONS = {
+    State.TURN_LEFT: TurnDirection.LEFT,
+    State.TURN_RIGHT: TurnDirection.RIGHT,
+    State.TURN_U: TurnDirection.U,
+    State.OBSTACLE_AVOIDANCE: TurnDirection.STOP,
+}
+
+def _stamp(msg) -> Optional[float]:
+    return None if msg.header.stamp.is_zero() else msg.header.stamp.to_sec()
+
 class StateMachineNode:
     node_name: str
     robot_name: str
@@ -40,8 +94,38 @@ class StateMachineNode:
     goal_tag_id: int
     obstacle_detected: bool
 
+    # Guards the fields set by the callbacks, notified on every update
+    condition: threading.Condition
+    update_seq: int
+    seen_seq: int
+    tag_trigger: Trigger
+    obstacle_trigger: Trigger
+    # Keeps the keepalive from publishing a state that was just replaced
+    state_lock: threading.Lock
+
+    # Last lane following controller state and how many were received, guarded by condition
+    lane_following: bool
+    lane_following_seq: int
+    # lane_following_seq when the state last changed, newer messages reflect the new state
+    lane_following_seq_at_change: int
+
+    trace: TransitionTrace
+    trace_file: str
+    # Transition into a turn state, finished when the turn service is called
+    pending_record: Optional[TransitionRecord]
+
+    plan_request: PlannerServiceRequest
+    # Requested during startup, None if that failed
+    plan_response: Optional[Any]
+
+    planner_service: PersistentServiceClient
+    turn_service: PersistentServiceClient
+
     state_pub: rospy.Publisher
+    trace_pub: rospy.Publisher
     apriltag_sub: rospy.Subscriber
+    lane_following_sub: rospy.Subscriber
+    keepalive_timer: rospy.Timer
 
     def __init__(self) -> None:
         self.node_name = rospy.get_name()
@@ -66,190 +150,322 @@ class StateMachineNode:
         self.plan = []
         self.crossings_already_passed = []
 
+        self.condition = threading.Condition()
+        self.update_seq = 0
+        self.seen_seq = -1
+        self.tag_trigger = None
+        self.obstacle_trigger = None
+        self.state_lock = threading.Lock()
+        self.lane_following = False
+        self.lane_following_seq = 0
+        self.lane_following_seq_at_change = 0
+
+        # The state is published on every change, and at the keepalive rate for late subscribers
         self.state_pub = rospy.Publisher(f"/{self.robot_name}/state_machine_node/state", Int32, queue_size=1)
+        keepalive_rate = float(rospy.get_param("~keepalive_rate", 1.0)) # Hz
+        self.keepalive_timer = rospy.Timer(rospy.Duration(1 / keepalive_rate), self._keepalive_cb)
+        rospy.on_shutdown(self._notify_shutdown)
 
-        self.apriltag_sub = rospy.Subscriber(f"/{self.robot_name}/apriltag_detection_node/tag_info", ApriltagMsg, self._apriltag_cb, queue_size=1)
+        # Every transition with its trigger and latencies, as JSON
+        self.trace = TransitionTrace(int(rospy.get_param("~trace_size", 200)))
+        self.trace_file = rospy.get_param("~trace_file", "")
+        self.pending_record = None
+        self.trace_pub = rospy.Publisher(f"/{self.robot_name}/state_machine_node/transition_trace", String, queue_size=10)
+        rospy.on_shutdown(self._save_trace)
+
+        # Filtered tag distance, predicted between the (slower) detections
+        self.apriltag_sub = rospy.Subscriber(f"/{self.robot_name}/apriltag_detection_node/tag_distance", ApriltagDistanceMsg, self._apriltag_cb, queue_size=1)
 
         self.obstacle_detection_sub = rospy.Subscriber(f"/{self.robot_name}/obstacle_detection_node/obstacle_detected", BoolStamped, self._obstacle_detection_cb, queue_size=1)
 
+        self.lane_following_sub = rospy.Subscriber(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped, self._lane_following_cb, queue_size=1)
 
-        # wait for all other services and messages to be ready 
-        # [plan_service, turn_service, apriltag_detection, lane_following_controller, obstacle_detection]
-        rospy.loginfo(f"[{self.node_name}] Waiting for planner service...")
-        rospy.wait_for_service(f"/{self.robot_name}/planner_service")
-        rospy.loginfo(f"[{self.node_name}] Waiting for turn service...")
-        rospy.wait_for_service(f"/{self.robot_name}/turn_service")
-        rospy.loginfo(f"[{self.node_name}] Waiting for apriltag detection message...")
-        rospy.wait_for_message(f"/{self.robot_name}/apriltag_detection_node/tag_info", ApriltagMsg)
-        rospy.loginfo(f"[{self.node_name}] Waiting for lane_following controller signal...")
-        rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-        rospy.loginfo(f"[{self.node_name}] Waiting for obstacle_detection signal...")
-        rospy.wait_for_message(f"/{self.robot_name}/obstacle_detection_node/obstacle_detected", BoolStamped)
-        rospy.loginfo(f"[{self.node_name}] All services and messages are ready.")
+
+        # One connection per service for the whole run
+        reconnect_timeout = float(rospy.get_param("~service_reconnect_timeout", 10.0)) # s
+        self.planner_service = PersistentServiceClient(f"/{self.robot_name}/planner_service", PlannerService, reconnect_timeout)
+        self.turn_service = PersistentServiceClient(f"/{self.robot_name}/turn_service", TurnService, reconnect_timeout)
+        rospy.on_shutdown(self._close_services)
+
+        # The plan is requested as soon as the planner is up, while the other dependencies are still starting
+        self.plan_request = self._plan_request()
+        self.plan_response = None
+        self._wait_for_dependencies()
 
         self._begin_state_machine()
 
-    def _apriltag_cb(self, msg: ApriltagMsg) -> None:
-        # -1 means no tag detected
-        if msg.tag_id == -1:
-            self.closest_tag_dist = None
-            self.closest_tag_id = None
-        else:
-            self.closest_tag_id = msg.tag_id
-            self.closest_tag_dist = msg.tag_pose.pose.position.z
+    def _wait_for_dependencies(self) -> None:
+        # All dependencies are probed at the same time, so startup takes as long as the slowest one instead of the sum.
+        # The node waits for all of them as before, a dependency slower than its timeout (~startup_timeouts/<name>,
+        # else ~startup_timeout, 0 never) only logs the startup report so far.
+        default_timeout = float(rospy.get_param("~startup_timeout", 0.0)) # s
+        timeouts = rospy.get_param("~startup_timeouts", {})
+        probes = {
+            "planner_service": lambda timeout: self._probe_service("planner_service", timeout, self._request_plan_early),
+            "turn_service": lambda timeout: self._probe_service("turn_service", timeout),
+            "tag_distance": lambda timeout: self._probe_message(lambda: self.tag_trigger is not None, timeout),
+            "lane_following_state": lambda timeout: self._probe_message(lambda: self.lane_following_seq > 0, timeout),
+            "obstacle_detected": lambda timeout: self._probe_message(lambda: self.obstacle_trigger is not None, timeout),
+        }
+        rospy.loginfo(f"[{self.node_name}] Waiting for {', '.join(probes)}...")
+        start_time = rospy.get_time()
+        ready_times = {}
+
+        def run(name: str, probe: Callable[[Optional[float]], bool]) -> None:
+            timeout = float(timeouts.get(name, default_timeout))
+            if timeout > 0 and not probe(timeout):
+                if rospy.is_shutdown():
+                    return
+                rospy.logwarn(f"[{self.node_name}] {name} not ready after {timeout:g} s, still waiting. "
+                              f"Startup report: {report()}")
+            if probe(None):
+                ready_times[name] = rospy.get_time() - start_time
+
+        def report() -> str:
+            # Slowest dependency last, the probe threads may add to ready_times meanwhile
+            times = dict(ready_times)
+            ready = [f"{name} {times[name]:.2f} s" for name in sorted(times, key=times.get)]
+            missing = [name for name in probes if name not in times]
+            return f"ready {', '.join(ready) or 'none'}" + (f"; NOT ready: {', '.join(missing)}" if missing else "")
+
+        threads = [threading.Thread(target=run, args=item, daemon=True) for item in probes.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(ready_times) < len(probes):
+            # Only left early on shutdown
+            raise rospy.ROSInterruptException(f"[{self.node_name}] Shut down during startup: {report()}")
+        rospy.loginfo(f"[{self.node_name}] Startup report: {report()}")
+        rospy.loginfo(f"[{self.node_name}] All services and messages are ready.")
+
+    def _probe_service(self, name: str, timeout: Optional[float], on_ready: Optional[Callable[[], None]] = None) -> bool:
+        try:
+            rospy.wait_for_service(f"/{self.robot_name}/{name}", timeout=timeout)
+        except rospy.ROSException:
+            return False
+        if on_ready is not None:
+            on_ready()
+        return True
+
+    def _probe_message(self, received: Callable[[], bool], timeout: Optional[float]) -> bool:
+        # The subscribers of the node record the first message, no extra subscriber is needed
+        with self.condition:
+            self.condition.wait_for(lambda: received() or rospy.is_shutdown(), timeout=timeout)
+            return received()
+
+    def _request_plan_early(self) -> None:
+        rospy.loginfo(f"[{self.node_name}] Requesting plan from planner service...")
+        try:
+            self.plan_response = self.planner_service(self.plan_request)
+        except rospy.ServiceException as e:
+            # Requested again in WAIT_FOR_PLAN
+            rospy.logwarn(f"[{self.node_name}] Plan request failed during startup: {e}")
+
+    def _apriltag_cb(self, msg: ApriltagDistanceMsg) -> None:
+        trigger = Trigger("tag_distance", _stamp(msg), rospy.get_time())
+        with self.condition:
+            self.tag_trigger = trigger
+            # -1 means no tag tracked
+            if msg.tag_id == -1:
+                self.closest_tag_dist = None
+                self.closest_tag_id = None
+            else:
+                self.closest_tag_id = msg.tag_id
+                self.closest_tag_dist = msg.distance
+            self.update_seq += 1
+            self.condition.notify_all()
 
-    
     def _obstacle_detection_cb(self, msg: BoolStamped) -> None:
-        # True means obstacle detected, False otherwise
-        self.obstacle_detected = msg.data
+        trigger = Trigger("obstacle_detected", _stamp(msg), rospy.get_time())
+        with self.condition:
+            self.obstacle_trigger = trigger
+            # True means obstacle detected, False otherwise
+            self.obstacle_detected = msg.data
+            self.update_seq += 1
+            self.condition.notify_all()
+
+    def _lane_following_cb(self, msg: BoolStamped) -> None:
+        with self.condition:
+            # True while the lane following controller drives
+            self.lane_following = msg.data
+            self.lane_following_seq += 1
+            self.condition.notify_all()
+
+    def _wait_for_lane_following_stop(self) -> None:
+        # Waits for a controller state received after the last state change that says it stopped
+        with self.condition:
+            self.condition.wait_for(lambda: (self.lane_following_seq > self.lane_following_seq_at_change and not self.lane_following)
+                                    or rospy.is_shutdown())
+
+    def _close_services(self) -> None:
+        self.planner_service.close()
+        self.turn_service.close()
+
+    def _notify_shutdown(self) -> None:
+        # Wakes up the state machine loop so it sees the shutdown
+        with self.condition:
+            self.condition.notify_all()
+
+    def _keepalive_cb(self, event) -> None:
+        with self.state_lock:
+            self.state_pub.publish(Int32(data=self.state.value))
+
+    def _set_state(self, state: State) -> None:
+        with self.state_lock:
+            if state != self.state:
+                self.state = state
+                self.lane_following_seq_at_change = self.lane_following_seq
+                self.state_pub.publish(Int32(data=state.value))
+
+    def _wait_for_update(self, seen_seq: int) -> int:
+        # Blocks until a callback delivered something newer than seen_seq, returns the latest sequence number
+        with self.condition:
+            self.condition.wait_for(lambda: self.update_seq != seen_seq or rospy.is_shutdown())
+            return self.update_seq
+
+    def _tag_snapshot(self) -> Tuple[Optional[int], bool, Trigger]:
+        # Closest tag id, whether it is close enough to stop, and the message it came from
+        with self.condition:
+            near = self.closest_tag_dist is not None and self.closest_tag_dist < TAG_STOP_DIST
+            return self.closest_tag_id, near, self.tag_trigger
+
+    def _crossing_event(self, tag_id: int) -> Event:
+        command = self.plan[tag_id]
+        if command not in CROSSING_EVENTS:
+            raise ValueError(f"[{self.node_name}] Invalid command at crossing {tag_id}: {command}")
+        self.crossings_already_passed.append(tag_id)
+        return CROSSING_EVENTS[command]
+
+    def _dispatch(self, event: Event, trigger: Trigger, decision_time: float) -> None:
+        next_state = TRANSITIONS.get((self.state, event))
+        if next_state is None:
+            raise ValueError(f"[{self.node_name}] No transition from {self.state.name} on {event.name}")
+        record = TransitionRecord(self.state.name, event.name, next_state.name, trigger, decision_time)
+        self._set_state(next_state)
+        record.state_published_time = rospy.get_time()
+        if next_state in TURN_DIRECTIONS:
+            # Finished when the turn service is called
+            self.pending_record = record
+        else:
+            self._finish_record(record)
+
+    def _finish_record(self, record: TransitionRecord) -> None:
+        entry = self.trace.add(record)
+        self.trace_pub.publish(String(data=json.dumps(entry)))
+
+    def _save_trace(self) -> None:
+        if self.trace_file:
+            self.trace.dump(self.trace_file)
+            rospy.loginfo(f"[{self.node_name}] Transition trace written to {self.trace_file}")
+
+    def _plan_request(self) -> PlannerServiceRequest:
+        request = PlannerServiceRequest()
+        start_grid_coords_dir = rospy.get_param("~start_grid_coords_dir", None)
+        goal_grid_coords_dir = rospy.get_param("~goal_grid_coords_dir", None)
+        if start_grid_coords_dir is None or goal_grid_coords_dir is None:
+            raise ValueError("Start or goal grid coordinates are not set.")
+        # separate the string into a list of strings by space
+        start_grid_coords_dir = ast.literal_eval(start_grid_coords_dir)
+        goal_grid_coords_dir = ast.literal_eval(goal_grid_coords_dir)
+        # convert the third entry to StreetDirection enum
+        request.start_grid_coords_dir[0] = start_grid_coords_dir[0]
+        request.start_grid_coords_dir[1] = start_grid_coords_dir[1]
+        request.start_grid_coords_dir[2] = StreetDirection[start_grid_coords_dir[2]].value
+        request.goal_grid_coords_dir[0] = goal_grid_coords_dir[0]
+        request.goal_grid_coords_dir[1] = goal_grid_coords_dir[1]
+        request.goal_grid_coords_dir[2] = StreetDirection[goal_grid_coords_dir[2]].value
+        return request
+
+    # State handlers: do the work of the state, return the event it ended with and its trigger, or None to stay
+
+    def _wait_for_plan(self) -> Optional[Tuple[Event, Trigger]]:
+        response, self.plan_response = self.plan_response, None
+        if response is None:
+            rospy.loginfo(f"[{self.node_name}] Requesting plan from planner service...")
+            response = self.planner_service(self.plan_request)
+        self.plan = [Command(cmd) for cmd in response.cmd_list]
+        # we do not allow starting at crossing but it's possible that we are right in front of one
+        tag_id, near, tag_trigger = self._tag_snapshot()
+        if near and tag_id == self.goal_tag_id:
+            return Event.GOAL_TAG, tag_trigger
+        if near:
+            return self._crossing_event(tag_id), tag_trigger
+        return Event.PLAN_READY, Trigger("planner_service", None, rospy.get_time())
+
+    def _lane_follow(self) -> Optional[Tuple[Event, Trigger]]:
+        # Nothing to decide until a new tag distance or obstacle message arrives
+        self.seen_seq = self._wait_for_update(self.seen_seq)
+        if rospy.is_shutdown():
+            return None
+        tag_id, near, tag_trigger = self._tag_snapshot()
+        if near and tag_id == self.goal_tag_id:
+            return Event.GOAL_TAG, tag_trigger
+        with self.condition:
+            obstacle_detected, obstacle_trigger = self.obstacle_detected, self.obstacle_trigger
+        if obstacle_detected:
+            return Event.OBSTACLE, obstacle_trigger
+        # check if we are at a crossing
+        if near:
+            if tag_id in self.crossings_already_passed:
+                rospy.logwarn_throttle(1.0, f"[{self.node_name}] Already passed crossing {tag_id} once, keep lane following.")
+                return None
+            rospy.loginfo(f"[{self.node_name}] Detect tag id {tag_id}")
+            return self._crossing_event(tag_id), tag_trigger
+        return None
+
+    def _turn(self) -> Optional[Tuple[Event, Trigger]]:
+        # Turns and the stop for obstacles: wait for the lane following controller to stop, then call the turn service
+        if self.state == State.OBSTACLE_AVOIDANCE:
+            rospy.loginfo(f"[{self.node_name}] Obstacle! Waiting for lane following to stop...")
+        self._wait_for_lane_following_stop()
+        if rospy.is_shutdown():
+            return None
+        direction = TURN_DIRECTIONS[self.state]
+        record, self.pending_record = self.pending_record, None
+        if record is not None:
+            record.stopped_time = rospy.get_time()
+            record.command = f"turn_service {direction.name}"
+            record.command_time = record.stopped_time
+            self._finish_record(record)
+        rospy.loginfo(f"[{self.node_name}] Requesting {direction.name} from turn service...")
+        self.turn_service(TurnServiceRequest(direction=direction.value))
+        turn_trigger = Trigger("turn_service", None, rospy.get_time())
+        if self.state != State.OBSTACLE_AVOIDANCE:
+            return Event.TURN_DONE, turn_trigger
+        with self.condition:
+            self.condition.wait_for(lambda: not self.obstacle_detected or rospy.is_shutdown())
+            obstacle_trigger = self.obstacle_trigger
+        if rospy.is_shutdown():
+            return None
+        return Event.OBSTACLE_CLEARED, obstacle_trigger
 
     def _begin_state_machine(self) -> None:
         rospy.loginfo(f"[{self.node_name}] Starting state machine...")
 
+        self.state_pub.publish(Int32(data=self.state.value))
+        handlers = {
+            State.WAIT_FOR_PLAN: self._wait_for_plan,
+            State.LANE_FOLLOW: self._lane_follow,
+            State.TURN_LEFT: self._turn,
+            State.TURN_RIGHT: self._turn,
+            State.TURN_U: self._turn,
+            State.OBSTACLE_AVOIDANCE: self._turn,
+        }
         while not rospy.is_shutdown():
-            self.state_pub.publish(Int32(data=self.state.value))
-            if self.state == State.WAIT_FOR_PLAN:
-                # rospy.loginfo(f"[{self.node_name}] State: {self.state.name}")
-                planner_service = rospy.ServiceProxy(f"/{self.robot_name}/planner_service", PlannerService)
-                request = PlannerServiceRequest()
-                start_grid_coords_dir = rospy.get_param("~start_grid_coords_dir", None)
-                goal_grid_coords_dir = rospy.get_param("~goal_grid_coords_dir", None)
-                if start_grid_coords_dir is None or goal_grid_coords_dir is None:
-                    raise ValueError("Start or goal grid coordinates are not set.")
-                # separate the string into a list of strings by space
-                start_grid_coords_dir = ast.literal_eval(start_grid_coords_dir)
-                goal_grid_coords_dir = ast.literal_eval(goal_grid_coords_dir)
-                # convert the third entry to StreetDirection enum
-                request.start_grid_coords_dir[0] = start_grid_coords_dir[0]
-                request.start_grid_coords_dir[1] = start_grid_coords_dir[1]
-                request.start_grid_coords_dir[2] = StreetDirection[start_grid_coords_dir[2]].value
-                request.goal_grid_coords_dir[0] = goal_grid_coords_dir[0]
-                request.goal_grid_coords_dir[1] = goal_grid_coords_dir[1]
-                request.goal_grid_coords_dir[2] = StreetDirection[goal_grid_coords_dir[2]].value
-                rospy.loginfo(f"[{self.node_name}] Requesting plan from planner service...")
-
-                response = planner_service(request)
-                self.plan = [Command(cmd) for cmd in response.cmd_list]
-                # we do not allow starting at crossing but it's possible that we are right in front of one
-                if self.closest_tag_dist and self.closest_tag_dist < TAG_STOP_DIST:
-                    if self.closest_tag_id != self.goal_tag_id:
-                        if self.plan[self.closest_tag_id] == Command.FORWARD:
-                            self.state = State.LANE_FOLLOW
-                        elif self.plan[self.closest_tag_id] == Command.LEFT:
-                            self.state = State.TURN_LEFT
-                        elif self.plan[self.closest_tag_id] == Command.RIGHT:
-                            self.state = State.TURN_RIGHT
-                        elif self.plan[self.closest_tag_id] == Command.UTURN:
-                            self.state = State.TURN_U
-                        else:
-                            raise ValueError(f"[{self.node_name}] Invalid command at crossing {self.closest_tag_id}: {self.plan[self.closest_tag_id]}")
-                        self.crossings_already_passed.append(self.closest_tag_id)
-                    else:
-                        self.state = State.STOP
-                else:
-                    self.state = State.LANE_FOLLOW
-                continue
-
-            elif self.state == State.LANE_FOLLOW:
-                # rospy.loginfo(f"[{self.node_name}] State: LANE_FOLLOW")
-                if self.closest_tag_id and self.closest_tag_id == self.goal_tag_id and self.closest_tag_dist < TAG_STOP_DIST:
-                    # print this time to check how much time we need to stop
-                    # self.time = rospy.get_time()
-                    self.state = State.STOP
-                    continue
-
-                if self.obstacle_detected is True:
-                    self.state = State.OBSTACLE_AVOIDANCE
-                    continue
-                
-                # check if we are at a crossing
-                if self.closest_tag_dist and self.closest_tag_dist < TAG_STOP_DIST:
-                    if self.closest_tag_id in self.crossings_already_passed:
-                        rospy.logwarn(f"[{self.node_name}] Already passed crossing {self.closest_tag_id} once, keep lane following.")
-                        continue
-                    rospy.loginfo(f"[{self.node_name}] Detect tag id {self.closest_tag_id}")
-                    if self.plan[self.closest_tag_id] == Command.FORWARD:
-                        self.state = State.LANE_FOLLOW
-                    elif self.plan[self.closest_tag_id] == Command.LEFT:
-                        self.state = State.TURN_LEFT
-                    elif self.plan[self.closest_tag_id] == Command.RIGHT:
-                        self.state = State.TURN_RIGHT
-                    elif self.plan[self.closest_tag_id] == Command.UTURN:
-                        self.state = State.TURN_U
-                    else:
-                        raise ValueError(f"[{self.node_name}] Invalid command at crossing {self.closest_tag_id}: {self.plan[self.closest_tag_id]}")
-                    self.crossings_already_passed.append(self.closest_tag_id)
-                
-            elif self.state == State.TURN_LEFT:
-                # make sure lane following is stopped
-                lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                while lane_follow_state.data:
-                    # Waiting for lane following to stop
-                    lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                # rospy.loginfo(f"[{self.node_name}] State: TURN_LEFT")
-                turn_service = rospy.ServiceProxy(f"/{self.robot_name}/turn_service", TurnService)
-                request = TurnServiceRequest()
-                request.direction = TurnDirection.LEFT.value
-                rospy.loginfo(f"[{self.node_name}] Requesting left turn from turn service...")
-                response = turn_service(request)
-                self.state = State.LANE_FOLLOW
-
-            elif self.state == State.TURN_RIGHT:
-                # make sure lane following is stopped
-                lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                while lane_follow_state.data:
-                    # Waiting for lane following to stop
-                    lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                # rospy.loginfo(f"[{self.node_name}] State: TURN_RIGHT")
-                turn_service = rospy.ServiceProxy(f"/{self.robot_name}/turn_service", TurnService)
-                request = TurnServiceRequest()
-                request.direction = TurnDirection.RIGHT.value
-                rospy.loginfo(f"[{self.node_name}] Requesting right turn from turn service...")
-                response = turn_service(request)
-                self.state = State.LANE_FOLLOW
-
-            elif self.state == State.TURN_U:
-                # make sure lane following is stopped
-                lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                while lane_follow_state.data:
-                    # Waiting for lane following to stop
-                    lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                # rospy.loginfo(f"[{self.node_name}] State: TURN_U")
-                turn_service = rospy.ServiceProxy(f"/{self.robot_name}/turn_service", TurnService)
-                request = TurnServiceRequest()
-                request.direction = TurnDirection.UTURN.value
-                rospy.loginfo(f"[{self.node_name}] Requesting U-turn from turn service...")
-                response = turn_service(request)
-                self.state = State.LANE_FOLLOW
-            
-            elif self.state == State.STOP:
-                lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                while lane_follow_state.data:
-                    # Waiting for lane following to stop
-                    lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                # rospy.loginfo(f"{rospy.get_time() - self.time} sec needed to stop")
+            if self.state == State.STOP:
+                self._wait_for_lane_following_stop()
                 # let user know that we have reached the goal and use ctrl+c to stop the node
                 rospy.loginfo(f"[{self.node_name}] Goal reached! Use ctrl+c to stop the node.")
                 break
+            result = handlers[self.state]()
+            if result is not None:
+                event, trigger = result
+                self._dispatch(event, trigger, rospy.get_time())
 
-            elif self.state == State.OBSTACLE_AVOIDANCE:
-                lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                while lane_follow_state.data:
-                    rospy.loginfo(f"[{self.node_name}] Obstacle! Waiting for lane following to stop...")
-                    lane_follow_state = rospy.wait_for_message(f"/{self.robot_name}/lane_following_controller_node/state", BoolStamped)
-                turn_service = rospy.ServiceProxy(f"/{self.robot_name}/turn_service", TurnService)
-                request = TurnServiceRequest()
-                request.direction = TurnDirection.STOP.value
-                rospy.loginfo(f"[{self.node_name}] Requesting stop from turn service...")
-                response = turn_service(request)
-                while self.obstacle_detected:
-                    rospy.sleep(0.1)
-                self.state = State.LANE_FOLLOW
-            else:
-                raise ValueError(f"[{self.node_name}] Invalid state: {self.state}")
-    
 
 if __name__ == "__main__":
     rospy.init_node("state_machine_node")
     state_machine_node = StateMachineNode()
-    rospy.spin()
\ No newline at end of file
+    rospy.spin()
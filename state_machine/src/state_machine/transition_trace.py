@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Latency trace of the state machine transitions, kept in a ring buffer.
+# All times are in seconds of the same clock, durations are reported in ms relative to the receipt of the trigger.
+import json
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+
+class Trigger:
+    # The message or service response an event was derived from
+    name: str
+    stamp: Optional[float] # header stamp of the message, None if not stamped
+    receive_time: float
+
+    def __init__(self, name: str, stamp: Optional[float], receive_time: float) -> None:
+        self.name = name
+        self.stamp = stamp
+        self.receive_time = receive_time
+
+
+def _ms(start: float, end: Optional[float]) -> Optional[float]:
+    return None if end is None else round((end - start) * 1000, 3)
+
+
+class TransitionRecord:
+    from_state: str
+    event: str
+    to_state: str
+    trigger: Trigger
+    decision_time: float
+    state_published_time: Optional[float]
+    stopped_time: Optional[float]
+    command: Optional[str]
+    command_time: Optional[float]
+
+    def __init__(self, from_state: str, event: str, to_state: str, trigger: Trigger, decision_time: float) -> None:
+        self.from_state = from_state
+        self.event = event
+        self.to_state = to_state
+        self.trigger = trigger
+        self.decision_time = decision_time
+        self.state_published_time = None
+        self.stopped_time = None
+        self.command = None
+        self.command_time = None
+
+    def to_dict(self) -> Dict:
+        start = self.trigger.receive_time
+        return {
+            "time": self.decision_time,
+            "from": self.from_state,
+            "event": self.event,
+            "to": self.to_state,
+            "trigger": self.trigger.name,
+            # How old the trigger was when it arrived, i.e. the upstream pipeline latency
+            "message_age_ms": _ms(self.trigger.stamp, start) if self.trigger.stamp is not None else None,
+            "decision_ms": _ms(start, self.decision_time),
+            "state_published_ms": _ms(start, self.state_published_time),
+            "lane_following_stopped_ms": _ms(start, self.stopped_time),
+            "command": self.command,
+            "command_ms": _ms(start, self.command_time),
+        }
+
+
+class TransitionTrace:
+    records: Deque[Dict]
+    lock: threading.Lock
+
+    def __init__(self, size: int) -> None:
+        self.records = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, record: TransitionRecord) -> Dict:
+        entry = record.to_dict()
+        with self.lock:
+            self.records.append(entry)
+        return entry
+
+    def snapshot(self) -> List[Dict]:
+        with self.lock:
+            return list(self.records)
+
+    def dump(self, path: str) -> None:
+        # One JSON object per line, oldest first
+        with open(path, "w") as file:
+            for entry in self.snapshot():
+                file.write(json.dumps(entry) + "\n")